@@ -0,0 +1,447 @@
+# Compiles random programs and checks that they write what a reference
+# interpreter running the source directly writes, and that BlockMachine
+# agrees with Machine on the compiled code.
+#   python benchmarks/fuzz.py [--seed=N] [--count=N] [--pairs] [--keep=dir] [compiler options]
+# --pairs also generates x/y and x%y of the same operands close together,
+# --keep writes the programs that fail to dir/fuzz_<seed>.imp
+import os
+import random
+import re
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "src"))
+
+from compiler import compile, parse_options
+from machine import Machine
+from block_machine import BlockMachine
+
+REGISTERS = [random.Random(0).randrange(2 ** 31) for _ in range(8)]
+# programs the reference runs longer than this are skipped
+MAX_STATEMENTS = 2 * 10 ** 6
+MAX_STEPS = 2 * 10 ** 7
+
+OPERATIONS = {
+    "+": lambda x, y: x + y,
+    "-": lambda x, y: max(0, x - y),
+    "*": lambda x, y: x * y,
+    "/": lambda x, y: x // y if y else 0,
+    "%": lambda x, y: x % y if y else 0,
+}
+COMPARISONS = {
+    "=": lambda x, y: x == y,
+    "!=": lambda x, y: x != y,
+    "<": lambda x, y: x < y,
+    ">": lambda x, y: x > y,
+    "<=": lambda x, y: x <= y,
+    ">=": lambda x, y: x >= y,
+}
+
+
+class TooLong(Exception):
+    pass
+
+
+def tokenize(source):
+    source = re.sub(r"#.*", "", source)
+    return re.findall(r":=|!=|>=|<=|[=<>]|\d+|[_a-z]+|[A-Z]+|[-+*/%,;()\[\]]", source)
+
+
+class Reference:
+    # parses the source on its own and runs it on the syntax tree, sharing
+    # nothing with the compiler; every variable is a list of cells, so that
+    # a parameter is the caller's list itself
+    def __init__(self, source):
+        self.tokens = tokenize(source)
+        self.position = 0
+        self.procedures = {}
+        self.parse_program()
+
+    def peek(self, offset=0):
+        position = self.position + offset
+        return self.tokens[position] if position < len(self.tokens) else None
+
+    def take(self, expected=None):
+        token = self.tokens[self.position]
+        if expected is not None and token != expected:
+            raise Exception(f"Expected {expected}, got {token}")
+        self.position += 1
+        return token
+
+    def parse_program(self):
+        while self.peek() == "PROCEDURE":
+            self.take()
+            name = self.take()
+            self.take("(")
+            params = []
+            while True:
+                if self.peek() == "T":
+                    self.take()
+                params.append(self.take())
+                if self.peek() != ",":
+                    break
+                self.take()
+            self.take(")")
+            self.take("IS")
+            declarations = self.parse_declarations()
+            self.take("IN")
+            body = self.parse_commands("END")
+            self.take("END")
+            self.procedures[name] = (params, declarations, body)
+        self.take("PROGRAM")
+        self.take("IS")
+        declarations = self.parse_declarations()
+        self.take("IN")
+        self.main = (declarations, self.parse_commands("END"))
+        self.take("END")
+
+    def parse_declarations(self):
+        declarations = []
+        while self.peek() != "IN":
+            name = self.take()
+            size = 1
+            if self.peek() == "[":
+                self.take()
+                size = int(self.take())
+                self.take("]")
+            declarations.append((name, size))
+            if self.peek() == ",":
+                self.take()
+        return declarations
+
+    def parse_commands(self, *ends):
+        commands = []
+        while self.peek() not in ends:
+            commands.append(self.parse_command())
+        return commands
+
+    def parse_identifier(self):
+        name = self.take()
+        if self.peek() != "[":
+            return name, 0
+        self.take()
+        index = self.take()
+        self.take("]")
+        return name, int(index) if index.isdigit() else index
+
+    def parse_value(self):
+        if self.peek().isdigit():
+            return int(self.take())
+        return self.parse_identifier()
+
+    def parse_condition(self):
+        left = self.parse_value()
+        op = self.take()
+        return op, left, self.parse_value()
+
+    def parse_command(self):
+        token = self.peek()
+        if token == "IF":
+            self.take()
+            condition = self.parse_condition()
+            self.take("THEN")
+            commands = self.parse_commands("ELSE", "ENDIF")
+            else_commands = []
+            if self.peek() == "ELSE":
+                self.take()
+                else_commands = self.parse_commands("ENDIF")
+            self.take("ENDIF")
+            return "if", condition, commands, else_commands
+        if token == "WHILE":
+            self.take()
+            condition = self.parse_condition()
+            self.take("DO")
+            commands = self.parse_commands("ENDWHILE")
+            self.take("ENDWHILE")
+            return "while", condition, commands
+        if token == "REPEAT":
+            self.take()
+            commands = self.parse_commands("UNTIL")
+            self.take("UNTIL")
+            condition = self.parse_condition()
+            self.take(";")
+            return "repeat", condition, commands
+        if token in ("READ", "WRITE"):
+            self.take()
+            argument = self.parse_identifier() if token == "READ" else self.parse_value()
+            self.take(";")
+            return token.lower(), argument
+        if self.peek(1) == "(":
+            name = self.take()
+            self.take("(")
+            args = [self.take()]
+            while self.peek() == ",":
+                self.take()
+                args.append(self.take())
+            self.take(")")
+            self.take(";")
+            return "call", name, args
+        target = self.parse_identifier()
+        self.take(":=")
+        left = self.parse_value()
+        expression = (None, left, None)
+        if self.peek() in OPERATIONS:
+            op = self.take()
+            expression = (op, left, self.parse_value())
+        self.take(";")
+        return "assign", target, expression
+
+    def run(self, inputs):
+        self.inputs = list(inputs)
+        self.output = []
+        self.statements = 0
+        declarations, commands = self.main
+        self.run_commands(commands, {name: [0] * size for name, size in declarations})
+        return self.output
+
+    def cell(self, env, identifier):
+        name, index = identifier
+        if type(index) is str:
+            index = env[index][0]
+        return env[name], index
+
+    def value(self, env, value):
+        if type(value) is int:
+            return value
+        cells, index = self.cell(env, value)
+        return cells[index]
+
+    def condition(self, env, condition):
+        op, left, right = condition
+        return COMPARISONS[op](self.value(env, left), self.value(env, right))
+
+    def count(self):
+        self.statements += 1
+        if self.statements > MAX_STATEMENTS:
+            raise TooLong()
+
+    def run_commands(self, commands, env):
+        for command in commands:
+            self.count()
+            kind = command[0]
+            if kind == "assign":
+                op, left, right = command[2]
+                result = self.value(env, left)
+                if op is not None:
+                    result = OPERATIONS[op](result, self.value(env, right))
+                cells, index = self.cell(env, command[1])
+                cells[index] = result
+            elif kind == "if":
+                self.run_commands(command[2] if self.condition(env, command[1]) else command[3], env)
+            elif kind == "while":
+                while self.condition(env, command[1]):
+                    self.run_commands(command[2], env)
+                    self.count()
+            elif kind == "repeat":
+                while True:
+                    self.run_commands(command[2], env)
+                    self.count()
+                    if self.condition(env, command[1]):
+                        break
+            elif kind == "read":
+                cells, index = self.cell(env, command[1])
+                cells[index] = self.inputs.pop(0)
+            elif kind == "write":
+                self.output.append(self.value(env, command[1]))
+            elif kind == "call":
+                params, declarations, body = self.procedures[command[1]]
+                callee = {name: [0] * size for name, size in declarations}
+                callee.update((param, env[arg]) for param, arg in zip(params, command[2]))
+                self.run_commands(body, callee)
+
+
+class Generator:
+    # random programs with nested loops that always end, procedures with
+    # variable and array parameters, constant and variable array indices and
+    # every operator; values are kept below 1000 so that they stay small
+    def __init__(self, rnd, pairs=False):
+        self.rnd = rnd
+        self.pairs = pairs
+        self.procedures = []
+        self.names = 0
+
+    def fresh(self, prefix):
+        # identifiers are letters only
+        self.names += 1
+        return prefix + "".join(chr(ord("a") + int(digit)) for digit in str(self.names))
+
+    def program(self):
+        rnd = self.rnd
+        procedures = [self.procedure() for _ in range(rnd.randint(0, 3))]
+        variables = [self.fresh("v") for _ in range(rnd.randint(2, 6))]
+        arrays = [(self.fresh("t"), rnd.randint(1, 6)) for _ in range(rnd.randint(0, 2))]
+        counters = [self.fresh("k") for _ in range(4)]
+        declarations = ", ".join(variables + [f"{name}[{size}]" for name, size in arrays] + counters)
+        body = [f"{name} := {rnd.randint(0, 30)};" for name in variables]
+        body += [f"{name}[{i}] := {rnd.randint(0, 20)};" for name, size in arrays for i in range(size)]
+        body.append(f"READ {variables[0]};")
+        body += self.block(variables, arrays, counters, 3, True)
+        body += [f"WRITE {name};" for name in variables]
+        body += [f"WRITE {name}[{i}];" for name, size in arrays for i in range(size)]
+        return "".join(procedures) + f"PROGRAM IS\n  {declarations}\nIN\n  " + "\n  ".join(body) + "\nEND\n"
+
+    def procedure(self):
+        rnd = self.rnd
+        name = self.fresh("p")
+        params = [self.fresh("x") for _ in range(rnd.randint(1, 3))]
+        array = self.fresh("q") if rnd.random() < 0.4 else None
+        local_names = [self.fresh("l") for _ in range(rnd.randint(0, 3))]
+        counters = [self.fresh("k") for _ in range(3)]
+        signature = ", ".join(params + ([f"T {array}"] if array else []))
+        body = [f"{local} := {rnd.randint(0, 9)};" for local in local_names]
+        # the array argument may have a single cell
+        body += self.block(params + local_names, [(array, 1)] if array else [], counters, 2)
+        self.procedures.append((name, len(params), array is not None))
+        return f"PROCEDURE {name}({signature}) IS\n  {', '.join(local_names + counters)}\nIN\n  " + \
+            "\n  ".join(body) + "\nEND\n"
+
+    def value(self, variables, arrays, small=False):
+        rnd = self.rnd
+        x = rnd.random()
+        if x < 0.3:
+            return str(rnd.randint(0, 5) if small else rnd.choice([0, 1, 2, 3, 4, 5, 7, 8, 10, 16, 31, 64, 100]))
+        if x < 0.4 and arrays:
+            name, size = rnd.choice(arrays)
+            return f"{name}[{rnd.randint(0, size - 1)}]"
+        return rnd.choice(variables)
+
+    def target(self, variables, arrays):
+        if arrays and self.rnd.random() < 0.3:
+            name, size = self.rnd.choice(arrays)
+            return f"{name}[{self.rnd.randint(0, size - 1)}]"
+        return self.rnd.choice(variables)
+
+    def expression(self, variables, arrays):
+        rnd = self.rnd
+        op = rnd.choice(["", "+", "-", "*", "/", "%", "+", "-"])
+        if not op:
+            return self.value(variables, arrays)
+        left = rnd.choice(variables) if rnd.random() < 0.5 else self.value(variables, arrays)
+        right = self.value(variables, arrays, op == "*")
+        if left.isdigit() and right.isdigit():
+            left = rnd.choice(variables)
+        return f"{left} {op} {right}"
+
+    def condition(self, variables, arrays):
+        op = self.rnd.choice(list(COMPARISONS))
+        return f"{self.value(variables, arrays)} {op} {self.value(variables, arrays)}"
+
+    def block(self, variables, arrays, counters, depth, reads=False):
+        rnd = self.rnd
+        lines = []
+        for _ in range(rnd.randint(1, 5)):
+            x = rnd.random()
+            if self.pairs and rnd.random() < 0.3:
+                left, right = rnd.choice(variables), self.value(variables, arrays)
+                ops = ["/", "%"]
+                rnd.shuffle(ops)
+                first, second = self.target(variables, arrays), self.target(variables, arrays)
+                lines.append(f"{first} := {left} {ops[0]} {right};")
+                if rnd.random() < 0.5:
+                    lines.append(f"WRITE {self.value(variables, arrays)};")
+                if rnd.random() < 0.3:
+                    lines.append(f"{self.target(variables, arrays)} := {self.expression(variables, arrays)};")
+                lines.append(f"{second} := {left} {ops[1]} {right};")
+                lines.append(f"{first} := {first} % 1000;")
+                lines.append(f"{second} := {second} % 1000;")
+            elif x < 0.45 or depth == 0:
+                target = self.target(variables, arrays)
+                lines.append(f"{target} := {self.expression(variables, arrays)};")
+                lines.append(f"{target} := {target} % 1000;")
+            elif x < 0.55:
+                lines.append(f"IF {self.condition(variables, arrays)} THEN")
+                lines += ["  " + line for line in self.block(variables, arrays, counters, depth - 1)]
+                if rnd.random() < 0.5:
+                    lines.append("ELSE")
+                    lines += ["  " + line for line in self.block(variables, arrays, counters, depth - 1)]
+                lines.append("ENDIF")
+            elif x < 0.7 and counters:
+                counter, rest = counters[0], counters[1:]
+                rounds = rnd.randint(0, 4)
+                body = ["  " + line for line in self.block(variables, arrays, rest, depth - 1)]
+                if rnd.random() < 0.5:
+                    lines += [f"{counter} := 0;", f"WHILE {counter} < {rounds} DO"] + body + \
+                        [f"  {counter} := {counter} + 1;", "ENDWHILE"]
+                else:
+                    lines += [f"{counter} := {rounds};", "REPEAT"] + body + \
+                        [f"  {counter} := {counter} - 1;", f"UNTIL {counter} = 0;"]
+            elif x < 0.8 and arrays:
+                name, size = rnd.choice(arrays)
+                index = rnd.choice(variables)
+                lines.append(f"{index} := {index} % {size};")
+                if rnd.random() < 0.5:
+                    lines.append(f"{name}[{index}] := {self.expression(variables, arrays)};")
+                    lines.append(f"{name}[{index}] := {name}[{index}] % 1000;")
+                else:
+                    lines.append(f"{rnd.choice(variables)} := {name}[{index}];")
+            elif x < 0.9 and self.procedures:
+                name, params, takes_array = rnd.choice(self.procedures)
+                if takes_array and not arrays:
+                    continue
+                args = [rnd.choice(variables) for _ in range(params)]
+                if takes_array:
+                    args.append(rnd.choice(arrays)[0])
+                lines.append(f"{name}({', '.join(args)});")
+            elif x < 0.95:
+                lines.append(f"WRITE {self.value(variables, arrays)};")
+            elif reads:
+                lines.append(f"READ {rnd.choice(variables)};")
+        return lines or [f"WRITE {self.value(variables, arrays)};"]
+
+
+def check(seed, settings, pairs):
+    # returns None when the program is fine or skipped, otherwise what is wrong
+    rnd = random.Random(seed)
+    source = Generator(rnd, pairs).program()
+    inputs = [rnd.randint(0, 50) for _ in range(20)]
+    try:
+        expected = Reference(source).run(inputs)
+    except TooLong:
+        return source, None
+    try:
+        code = compile(source, **settings).code
+        result = Machine(code).run(inputs, REGISTERS, MAX_STEPS)
+        blocks = BlockMachine(code).run(inputs, REGISTERS, MAX_STEPS)
+    except Exception as e:
+        return source, str(e)
+    if result.output != expected:
+        return source, f"wrote {result.output[:8]}, expected {expected[:8]}"
+    if blocks.output != result.output or blocks.cost != result.cost:
+        return source, f"BlockMachine wrote {blocks.output[:8]} at cost {blocks.cost}, Machine cost {result.cost}"
+    return source, None
+
+
+def main(argv):
+    seed, count = 0, 200
+    pairs = False
+    keep = None
+    options = []
+    for option in argv[1:]:
+        key, _, value = option.partition("=")
+        if key == "--seed":
+            seed = int(value)
+        elif key == "--count":
+            count = int(value)
+        elif key == "--pairs":
+            pairs = True
+        elif key == "--keep":
+            keep = value
+        else:
+            options.append(option)
+    settings = parse_options(options)
+    failed = 0
+    for program_seed in range(seed, seed + count):
+        source, problem = check(program_seed, settings, pairs)
+        if problem is None:
+            continue
+        failed += 1
+        print(f"seed {program_seed}: {problem}")
+        if keep:
+            with open(os.path.join(keep, f"fuzz_{program_seed}.imp"), 'w') as out_f:
+                out_f.write(source)
+    print(f"{count} programs, {failed} failed")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
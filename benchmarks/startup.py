@@ -0,0 +1,44 @@
+# Measures compiler start-up latency with and without the cached parser tables.
+#   python benchmarks/startup.py [runs] [program.imp]
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+COMPILER = os.path.join(ROOT, "src", "compiler.py")
+
+
+def run(source, output, tables):
+    env = dict(os.environ, IMP_PARSER_TABLES=tables)
+    start = time.perf_counter()
+    subprocess.run([sys.executable, COMPILER, source, output], env=env, check=True, stdout=subprocess.DEVNULL)
+    return time.perf_counter() - start
+
+
+def measure(runs, source):
+    with tempfile.TemporaryDirectory() as directory:
+        output = os.path.join(directory, "out.mr")
+        cached = os.path.join(directory, "cached.tables")
+        run(source, output, cached)
+        cold, warm = [], []
+        for i in range(runs):
+            cold.append(run(source, output, os.path.join(directory, f"cold{i}.tables")))
+            warm.append(run(source, output, cached))
+    return cold, warm
+
+
+def report(name, times):
+    print(f"{name:>8}: median {statistics.median(times) * 1000:7.1f} ms, min {min(times) * 1000:7.1f} ms")
+
+
+if __name__ == "__main__":
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    source = sys.argv[2] if len(sys.argv) > 2 else os.path.join(ROOT, "examples2023", "example1.imp")
+    cold, warm = measure(runs, source)
+    print(f"{os.path.basename(source)}, {runs} runs each")
+    report("cold", cold)
+    report("cached", warm)
+    print(f"saved {(statistics.median(cold) - statistics.median(warm)) * 1000:.1f} ms per invocation")
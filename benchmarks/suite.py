@@ -0,0 +1,212 @@
+# Compiles and runs every program of examples2023, checks the outputs given in
+# the header comments and reports code size, machine cost and compile time.
+#   python benchmarks/suite.py [--record=file] [--compare=file] [--cost-threshold=P]
+#                              [--time-threshold=P] [--repeat=N] [--max-steps=N] [--dir=path]
+#                              [compiler options]
+import json
+import os
+import random
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "src"))
+
+from compiler import compile, parse_options
+from machine import Machine
+
+EXAMPLES = os.path.join(ROOT, "examples2023")
+BASELINE = os.path.join(ROOT, "benchmarks", "baseline.json")
+REGISTERS = [random.Random(0).randrange(2 ** 31) for _ in range(8)]
+# a run that executes more instructions than this fails instead of hanging
+MAX_STEPS = 10 ** 7
+
+
+def numbers(text):
+    try:
+        return [int(value) for value in text.split()]
+    except ValueError:
+        return None
+
+
+def parse_header(source):
+    # "# ? 20" is an input and "# > 167960" an expected output of one run; a
+    # header can also list runs as a line of inputs followed by a line of
+    # outputs, with an empty comment line between runs
+    cases = []
+    inputs, outputs = [], []
+    pending = None
+    for line in source.splitlines():
+        if not line.startswith("#"):
+            break
+        text = line[1:].strip()
+        if text.startswith("?") and numbers(text[1:]):
+            inputs += numbers(text[1:])
+        elif text.startswith(">") and numbers(text[1:]):
+            outputs += numbers(text[1:])
+        elif not text:
+            if inputs or outputs:
+                cases.append((inputs, outputs))
+            inputs, outputs, pending = [], [], None
+        elif numbers(text) is not None:
+            if pending is None:
+                pending = numbers(text)
+            else:
+                cases.append((pending, numbers(text)))
+                pending = None
+    if inputs or outputs:
+        cases.append((inputs, outputs))
+    return cases
+
+
+def read_cases(path, source):
+    # runs can also be given in program.runs next to program.imp, in the
+    # same format as the header, for programs whose header has none
+    cases = parse_header(source)
+    runs = os.path.splitext(path)[0] + ".runs"
+    if os.path.exists(runs):
+        with open(runs) as in_f:
+            cases += parse_header(in_f.read())
+    return cases
+
+
+def measure(path, settings, repeat, max_steps):
+    with open(path) as in_f:
+        source = in_f.read()
+    # one untimed compile first, then the best of the timed ones, which is
+    # much steadier than the mean for runs this short
+    program = compile(source, **settings)
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        program = compile(source, **settings)
+        times.append(time.perf_counter() - start)
+    machine = Machine(program.code)
+    entry = {"size": len(program.code), "compile_ms": round(min(times) * 1000, 2), "runs": []}
+    for inputs, expected in read_cases(path, source) or [([], None)]:
+        run = {"inputs": inputs}
+        try:
+            result = machine.run(inputs, REGISTERS, max_steps)
+        except Exception as e:
+            run["error"] = str(e)
+        else:
+            run.update(cost=result.cost, io=result.io, steps=result.steps, output=result.output)
+            if expected:
+                run["ok"] = result.output == expected
+        entry["runs"].append(run)
+    return entry
+
+
+def run_suite(directory, settings, repeat, max_steps):
+    results = {}
+    for name in sorted(os.listdir(directory)):
+        if name.endswith(".imp"):
+            results[name] = measure(os.path.join(directory, name), settings, repeat, max_steps)
+    return results
+
+
+def report(results):
+    failed = 0
+    print(f"{'program':<16} {'size':>6} {'compile ms':>11} {'cost':>12} {'steps':>10}  status")
+    for name, entry in results.items():
+        for k, run in enumerate(entry["runs"]):
+            label = name if k == 0 else ""
+            size = entry["size"] if k == 0 else ""
+            compile_ms = entry["compile_ms"] if k == 0 else ""
+            if "error" in run:
+                failed += 1
+                status = f"FAILED: {run['error']}"
+                print(f"{label:<16} {size:>6} {compile_ms:>11} {'-':>12} {'-':>10}  {status}")
+                continue
+            status = {True: "ok", False: "WRONG OUTPUT", None: "no expected output"}[run.get("ok")]
+            if run.get("ok") is False:
+                failed += 1
+            print(f"{label:<16} {size:>6} {compile_ms:>11} {run['cost']:>12} {run['steps']:>10}  {status}")
+    return failed
+
+
+def change(old, new):
+    return 100 * (new - old) / old if old else 0
+
+
+def compare(results, baseline, cost_threshold, time_threshold):
+    regressions = 0
+    for name, entry in results.items():
+        old = baseline.get(name)
+        if old is None:
+            print(f"{name}: not in baseline")
+            continue
+        notes = []
+        for run, old_run in zip(entry["runs"], old["runs"]):
+            if run["inputs"] != old_run["inputs"] or "cost" not in old_run:
+                continue
+            if "cost" not in run:
+                regressions += 1
+                notes.append(f"FAILED (cost {old_run['cost']} in baseline)")
+                continue
+            if "ok" not in run and run["output"] != old_run["output"]:
+                # without expected outputs the baseline's output is the reference
+                regressions += 1
+                notes.append("OUTPUT differs from baseline")
+            cost_change = change(old_run["cost"], run["cost"])
+            if cost_change > cost_threshold:
+                regressions += 1
+                notes.append(f"COST {old_run['cost']} -> {run['cost']} ({cost_change:+.1f}%)")
+            elif run["cost"] != old_run["cost"]:
+                notes.append(f"cost {old_run['cost']} -> {run['cost']} ({cost_change:+.1f}%)")
+        time_change = change(old["compile_ms"], entry["compile_ms"])
+        if time_change > time_threshold:
+            regressions += 1
+            notes.append(f"COMPILE TIME {old['compile_ms']} -> {entry['compile_ms']} ms ({time_change:+.1f}%)")
+        if entry["size"] != old["size"]:
+            notes.append(f"size {old['size']} -> {entry['size']}")
+        print(f"{name}: {', '.join(notes) if notes else 'unchanged'}")
+    return regressions
+
+
+def main(argv):
+    record = compare_with = None
+    cost_threshold, time_threshold = 0.0, 25.0
+    repeat = 5
+    max_steps = MAX_STEPS
+    directory = EXAMPLES
+    options = []
+    for option in argv[1:]:
+        key, _, value = option.partition("=")
+        if key == "--record":
+            record = value or BASELINE
+        elif key == "--compare":
+            compare_with = value or BASELINE
+        elif key == "--cost-threshold":
+            cost_threshold = float(value)
+        elif key == "--time-threshold":
+            time_threshold = float(value)
+        elif key == "--repeat":
+            repeat = int(value)
+        elif key == "--max-steps":
+            max_steps = int(value)
+        elif key == "--dir":
+            directory = value
+        else:
+            options.append(option)
+
+    results = run_suite(directory, parse_options(options), repeat, max_steps)
+    failed = report(results)
+    if record:
+        with open(record, 'w') as out_f:
+            json.dump({"options": options, "programs": results}, out_f, indent=1)
+            out_f.write("\n")
+    regressions = 0
+    if compare_with:
+        with open(compare_with) as in_f:
+            baseline = json.load(in_f)
+        if baseline["options"] != options:
+            print(f"warning: baseline was recorded with options {baseline['options']}")
+        print()
+        regressions = compare(results, baseline["programs"], cost_threshold, time_threshold)
+        print(f"{regressions} regression(s) beyond {cost_threshold}% cost / {time_threshold}% compile time")
+    return 1 if failed or regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,195 @@
+from structures import Array, Link_T
+
+
+# values
+
+class Const:
+    __slots__ = ("value",)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __eq__(self, other):
+        return type(other) is Const and self.value == other.value
+
+    def __hash__(self):
+        return hash(self.value)
+
+    def __repr__(self):
+        return str(self.value)
+
+
+class Name:
+    __slots__ = ("name", "symbol")
+
+    def __init__(self, name, symbol):
+        self.name = name
+        self.symbol = symbol
+
+    def __eq__(self, other):
+        return type(other) is Name and self.name == other.name
+
+    def __hash__(self):
+        return hash(self.name)
+
+    def __repr__(self):
+        return self.name
+
+
+class Element:
+    __slots__ = ("name", "symbol", "index")
+
+    def __init__(self, name, symbol, index):
+        self.name = name
+        self.symbol = symbol
+        self.index = index
+
+    def is_link(self):
+        return type(self.symbol) is Link_T
+
+    def __eq__(self, other):
+        return type(other) is Element and self.name == other.name and self.index == other.index
+
+    def __hash__(self):
+        return hash((self.name, self.index))
+
+    def __repr__(self):
+        return f"{self.name}[{self.index}]"
+
+
+class Load:
+    __slots__ = ("target",)
+
+    def __init__(self, target):
+        self.target = target
+
+    def __eq__(self, other):
+        return type(other) is Load and self.target == other.target
+
+    def __hash__(self):
+        return hash(self.target)
+
+    def __repr__(self):
+        return repr(self.target)
+
+
+# expressions and conditions
+
+class BinOp:
+    __slots__ = ("op", "left", "right")
+
+    def __init__(self, op, left, right):
+        self.op = op
+        self.left = left
+        self.right = right
+
+    def __eq__(self, other):
+        return type(other) is BinOp and (self.op, self.left, self.right) == (other.op, other.left, other.right)
+
+    def __hash__(self):
+        return hash((self.op, self.left, self.right))
+
+    def __repr__(self):
+        return f"({self.left} {self.op} {self.right})"
+
+
+# the comparison that holds exactly when the other one does not
+INVERSE = {"eq": "ne", "ne": "eq", "lt": "ge", "ge": "lt", "gt": "le", "le": "gt"}
+
+
+class Condition:
+    __slots__ = ("op", "left", "right")
+
+    def __init__(self, op, left, right):
+        self.op = op
+        self.left = left
+        self.right = right
+
+    def __eq__(self, other):
+        return type(other) is Condition and (self.op, self.left, self.right) == (other.op, other.left, other.right)
+
+    def __hash__(self):
+        return hash((self.op, self.left, self.right))
+
+    def __repr__(self):
+        return f"({self.left} {self.op} {self.right})"
+
+
+# commands
+
+class Assign:
+    __slots__ = ("target", "expr", "lineno")
+
+    def __init__(self, target, expr, lineno):
+        self.target = target
+        self.expr = expr
+        self.lineno = lineno
+
+
+class If:
+    __slots__ = ("condition", "commands", "else_commands", "lineno")
+
+    def __init__(self, condition, commands, else_commands, lineno):
+        self.condition = condition
+        self.commands = commands
+        self.else_commands = else_commands
+        self.lineno = lineno
+
+
+class While:
+    __slots__ = ("condition", "commands", "lineno")
+
+    def __init__(self, condition, commands, lineno):
+        self.condition = condition
+        self.commands = commands
+        self.lineno = lineno
+
+
+class Until:
+    __slots__ = ("condition", "commands", "lineno")
+
+    def __init__(self, condition, commands, lineno):
+        self.condition = condition
+        self.commands = commands
+        self.lineno = lineno
+
+
+class Read:
+    __slots__ = ("target", "lineno")
+
+    def __init__(self, target, lineno):
+        self.target = target
+        self.lineno = lineno
+
+
+class Write:
+    __slots__ = ("value", "lineno")
+
+    def __init__(self, value, lineno):
+        self.value = value
+        self.lineno = lineno
+
+
+class Call:
+    __slots__ = ("name", "procedure", "args", "lineno")
+
+    def __init__(self, name, procedure, args, lineno):
+        self.name = name
+        self.procedure = procedure
+        self.args = args
+        self.lineno = lineno
+
+
+class Inline:
+    # the body of call.procedure copied in place of the call, with the
+    # arguments substituted for the parameters
+    __slots__ = ("call", "commands", "lineno")
+
+    def __init__(self, call, commands, lineno):
+        self.call = call
+        self.commands = commands
+        self.lineno = lineno
+
+
+def is_array(symbol):
+    return type(symbol) in (Array, Link_T)
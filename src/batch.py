@@ -0,0 +1,66 @@
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from compiler import compile, parse_options
+
+
+def compile_file(source_path, output_path, settings):
+    start = time.perf_counter()
+    try:
+        with open(source_path) as in_f:
+            source = in_f.read()
+        program = compile(source, **settings)
+        program.write(output_path)
+        return source_path, time.perf_counter() - start, len(program.code), None
+    except Exception as e:
+        return source_path, time.perf_counter() - start, 0, str(e)
+
+
+def compile_directory(source_dir, output_dir, settings, jobs=None):
+    names = sorted(name for name in os.listdir(source_dir) if name.endswith(".imp"))
+    os.makedirs(output_dir, exist_ok=True)
+    with ProcessPoolExecutor(jobs) as pool:
+        futures = [pool.submit(compile_file, os.path.join(source_dir, name),
+                               os.path.join(output_dir, name[:-len(".imp")] + ".mr"), settings)
+                   for name in names]
+        results = [future.result() for future in futures]
+
+    with open(os.path.join(output_dir, "timings.tsv"), 'w') as out_f:
+        print("file\tseconds\tinstructions\tstatus", file=out_f)
+        for path, seconds, size, error in results:
+            print(f"{os.path.basename(path)}\t{seconds:.4f}\t{size}\t{error or 'ok'}", file=out_f)
+    return results
+
+
+def main(argv):
+    if len(argv) < 3:
+        print("usage: batch.py <source_dir> <output_dir> [--jobs=N] [compiler options]")
+        return 2
+    jobs = None
+    options = []
+    for option in argv[3:]:
+        if option.startswith("--jobs="):
+            jobs = int(option.split("=", 1)[1])
+        else:
+            options.append(option)
+
+    start = time.perf_counter()
+    results = compile_directory(argv[1], argv[2], parse_options(options), jobs)
+    elapsed = time.perf_counter() - start
+
+    failed = 0
+    for path, seconds, size, error in results:
+        if error:
+            failed += 1
+            print(f"{os.path.basename(path)}: FAILED {error}")
+        else:
+            print(f"{os.path.basename(path)}: {seconds * 1000:.1f} ms, {size} instructions")
+    compile_time = sum(seconds for _, seconds, _, _ in results)
+    print(f"{len(results)} files, {failed} failed, {compile_time:.2f} s compile time, {elapsed:.2f} s wall time")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,144 @@
+from instructions import (READ, WRITE, LOAD, STORE, ADD, SUB, GET, PUT, RST, INC, DEC, SHL, SHR,
+                          JUMP, JPOS, STRK, JUMPR, HALT)
+from machine import Machine, Result, END, check_limit
+
+REGISTERS = ", ".join(f"r{i}" for i in range(8))
+
+STATEMENTS = {
+    LOAD: "r0 = get(r{x}, 0)",
+    STORE: "memory[r{x}] = r0",
+    ADD: "r0 += r{x}",
+    SUB: "r0 = r0 - r{x} if r0 >= r{x} else 0",
+    GET: "r0 = r{x}",
+    PUT: "r{x} = r0",
+    RST: "r{x} = 0",
+    INC: "r{x} += 1",
+    DEC: "r{x} = r{x} - 1 if r{x} > 0 else 0",
+    SHL: "r{x} <<= 1",
+    SHR: "r{x} >>= 1",
+    STRK: "r{x} = {i}",
+    READ: "r0 = read(inputs, {i})",
+    WRITE: "output.append(r0)",
+}
+COSTS = {LOAD: 50, STORE: 50, ADD: 5, SUB: 5}
+
+
+def read(inputs, lr):
+    try:
+        return next(inputs)
+    except StopIteration:
+        raise Exception(f"No input left for READ at instruction {lr}") from None
+
+
+class FunctionBuilder:
+    # translates the code reachable from start into one Python function: straight
+    # runs of instructions become statements, jump targets are inlined as nested
+    # branches up to max_depth, a jump back to start becomes a loop and any other
+    # target leaves the function and returns the address to continue at
+    max_depth = 4
+    budget = 200
+
+    def __init__(self, ops, args, start):
+        self.ops = ops
+        self.args = args
+        self.start = start
+        self.lines = []
+        self.size = 0
+
+    def build(self):
+        self.lines = [
+            "def block(r, memory, output, inputs, t, io, steps, limit):",
+            f"    {REGISTERS} = r",
+            "    get = memory.get",
+            "    while steps <= limit:",
+        ]
+        self.segment(self.start, 2, 0, set())
+        self.exit(str(self.start), 1)
+        namespace = {"read": read}
+        exec(compile("\n".join(self.lines), f"<block {self.start}>", "exec"), namespace)
+        return namespace["block"]
+
+    def emit(self, line, indent):
+        self.lines.append("    " * indent + line)
+
+    def exit(self, target, indent):
+        self.emit(f"r[:] = {REGISTERS}", indent)
+        self.emit(f"return {target}, t, io, steps", indent)
+
+    def segment(self, i, indent, depth, path):
+        path = path | {i}
+        t = io = steps = 0
+        while True:
+            op, x = self.ops[i], self.args[i]
+            if op in STATEMENTS:
+                self.emit(STATEMENTS[op].format(x=x, i=i), indent)
+                if op == READ or op == WRITE:
+                    io += 100
+                else:
+                    t += COSTS.get(op, 1)
+                steps += 1
+                self.size += 1
+                i += 1
+                continue
+            break
+        if op == END:
+            self.emit(f"raise Exception('Jump to nonexistent instruction {i}')", indent)
+            return
+        if op != HALT:
+            t += 1
+            steps += 1
+        if t:
+            self.emit(f"t += {t}", indent)
+        if io:
+            self.emit(f"io += {io}", indent)
+        if steps:
+            self.emit(f"steps += {steps}", indent)
+        if op == HALT:
+            self.exit("-1", indent)
+        elif op == JUMPR:
+            self.exit(f"r{x}", indent)
+        elif op == JUMP:
+            self.goto(x, indent, depth, path)
+        else:
+            self.emit("if r0 > 0:" if op == JPOS else "if r0 == 0:", indent)
+            self.goto(x, indent + 1, depth, path)
+            self.goto(i + 1, indent, depth, path)
+
+    def goto(self, target, indent, depth, path):
+        if target == self.start:
+            self.emit("continue", indent)
+        elif target in path or depth >= self.max_depth or self.size >= self.budget:
+            self.exit(str(target), indent)
+        else:
+            self.segment(target, indent, depth + 1, path)
+
+
+class BlockMachine(Machine):
+    def __init__(self, code):
+        super().__init__(code)
+        self.functions = {}
+
+    def function(self, start):
+        if not 0 <= start < len(self):
+            raise Exception(f"Jump to nonexistent instruction {start}")
+        function = FunctionBuilder(self.ops, self.args, start).build()
+        self.functions[start] = function
+        return function
+
+    def run(self, inputs=(), registers=None, max_steps=None):
+        # the step limit is checked when a function returns, so a run that
+        # goes past it stops a little later than on Machine
+        check_limit(max_steps)
+        inputs = iter(inputs)
+        output = []
+        memory = {}
+        r = list(registers) if registers is not None else self.random_registers()
+        limit = max_steps if max_steps is not None else float("inf")
+        functions = self.functions
+        lr = t = io = steps = 0
+        while lr >= 0:
+            function = functions.get(lr) or self.function(lr)
+            lr, t, io, steps = function(r, memory, output, inputs, t, io, steps, limit)
+            if steps > limit:
+                raise Exception(f"Step limit {max_steps} reached")
+        return Result(output, t, io, steps)
@@ -1,4 +1,55 @@
 from structures import Variable, Link, Link_T, Array
+from ast_nodes import (Const, Name, Element, Load, BinOp, Condition, Assign, If, While, Until, Read, Write, Call,
+                       Inline, INVERSE)
+from instructions import (READ, WRITE, LOAD, STORE, ADD, SUB, GET, PUT, RST, INC, DEC, SHL, SHR, JUMP, JPOS, JZERO,
+                          STRK, JUMPR, HALT, LABEL, REGISTERS, REGISTER_INDEX, REGISTER_OPS, Instruction)
+from peephole import instruction_cost, static_cost
+from const_planner import ConstPlanner
+from register_allocator import LoopRegisterAllocator
+from linker import is_label
+from value_ranges import TOP
+
+
+UNROLLED_STEPS = 8
+
+
+def routine_for(expr):
+    # the multiplication or division loop the expression needs, if any
+    if type(expr) is not BinOp or expr.op not in ("mul", "div", "mod"):
+        return None
+    expr1, expr2 = expr.left, expr.right
+    if type(expr1) is Const and type(expr2) is Const:
+        return None
+    if expr.op == "mul":
+        if type(expr1) is Const or type(expr2) is Const:
+            return None
+        return "mul"
+    if expr1 == expr2 or (type(expr1) is Const and expr1.value == 0):
+        return None
+    if type(expr2) is Const and expr2.value & (expr2.value - 1) == 0:
+        return None
+    return "div"
+
+
+def multiplication_digits(value):
+    # value as digits from the highest, each 0, 1 or -1: plain binary, or
+    # the form without adjacent nonzero digits when its extra subtractions
+    # save enough additions
+    binary = [int(bit) for bit in bin(value)[2:]]
+    signed = []
+    while value:
+        if value & 1:
+            digit = 2 - (value & 3)
+            value -= digit
+        else:
+            digit = 0
+        signed.append(digit)
+        value >>= 1
+    signed.reverse()
+
+    def cost(digits):
+        return (len(digits) - 1) * instruction_cost(SHL) + sum(1 for digit in digits[1:] if digit) * instruction_cost(ADD)
+    return min(binary, signed, key=cost)
 
 
 class CodeGenerator:
@@ -11,11 +62,34 @@ class CodeGenerator:
         self.code = []
         self.links = []
 
-        self.first_line = 0 
         self.loop_depth = 0
+        self.labels = 0
 
         self.reg_address = "h"
         self.reg_value = "g"
+        self.reg_return = "f"
+
+        self.arith_mode = "inline"
+        self.routine_sites = {}
+        self.used_routines = set()
+
+        self.planner = ConstPlanner()
+        self.planned = 0
+
+        self.promoted = {}
+        self.promoted_written = set()
+        self.trial = 0
+
+        self.warnings = []
+        # variables passed to an inlined procedure, which may read them
+        # before they are set just like a procedure reads its parameters
+        self.unchecked = frozenset()
+        # the inlined calls the code being generated comes from, as
+        # (procedure, line of the call) from the outermost one, and the
+        # procedure whose source it is; instructions of an inlined body get
+        # both as their origin
+        self.inlined = ()
+        self.source = None
 
     def gen_procedure_code(self, name, procedure_table):
         self.procedure_table = procedure_table
@@ -23,68 +97,215 @@ class CodeGenerator:
         self.commands = self.procedure.commands
         self.symbols = self.procedure.symbols
         self.links = self.procedure.links
-        self.code = []
-        self.first_line = procedure_table.current_line
+        self.reset_code()
+        self.label(name)
+        self.source = name
+        # a specialized copy reads the caller's variables directly, so they
+        # get the same treatment as parameters; the ones it sets are marked
+        # initialized at its calls instead of here
+        bound = [(symbol, symbol.initialized) for symbol in self.procedure.bindings.values()
+                 if type(symbol) is Variable]
+        for symbol, _ in bound:
+            symbol.initialized = False
+        self.unchecked = frozenset(symbol for symbol, _ in bound)
         self.gen_code_from_commands(self.commands)
+        self.unchecked = frozenset()
+        self.procedure.assigned = [symbol for symbol, _ in bound if symbol.initialized]
+        for symbol, initialized in bound:
+            symbol.initialized = initialized
         if name == 'PROGRAM':
-            self.code.append("HALT")
+            self.emit(HALT)
         else:
             self.gen_jump_back(self.procedure.memory_offset)
 
+    def gen_routine_code(self, kind):
+        self.reset_code()
+        self.label(kind.upper())
+        if kind == "mul":
+            self.gen_multiplication_loop()
+            self.emit(GET, 'd')
+        else:
+            self.gen_division_loop()
+        self.emit(INC, self.reg_return)
+        self.emit(INC, self.reg_return)
+        self.emit(JUMPR, self.reg_return)
+
+    def count_routine_sites(self, commands, depth=0):
+        # only sites outside loops are counted, the ones in loops never call
+        fused = None
+        for k, command in enumerate(commands):
+            if command is fused:
+                continue
+            match command:
+                case Assign():
+                    fused = self.division_pair(commands, k)
+                    kind = routine_for(command.expr)
+                    if kind and not depth:
+                        self.routine_sites[kind] = self.routine_sites.get(kind, 0) + 1
+                case If():
+                    self.count_routine_sites(command.commands, depth)
+                    if command.else_commands is not None:
+                        self.count_routine_sites(command.else_commands, depth)
+                case While() | Until():
+                    self.count_routine_sites(command.commands, depth + 1)
+                case Inline():
+                    self.count_routine_sites(command.commands, depth)
+
+    def use_routine(self, kind):
+        if self.arith_mode == "call":
+            return True
+        if self.arith_mode != "auto" or self.loop_depth:
+            # in a loop the call and return would be paid on every round
+            return False
+        sites = self.routine_sites.get(kind, 0)
+        inline_cost = static_cost(self.routine_body(kind))
+        call_cost = instruction_cost(STRK) + instruction_cost(JUMP)
+        routine_cost = inline_cost + 3 * instruction_cost(INC)
+        return sites * inline_cost > routine_cost + sites * call_cost
+
+    def routine_body(self, kind):
+        generator = CodeGenerator()
+        if kind == "mul":
+            generator.gen_multiplication_loop()
+        else:
+            generator.gen_division_loop()
+        return [instruction for instruction in generator.code if not is_label(instruction)]
+
+    def call_routine(self, kind):
+        self.used_routines.add(kind)
+        self.emit(STRK, self.reg_return)
+        self.emit(JUMP, kind.upper())
+
     def gen_jump_back(self, memory_offset):
         self.gen_const(value=memory_offset, reg="a")
-        self.code.append("LOAD a")
-        self.code.append("JUMPR a")
+        self.emit(LOAD, 'a')
+        self.emit(JUMPR, 'a')
 
-    def get_current_line(self, offset = True):
-        if offset:
-            return self.first_line + len(self.code)
-        return len(self.code)
+    def reset_code(self):
+        self.code = []
+        self.planner.clear()
+        self.planned = 0
+
+    def new_label(self):
+        self.labels += 1
+        return f"L{self.labels}"
+
+    def label(self, name=None):
+        if name is None:
+            name = self.new_label()
+        self.emit(LABEL, name)
+        return name
+
+    def emit(self, op, arg=None):
+        if op in REGISTER_OPS:
+            arg = REGISTER_INDEX[arg]
+        self.code.append(Instruction(op, arg))
+
+    def stamp_lines(self, start, lineno):
+        for instruction in self.code[start:]:
+            if instruction.line is None:
+                instruction.line = lineno
+                if self.inlined:
+                    instruction.origin = self.inlined, self.source
 
     def gen_code_from_commands(self, commands):
-        for command in commands:
+        fused = None
+        for k, command in enumerate(commands):
+            if command is fused:
+                continue
+            start = len(self.code)
             try:
-                match command[0]:
-                    case "write":
-                        self.perform_write(command[1])
-                    case "read":
-                        self.perform_read(command[1])
-                    case "assign":
-                        self.perform_assign(command[1], command[2])
-                    case "if":
-                        self.perform_if(command[1], command[2])
-                    case "ifelse":
-                        self.perform_if_else(command[1], command[2], command[3])
-                    case "while":
-                        self.perform_while(command[1], command[2])
-                    case "until":
-                        self.perform_until(condition=command[1], commands=command[2])
-                    case "proc_call":
-                        self.perform_procedure(command[1])
+                match command:
+                    case Write():
+                        self.perform_write(command.value)
+                    case Read():
+                        self.perform_read(command.target)
+                    case Assign():
+                        fused = self.division_pair(commands, k)
+                        if fused is not None:
+                            self.perform_division_pair(command, fused)
+                        else:
+                            self.perform_assign(command.target, command.expr)
+                    case If():
+                        if command.else_commands is None:
+                            self.perform_if(command.condition, command.commands)
+                        else:
+                            self.perform_if_else(command.condition, command.commands, command.else_commands)
+                    case While():
+                        self.perform_while(command.condition, command.commands)
+                    case Until():
+                        self.perform_until(condition=command.condition, commands=command.commands)
+                    case Call():
+                        self.perform_procedure(command)
+                    case Inline():
+                        self.perform_inline(command)
             except Exception as e:
-                raise Exception(f'{e}, at line {command[-1]}') from None
+                raise Exception(f'{e}, at line {command.lineno}') from None
+            self.stamp_lines(start, command.lineno)
 
     # START commands
 
     def perform_write(self, value):
-        if value[0] == "const":
-            self.gen_const(value[1], 'a')
+        if type(value) is Const:
+            self.gen_const(value.value, 'a')
         else:
-            self.load_variable(value[1], 'a')
+            self.load_variable(value.target, 'a')
 
-        self.code.append("WRITE")
+        self.emit(WRITE)
 
     def perform_read(self, target):
+        if type(target) is Name and target.name in self.promoted:
+            target.symbol.initialized = True
+            self.emit(READ)
+            self.emit(PUT, self.promoted[target.name])
+            return
         self.load_address(target, out_reg=self.reg_address, isInit=True)
-        self.code.append("READ")
-        self.code.append(f"STORE {self.reg_address}")
+        self.emit(READ)
+        self.emit(STORE, self.reg_address)
  
     def perform_assign(self, target, expr):
         self.calculate_expression(expr)
-        self.code.append("PUT d")
-        self.load_address(target, out_reg=self.reg_address, isInit=True)
-        self.code.append("GET d")
-        self.code.append(f"STORE {self.reg_address}")
+        self.store_accumulator(target)
+
+    def store_accumulator(self, target):
+        if type(target) is Name and target.name in self.promoted:
+            target.symbol.initialized = True
+            self.emit(PUT, self.promoted[target.name])
+        elif type(target.symbol) is Variable:
+            self.load_address(target, out_reg=self.reg_address, isInit=True)
+            self.emit(STORE, self.reg_address)
+        else:
+            self.emit(PUT, 'd')
+            self.load_address(target, out_reg=self.reg_address, isInit=True)
+            self.emit(GET, 'd')
+            self.emit(STORE, self.reg_address)
+
+    def division_pair(self, commands, k):
+        # x := a / b next to y := a % b, in either order, needs one division
+        # when x is a plain variable that a and b do not read
+        if k + 1 >= len(commands) or type(commands[k + 1]) is not Assign:
+            return None
+        first, second = commands[k].expr, commands[k + 1].expr
+        if type(first) is not BinOp or type(second) is not BinOp or {first.op, second.op} != {"div", "mod"}:
+            return None
+        if (first.left, first.right) != (second.left, second.right) or \
+                routine_for(first) != "div" or routine_for(second) != "div":
+            return None
+        target = commands[k].target
+        if type(target) is not Name or type(target.symbol) is not Variable or \
+                type(commands[k + 1].target) is Name and commands[k + 1].target.symbol is target.symbol:
+            return None
+        for value in (first.left, first.right):
+            if type(value) is Load and (value.target.symbol is target.symbol or type(value.target) is Element and
+                                        type(value.target.index) is Name and value.target.index.symbol is target.symbol):
+                return None
+        return commands[k + 1]
+
+    def perform_division_pair(self, first, second):
+        self.gen_division(first.expr.left, first.expr.right, ranges=self.procedure.ranges.get(first.expr, (TOP, TOP)))
+        for command in (first, second):
+            self.emit(GET, "d" if command.expr.op == "div" else "e")
+            self.store_accumulator(command.target)
 
     def perform_if(self, condition, commands):
         cond = self.simplify_condition(condition)
@@ -92,13 +313,10 @@ class CodeGenerator:
             if cond:
                 self.gen_code_from_commands(commands)
         else:
-            cond_start = self.get_current_line()
-            self.check_condition(condition)
-            command_start = self.get_current_line()
+            command_end = self.new_label()
+            self.check_condition(condition, command_end)
             self.gen_code_from_commands(commands)
-            command_end = self.get_current_line()
-            for i in range(cond_start - self.first_line, command_start - self.first_line):
-                self.code[i] = self.code[i].replace('finish', str(command_end))
+            self.label(command_end)
 
     def perform_if_else(self, condition, commands_if, commands_else):
         cond = self.simplify_condition(condition)
@@ -108,110 +326,165 @@ class CodeGenerator:
             else:
                 self.gen_code_from_commands(commands_else)
         else:
-            cond_start = self.get_current_line()
-            local_cond_start = cond_start - self.first_line
-            self.check_condition(condition)
-            if_start = self.get_current_line()
-            local_if_start = if_start - self.first_line
+            else_start, command_end = self.new_label(), self.new_label()
+            self.check_condition(condition, else_start)
             self.gen_code_from_commands(commands_if)
-            self.code.append(f"JUMP finish")
-            else_start = self.get_current_line()
-            local_else_start = else_start - self.first_line
+            self.emit(JUMP, command_end)
+            self.label(else_start)
             self.gen_code_from_commands(commands_else)
-            command_end = self.get_current_line()
-            self.code[local_else_start - 1] = self.code[local_else_start - 1].replace('finish', str(command_end))
-            for i in range(local_cond_start, local_if_start):
-                self.code[i] = self.code[i].replace('finish', str(else_start))
+            self.label(command_end)
 
     def perform_while(self, condition, commands):
         cond = self.simplify_condition(condition)
         if isinstance(cond, bool):
             if cond:
-                loop_start = self.get_current_line()
-                self.loop_depth += 1
-                self.gen_code_from_commands(commands)
-                self.loop_depth -= 1
-                self.code.append(f"JUMP {loop_start}")
+                promoted = self.promote_loop_variables(condition, commands, lambda: self.gen_loop_body(commands))
+                loop_start = self.label()
+                self.gen_loop_body(commands)
+                self.emit(JUMP, loop_start)
+                self.release_loop_variables(promoted)
         else:
-            cond_start = self.get_current_line()
-            local_cond_start = cond_start - self.first_line
-            self.check_condition(condition)
-            loop_start = self.get_current_line()
-            local_loop_start = loop_start - self.first_line
-            self.loop_depth += 1
-            self.gen_code_from_commands(commands)
-            self.loop_depth -= 1
-            self.code.append(f"JUMP {cond_start}")
-            loop_end = self.get_current_line()
-            for i in range(local_cond_start, local_loop_start):
-                self.code[i] = self.code[i].replace('finish', str(loop_end))
+            # rotated: the condition guards the entry and is tested again
+            # at the bottom, so the back edge is the conditional jump itself
+            promoted = self.promote_loop_variables(condition, commands, lambda: self.gen_loop_test(condition, commands))
+            loop_end = self.new_label()
+            self.check_condition(condition, loop_end)
+            loop_start = self.label()
+            self.gen_loop_body(commands)
+            self.check_condition(Condition(INVERSE[condition.op], condition.left, condition.right), loop_start)
+            self.label(loop_end)
+            self.release_loop_variables(promoted)
 
     def perform_until(self, condition, commands):
-        loop_start = self.get_current_line()
+        promoted = self.promote_loop_variables(condition, commands, lambda: self.gen_loop_test(condition, commands))
+        loop_start = self.label()
+        self.gen_loop_body(commands)
+        self.check_condition(condition, loop_start)
+        self.release_loop_variables(promoted)
+
+    def gen_loop_body(self, commands):
         self.loop_depth += 1
         self.gen_code_from_commands(commands)
         self.loop_depth -= 1
-        cond_start = self.get_current_line()
-        local_cond_start = cond_start - self.first_line
-        self.check_condition(condition)
-        cond_end = self.get_current_line()
-        local_cond_end = cond_end - self.first_line
-        for i in range(local_cond_start, local_cond_end):
-            self.code[i] = self.code[i].replace('finish', str(loop_start))
-
-    def perform_procedure(self, procedure_call, address_reg="e"):
-        procedure_name = procedure_call[0]
-        procedure_vars = procedure_call[1]
-        if procedure_name not in self.procedure_table:
-            raise Exception(f"Undeclared procedure {procedure_name}")
-        procedure = self.procedure_table[procedure_name]
+
+    def gen_loop_test(self, condition, commands):
+        self.check_condition(condition, self.new_label())
+        self.gen_loop_body(commands)
+
+    def promote_loop_variables(self, condition, commands, gen_loop):
+        if self.trial:
+            return {}
+        allocator = LoopRegisterAllocator(self.procedure, self.promoted)
+        allocator.scan_loop(condition, commands)
+        if not allocator.weights:
+            return {}
+        used = self.registers_used(gen_loop) | set(self.promoted.values())
+        promoted = allocator.choose(used)
+        for name, reg in promoted.items():
+            self.gen_const(self.procedure.get_address(name), 'a')
+            self.emit(LOAD, 'a')
+            self.emit(PUT, reg)
+        self.promoted.update(promoted)
+        self.promoted_written |= allocator.written & promoted.keys()
+        return promoted
+
+    def release_loop_variables(self, promoted):
+        for name, reg in promoted.items():
+            if name in self.promoted_written:
+                self.store_promoted(name, reg)
+                self.promoted_written.discard(name)
+            del self.promoted[name]
+
+    def store_promoted(self, name, reg):
+        self.emit(GET, reg)
+        self.gen_const(self.procedure.get_address(name), reg)
+        self.emit(STORE, reg)
+
+    def registers_used(self, gen_code):
+        start, planned, known = len(self.code), self.planned, dict(self.planner.values)
+        flags = [(var, dict(vars(var))) for var in list(self.symbols.values()) + list(self.links.values())]
+        routines = set(self.used_routines)
+        self.trial += 1
+        try:
+            gen_code()
+        finally:
+            self.trial -= 1
+        used = set()
+        for instruction in self.code[start:]:
+            if instruction.op in REGISTER_OPS:
+                used.add(REGISTERS[instruction.arg])
+            elif instruction.op == JUMP and instruction.arg in ("MUL", "DIV"):
+                used |= self.routine_registers(instruction.arg.lower())
+        del self.code[start:]
+        self.planned, self.planner.values = planned, known
+        for var, state in flags:
+            vars(var).update(state)
+        self.used_routines = routines
+        return used
+
+    def routine_registers(self, kind):
+        used = {self.reg_return}
+        for instruction in self.routine_body(kind):
+            if instruction.op in REGISTER_OPS:
+                used.add(REGISTERS[instruction.arg])
+        return used
+
+    def perform_procedure(self, call, address_reg="e"):
+        procedure = call.procedure
         procedure_offset = procedure.memory_offset
 
-        if len(procedure_vars) != len(procedure.links):
-            raise Exception(f"Procedure takes {len(procedure.links)} arguments, you give {len(procedure_vars)}")
+        if len(call.args) != len(procedure.links):
+            raise Exception(f"Procedure takes {len(procedure.links)} arguments, you give {len(call.args)}")
         
         current_offset = procedure_offset + 1
 
-        for var in procedure_vars:
+        for name in self.promoted_written:
+            self.store_promoted(name, self.promoted[name])
+
+        for arg in call.args:
             self.gen_const(value=current_offset, reg='a')
-            self.code.append(f"PUT {address_reg}")
+            self.emit(PUT, address_reg)
+            self.load_address(arg, out_reg='a')
 
-            if var[0] == "load":
-                self.load_address(var[1], out_reg='a')
-                
-                name, link = procedure.get_link_by_offset(current_offset)
-                link_type = 'Array' if type(link) is Link_T else 'Var'
-                if var[1] in self.symbols:
-                    var_type = 'Array' if type(self.symbols[var[1]]) is Array else 'Var'
-                elif var[1] in self.links:
-                    var_type = 'Array' if type(self.links[var[1]]) is Link_T else 'Var'
-                else:
-                    raise Exception(f"Undeclared variable {var[1]}")
+            name, link = procedure.get_link_by_offset(current_offset)
+            link_type = 'Array' if type(link) is Link_T else 'Var'
+            var_type = 'Array' if type(arg.symbol) in (Array, Link_T) else 'Var'
+            if link_type != var_type:
+                raise Exception(f"Using wrong type of variable in arguments, call {call.name}")
 
-                if link_type != var_type:
-                    raise Exception(f"Using wrong type of variable in arguments, call {procedure_name}")
+            if link_type == 'Var' and link.initialized:
+                arg.symbol.initialized = link.initialized
 
-                if link_type == 'Var' and link.initialized:
-                    if var[1] in self.symbols:
-                        self.symbols[var[1]].initialized = link.initialized
-                    elif var[1] in self.links:
-                        self.links[var[1]].initialized = link.initialized
-            else:
-                Exception("PROCEDURE CALL ERROR")
-            
-            self.code.append(f"STORE {address_reg}")
+            self.emit(STORE, address_reg)
 
             current_offset += 1
         
+        for symbol in procedure.assigned:
+            symbol.initialized = True
+
         self.gen_const(4, 'b')
         self.gen_const(procedure_offset, 'a')
-        self.code.append(f"PUT {address_reg}")
-        self.code.append("STRK a")
-        self.code.append("ADD b")
-        self.code.append(f"STORE {address_reg}")
+        self.emit(PUT, address_reg)
+        self.emit(STRK, 'a')
+        self.emit(ADD, 'b')
+        self.emit(STORE, address_reg)
+
+        self.emit(JUMP, call.name)
 
-        self.code.append(f"JUMP {procedure.first_line}")
+        for name, reg in self.promoted.items():
+            self.gen_const(self.procedure.get_address(name), 'a')
+            self.emit(LOAD, 'a')
+            self.emit(PUT, reg)
                 
+    def perform_inline(self, inline):
+        saved = self.unchecked, self.inlined, self.source
+        call = inline.call
+        self.unchecked = self.unchecked | frozenset(arg.symbol for arg in call.args if type(arg.symbol) is Variable)
+        self.inlined = self.inlined + ((self.source, inline.lineno),)
+        self.source = call.name
+        self.gen_code_from_commands(inline.commands)
+        self.unchecked, self.inlined, self.source = saved
+
     # END commands 
 
     # START WORK WITH MEMORY
@@ -219,42 +492,34 @@ class CodeGenerator:
         if not out_reg:
             out_reg = self.reg_address
         
-        if type(target) is tuple:
-            if target[0] == "undeclared":
-                raise Exception(f"Undeclared variable {target[0]}")
-            elif target[0] == "array":
-                self.load_from_array_memory(target[1], target[2], out_reg)
-            elif target[0] == "link_t":
-                self.load_link_T_address(target[1], target[2], out_reg)
+        if type(target) is Element:
+            if target.is_link():
+                self.load_link_T_address(target.name, target.index, out_reg)
             else:
-                raise Exception("LOAD ADDRESS ERROR")
+                self.load_from_array_memory(target.name, target.index, out_reg)
         else:
-            if target in self.links:
-                if type(self.links[target]) is Link:
-                    self.load_link_address(target, out_reg)
-                    self.links[target].isUsed = True
-                    if isInit:
-                        self.links[target].initialized = True
-                elif type(self.links[target]) is Link_T:
-                    self.load_link_T_address(target, 0, out_reg)
-            elif target in self.symbols:
-                if type(self.symbols[target]) is Variable:
-                    address = self.procedure.get_address(target)
-                    self.gen_const(address, out_reg)
-                    if isInit:
-                        self.symbols[target].initialized = True
-                elif type(self.symbols[target]) is Array:
-                    self.load_from_array_memory(target, 0, out_reg)
-            else:
-                raise Exception(f"Array {target} doesn't have index")
+            symbol = target.symbol
+            if type(symbol) is Link:
+                self.load_link_address(target.name, out_reg)
+                symbol.isUsed = True
+                if isInit:
+                    symbol.initialized = True
+            elif type(symbol) is Link_T:
+                self.load_link_T_address(target.name, 0, out_reg)
+            elif type(symbol) is Variable:
+                self.gen_const(symbol.memory_offset, out_reg)
+                if isInit:
+                    symbol.initialized = True
+            elif type(symbol) is Array:
+                self.load_from_array_memory(target.name, 0, out_reg)
 
     def load_link_T(self, array_name, index, reg=''):
         if not reg:
             reg = self.reg_value
         self.load_link_T_address(array_name, index, reg)
-        self.code.append(f"LOAD {reg}")
+        self.emit(LOAD, reg)
         if reg != 'a':
-            self.code.append(f"PUT {reg}")
+            self.emit(PUT, reg)
                     
     def load_link_T_address(self, array_name, index, out_reg='', reg_f='f'):
         if not out_reg:
@@ -262,209 +527,217 @@ class CodeGenerator:
         if type(index) is int:
             address, index = self.procedure.get_address((array_name, index))
             self.gen_const(address, 'a')
-            self.code.append("LOAD a")
+            self.emit(LOAD, 'a')
             self.gen_const(index, reg_f)
-            self.code.append(f"ADD {reg_f}")
+            self.emit(ADD, reg_f)
             if out_reg != 'a':
-                self.code.append(f"PUT {out_reg}")
+                self.emit(PUT, out_reg)
             return
-        elif type(index) != tuple:
+        elif type(index) is not Name:
             raise Exception("LINK_T LOAD ERROR")
         
-        if index[1] in self.symbols and type(self.symbols[index[1]]) is Variable:
-            if not self.symbols[index[1]].initialized:
-                raise Exception(f"Trying to use unitialized variable {index[1]} as index")
-            self.load_variable(index[1], out_reg=reg_f)
+        if type(index.symbol) is Variable:
+            if not index.symbol.initialized and index.symbol not in self.unchecked:
+                raise Exception(f"Trying to use unitialized variable {index.name} as index")
+            self.load_variable(index, out_reg=reg_f)
             var = self.procedure.get_variable(array_name)
             self.gen_const(var.memory_offset, 'a')
-            self.code.append(f"LOAD a")
-            self.code.append(f"ADD {reg_f}")
+            self.emit(LOAD, 'a')
+            self.emit(ADD, reg_f)
 
-        elif index[1] in self.links and type(self.links[index[1]]) is Link:
-            self.load_link(index[1], out_reg=reg_f)
+        elif type(index.symbol) is Link:
+            self.load_link(index.name, out_reg=reg_f)
             var = self.procedure.get_variable(array_name)
             self.gen_const(var.memory_offset, 'a')
-            self.code.append(f"LOAD a")
-            self.code.append(f"ADD {reg_f}")
+            self.emit(LOAD, 'a')
+            self.emit(ADD, reg_f)
 
         if out_reg != 'a':
-            self.code.append(f"PUT {out_reg}")
+            self.emit(PUT, out_reg)
 
     def load_variable(self, variable, out_reg):
-        if type(variable) is tuple:
-            if variable[0] == "undeclared":
-                raise Exception(f"Undeclared variable {variable[1]}")
-            elif variable[0] == "array":
-                self.load_array_at(variable[1], variable[2], out_reg)
-            elif variable[0] == "link_t":
-                self.load_link_T(variable[1], variable[2], out_reg)
+        if type(variable) is Element:
+            if variable.is_link():
+                self.load_link_T(variable.name, variable.index, out_reg)
             else:
-                raise Exception("LOAD VARIABLE ERROR")
+                self.load_array_at(variable.name, variable.index, out_reg)
         else:
-            if variable in self.links and type(self.links[variable]) is Link:
-                self.load_link(variable, out_reg)
-                self.links[variable].isUsed = True
-            elif variable in self.symbols and type(self.symbols[variable]) is Variable:
-                var = self.procedure.get_variable(variable)
-                if not var.initialized:
+            if type(variable.symbol) is Link:
+                self.load_link(variable.name, out_reg)
+                variable.symbol.isUsed = True
+            elif type(variable.symbol) is Variable:
+                if not variable.symbol.initialized and variable.symbol not in self.unchecked:
                     if self.loop_depth == 0:
-                        raise Exception(f"Uninitialized variable {variable}")
-                    else:
-                        print(f"WARNING: variable {variable} may be used before set")               
-                self.load_from_memory(var.memory_offset, out_reg)
+                        raise Exception(f"Uninitialized variable {variable.name}")
+                    elif not self.trial:
+                        self.warnings.append(f"WARNING: variable {variable.name} may be used before set")
+                self.load_scalar(variable.name, out_reg)
+
+    def load_scalar(self, name, out_reg):
+        if name in self.promoted:
+            self.emit(GET, self.promoted[name])
+            if out_reg and out_reg != 'a':
+                self.emit(PUT, out_reg)
+        else:
+            self.load_from_memory(self.procedure.get_address(name), out_reg)
 
     def load_link(self, name, out_reg=''):
         if not out_reg:
             out_reg = self.reg_value
         address = self.procedure.get_address(name)
         self.gen_const(address, out_reg)
-        self.code.append(f"LOAD {out_reg}")
-        self.code.append("LOAD a")
+        self.emit(LOAD, out_reg)
+        self.emit(LOAD, 'a')
         if out_reg != 'a':
-            self.code.append(f"PUT {out_reg}")
+            self.emit(PUT, out_reg)
 
     def load_link_address(self, name, out_reg=''):
         if not out_reg:
             out_reg = self.reg_value
         address = self.procedure.get_address(name)
         self.gen_const(address, out_reg)
-        self.code.append(f"LOAD {out_reg}")
+        self.emit(LOAD, out_reg)
         if out_reg != 'a':
-            self.code.append(f"PUT {out_reg}")
+            self.emit(PUT, out_reg)
 
     def load_from_memory(self, address, out_reg=""):
         self.gen_const(address, self.reg_address)
-        self.code.append(f"LOAD {self.reg_address}")
+        self.emit(LOAD, self.reg_address)
         if out_reg:
-            self.code.append(f"PUT {out_reg}")
+            self.emit(PUT, out_reg)
     
     def load_array_at(self, array_name, index, reg=""):
         if not reg:
             reg = self.reg_value
         self.load_from_array_memory(array_name, index, reg)
-        self.code.append(f"LOAD {reg}")
+        self.emit(LOAD, reg)
         if reg != 'a':
-            self.code.append(f'PUT {reg}')
+            self.emit(PUT, reg)
 
     def load_from_array_memory(self, array_name, index, target_reg, reg2='f'):
         if type(index) is int:
             address = self.procedure.get_address((array_name, index))
             self.gen_const(address, target_reg)
-        elif type(index) is tuple:
-            if index[1] in self.symbols and type(self.symbols[index[1]]) is Variable:
-                if not self.symbols[index[1]].initialized:
-                    raise Exception(f"Trying to use {array_name}[{index[1]}] where variable {index[1]} is uninitialized")
-                self.load_from_memory(self.procedure.get_address(index[1]), reg2)
+        elif type(index) is Name:
+            if type(index.symbol) is Variable:
+                if not index.symbol.initialized and index.symbol not in self.unchecked:
+                    raise Exception(f"Trying to use {array_name}[{index.name}] where variable {index.name} is uninitialized")
                 arr = self.procedure.get_variable(array_name)
-                self.gen_const(arr.memory_offset, 'a')
-                self.code.append(f"ADD {reg2}")
-            elif index[1] in self.links and type(self.links[index[1]]) is Link:
-                self.load_link(index[1], reg2)
+                if arr.memory_offset:
+                    self.load_scalar(index.name, reg2)
+                    self.gen_const(arr.memory_offset, 'a')
+                    self.emit(ADD, reg2)
+                else:
+                    # the index is the address itself
+                    self.load_scalar(index.name, "")
+            elif type(index.symbol) is Link:
+                self.load_link(index.name, reg2)
                 arr = self.procedure.get_variable(array_name)
                 self.gen_const(arr.memory_offset, 'a')
-                self.code.append(f"ADD {reg2}")
+                self.emit(ADD, reg2)
             if target_reg != 'a':
-                self.code.append(f"PUT {target_reg}")
+                self.emit(PUT, target_reg)
 
     def gen_const(self, value, reg):
-        self.code.append(f"RST {reg}")
-        bits = bin(value)[2:]
-        for bit in bits[:-1]:
-            if bit == '1':
-                self.code.append(f"INC {reg}")
-            self.code.append(f"SHL {reg}")
-        if bits[-1] == '1':
-            self.code.append(f"INC {reg}")
+        self.sync_planner()
+        self.code += self.planner.plan(value, REGISTER_INDEX[reg])
+
+    def sync_planner(self):
+        for instruction in self.code[self.planned:]:
+            self.planner.observe(instruction)
+        self.planned = len(self.code)
 
     # END WORK WITH MEMORY
 
     def calculate_expression(self, expr, first='a', second='b'):
-        match expr[0]:
-            case "const":
-                self.gen_const(expr[1], self.reg_value)
-                self.code.append(f"GET {self.reg_value}")
-                if first != 'a':
-                    self.code.append(f"PUT {first}")
-            case "load":
-                self.load_variable(expr[1], first)
+        if type(expr) is Const:
+            self.gen_const(expr.value, first)
+            return
+        if type(expr) is Load:
+            self.load_variable(expr.target, first)
+            return
+        expr1, expr2 = expr.left, expr.right
+        match expr.op:
             case "add":
                 const = False
-                if expr[1][0] == 'const' and expr[2][0] != 'const':
-                    expr = (expr[0], expr[2], expr[1])
+                if type(expr1) is Const and type(expr2) is not Const:
+                    expr1, expr2 = expr2, expr1
                     const = True
-                elif expr[2][0] == 'const':
+                elif type(expr2) is Const:
                     const = True
-                self.adding_case(expr1=expr[1], expr2=expr[2], const=const, buf_reg=second)
+                self.adding_case(expr1=expr1, expr2=expr2, const=const, buf_reg=second)
                 if first != 'a':
-                    self.code.append(f"PUT {first}")
+                    self.emit(PUT, first)
             case "sub":
-                self.subtraction_case(expr1=expr[1], expr2=expr[2], buf_reg=second)
+                self.subtraction_case(expr1=expr1, expr2=expr2, buf_reg=second)
                 if first != 'a':
-                    self.code.append(f"PUT {first}")
+                    self.emit(PUT, first)
             case "mul":
                 const = False
-                if expr[1][0] == 'const' and expr[2][0] != 'const':
-                    expr = (expr[0], expr[2], expr[1])
+                ranges = self.procedure.ranges.get(expr, (TOP, TOP))
+                if type(expr1) is Const and type(expr2) is not Const:
+                    expr1, expr2 = expr2, expr1
+                    ranges = ranges[::-1]
                     const = True
-                elif expr[2][0] == 'const':
+                elif type(expr2) is Const:
                     const = True
-                self.multiplication_case(expr1=expr[1], expr2=expr[2], const=const)
+                self.multiplication_case(expr1=expr1, expr2=expr2, const=const, ranges=ranges)
                 if first != 'a':
-                    self.code.append(f"PUT {first}")
+                    self.emit(PUT, first)
             case "div":
-                self.division_case(expr1=expr[1], expr2=expr[2])
+                self.division_case(expr1=expr1, expr2=expr2, ranges=self.procedure.ranges.get(expr, (TOP, TOP)))
                 if first != 'a':
-                    self.code.append(f"PUT {first}")
+                    self.emit(PUT, first)
             case "mod":
-                self.mod_case(expr1=expr[1], expr2=expr[2])
+                self.mod_case(expr1=expr1, expr2=expr2, ranges=self.procedure.ranges.get(expr, (TOP, TOP)))
 
     def adding_case(self, expr1, expr2, const, buf_reg):
-        if expr1[0] == expr2[0] == 'const':
-            self.gen_const(expr1[1] + expr2[2], 'a')
+        if type(expr1) is Const and type(expr2) is Const:
+            self.gen_const(expr1.value + expr2.value, 'a')
         elif expr1 == expr2:
             self.calculate_expression(expr1)
-            self.code.append("SHL a")
-        elif const:
+            self.emit(SHL, 'a')
+        elif const and expr2.value < 12:
             self.calculate_expression(expr1)
-            change = f"INC a"
-            self.code += expr2[1] * [change]
+            for _ in range(expr2.value):
+                self.emit(INC, 'a')
         else:
             self.calculate_expression(expr2, buf_reg)
             self.calculate_expression(expr1)
-            self.code.append(f"ADD {buf_reg}")
+            self.emit(ADD, buf_reg)
 
     def subtraction_case(self, expr1, expr2, buf_reg):
-        if expr1[0] == expr2[0] == 'const':
-            val = max(0, expr1[1] - expr2[1])
+        if type(expr1) is Const and type(expr2) is Const:
+            val = max(0, expr1.value - expr2.value)
             if val:
                 self.gen_const(val, 'a')
             else:
-                self.code.append("RST a")
-        elif expr1[0] == "const" or expr2[0] == "const":
-            if expr2[0] == "const":
-                if expr2[1] < 12:
+                self.emit(RST, 'a')
+        elif type(expr1) is Const or type(expr2) is Const:
+            if type(expr2) is Const:
+                if expr2.value < 12:
                     self.calculate_expression(expr1)
-                    change = "DEC a"
-                    self.code += expr2[1] * [change]
+                    for _ in range(expr2.value):
+                        self.emit(DEC, 'a')
                     return
-            elif expr1[0] == "const":
-                if expr1[1] == 0:
-                    self.code.append("RST a")
+            elif type(expr1) is Const:
+                if expr1.value == 0:
+                    self.emit(RST, 'a')
                     return
 
         self.calculate_expression(expr1, buf_reg)
         self.calculate_expression(expr2, "c")
-        self.code.append(f"GET {buf_reg}")
-        self.code.append("SUB c")
+        self.emit(GET, buf_reg)
+        self.emit(SUB, 'c')
 
-    def multiplication_case(self, expr1, expr2, const, second_reg="b", third_reg="c", temp_res_reg="d"):
-        if expr1[0] == expr2[0] == "const":
-            self.calculate_expression(expr1[1] * expr2[1])
+    def multiplication_case(self, expr1, expr2, const, ranges=(TOP, TOP), second_reg="b", third_reg="c", temp_res_reg="d"):
+        if type(expr1) is Const and type(expr2) is Const:
+            self.gen_const(expr1.value * expr2.value, 'a')
             return
         if const:
-            val = expr2[1]
+            val = expr2.value
             if val == 0:
-                self.code.append("RESET a")
+                self.emit(RST, 'a')
                 return
             elif val == 1:
                 self.calculate_expression(expr1)
@@ -472,83 +745,128 @@ class CodeGenerator:
             elif val & (val - 1) == 0:
                 self.calculate_expression(expr1)
                 while val > 1:
-                    self.code.append(f"SHL a")
+                    self.emit(SHL, 'a')
                     val /= 2
                 return
+            self.calculate_expression(expr1)
+            self.gen_constant_multiplication(val, second_reg)
+            return
         if expr1 == expr2:
             self.calculate_expression(expr1)
-            self.code.append(f"PUT {second_reg}")
-            self.code.append(f"PUT {third_reg}")
+            self.emit(PUT, second_reg)
+            self.emit(PUT, third_reg)
         else:
             self.calculate_expression(expr2, third_reg)
             self.calculate_expression(expr1, second_reg)
 
-        first_line = self.get_current_line() - 1
-        self.code.append(f"RST {temp_res_reg}") 
-        self.code.append(f"GET {third_reg}")
-        self.code.append(f"SUB {second_reg}")
-        self.code.append(f"JPOS {first_line + 21}")
-        self.code.append(f"JUMP {first_line + 8}")
-
-        self.code.append(f"SHL {second_reg}")  
-        self.code.append(f"SHR {third_reg}")
-
-        self.code.append(f"GET {third_reg}")  
-        self.code.append(f"JZERO {first_line + 32}")  
-        self.code.append(f"SHR {third_reg}")
-        self.code.append(f"SHL {third_reg}")
-        self.code.append(f"SUB {third_reg}")
-        self.code.append(f"JPOS {first_line + 15}")
-        self.code.append(f"JUMP {first_line + 6}")
-
-        self.code.append(f"GET {temp_res_reg}")  
-        self.code.append(f"ADD {second_reg}")
-        self.code.append(f"PUT {temp_res_reg}")
-        self.code.append(f"JUMP {first_line + 6}")
-
-        self.code.append(f"SHL {third_reg}")  
-        self.code.append(f"SHR {second_reg}")
-
-        self.code.append(f"GET {second_reg}")  
-        self.code.append(f"JZERO {first_line + 32}") 
-        self.code.append(f"SHR {second_reg}")
-        self.code.append(f"SHL {second_reg}")
-        self.code.append(f"SUB {second_reg}")
-        self.code.append(f"JPOS {first_line + 28}")
-        self.code.append(f"JUMP {first_line + 19}")
-
-        self.code.append(f"GET {temp_res_reg}")  
-        self.code.append(f"ADD {third_reg}")
-        self.code.append(f"PUT {temp_res_reg}")
-        self.code.append(f"JUMP {first_line + 19}") 
-
-        self.code.append(f"GET d") 
+        if self.use_routine("mul"):
+            self.call_routine("mul")
+        else:
+            # the loop runs over the bits of the smaller operand; when the
+            # ranges tell which one that is, it is not compared first
+            (low1, high1), (low2, high2) = ranges
+            smaller = None
+            if high1 is not None and high1 <= low2:
+                smaller = second_reg
+            elif high2 is not None and high2 <= low1:
+                smaller = third_reg
+            self.gen_multiplication_loop(second_reg, third_reg, temp_res_reg, smaller)
+        self.emit(GET, temp_res_reg)
+
+    def gen_constant_multiplication(self, value, reg="b"):
+        # a holds x; every prefix of the digits is positive, so subtracting
+        # never stops at 0
+        self.emit(PUT, reg)
+        for digit in multiplication_digits(value)[1:]:
+            self.emit(SHL, 'a')
+            if digit == 1:
+                self.emit(ADD, reg)
+            elif digit == -1:
+                self.emit(SUB, reg)
+
+    def gen_multiplication_loop(self, second_reg="b", third_reg="c", temp_res_reg="d", smaller=None):
+        double_second, test_third, add_second = self.new_label(), self.new_label(), self.new_label()
+        double_third, test_second, add_third = self.new_label(), self.new_label(), self.new_label()
+        end = self.new_label()
+        self.emit(RST, temp_res_reg) 
+        if smaller is None:
+            self.emit(GET, third_reg)
+            self.emit(SUB, second_reg)
+            self.emit(JPOS, test_second)
+        if smaller != second_reg:
+            self.emit(JUMP, test_third)
+        else:
+            self.emit(JUMP, test_second)
+
+        self.label(double_second)
+        self.emit(SHL, second_reg)  
+        self.emit(SHR, third_reg)
+
+        self.label(test_third)
+        self.emit(GET, third_reg)  
+        self.emit(JZERO, end)  
+        self.emit(SHR, third_reg)
+        self.emit(SHL, third_reg)
+        self.emit(SUB, third_reg)
+        self.emit(JPOS, add_second)
+        self.emit(JUMP, double_second)
+
+        self.label(add_second)
+        self.emit(GET, temp_res_reg)  
+        self.emit(ADD, second_reg)
+        self.emit(PUT, temp_res_reg)
+        self.emit(JUMP, double_second)
+
+        self.label(double_third)
+        self.emit(SHL, third_reg)  
+        self.emit(SHR, second_reg)
+
+        self.label(test_second)
+        self.emit(GET, second_reg)  
+        self.emit(JZERO, end) 
+        self.emit(SHR, second_reg)
+        self.emit(SHL, second_reg)
+        self.emit(SUB, second_reg)
+        self.emit(JPOS, add_third)
+        self.emit(JUMP, double_third)
+
+        self.label(add_third)
+        self.emit(GET, temp_res_reg)  
+        self.emit(ADD, third_reg)
+        self.emit(PUT, temp_res_reg)
+        self.emit(JUMP, double_third) 
+        self.label(end)
 
     def division_case(
             self, expr1, expr2,
             ismod = False,
+            ranges=(TOP, TOP),
             r_a='a',
-            dividend_reg="b",
-            divisor_reg="c",
             quotient_reg="d",
             remainder_reg="e",
     ):
         if not ismod:
-            if expr1[0] == expr2[0] == "const":
-                if expr2[1] > 0:
-                    self.gen_const(expr1[1] // expr2[1], r_a)
+            if type(expr1) is Const and type(expr2) is Const:
+                if expr2.value > 0:
+                    self.gen_const(expr1.value // expr2.value, r_a)
                 else:
-                    self.code.append(f"RST {r_a}")
+                    self.emit(RST, r_a)
+                return
             elif expr1 == expr2:
                 self.calculate_expression(expr1)
-                self.code.append(f"JZERO {self.get_current_line() + 2}")
-                self.code.append(f"INC {r_a}")
-            elif expr1[0] == "const" and expr1[1] == 0:
-                self.code.append(f"RST {r_a}")
-            elif expr2[0] == "const":
-                val = expr2[1]
+                zero = self.new_label()
+                self.emit(JZERO, zero)
+                self.emit(RST, r_a)
+                self.emit(INC, r_a)
+                self.label(zero)
+                return
+            elif type(expr1) is Const and expr1.value == 0:
+                self.emit(RST, r_a)
+                return
+            elif type(expr2) is Const:
+                val = expr2.value
                 if val == 0:
-                    self.code.append(f"RST {r_a}")
+                    self.emit(RST, r_a)
                     return
                 elif val == 1:
                     self.calculate_expression(expr1)
@@ -556,111 +874,196 @@ class CodeGenerator:
                 elif val & (val - 1) == 0:
                     self.calculate_expression(expr1)
                     while val > 1:
-                        self.code.append(f"SHR {r_a}")
+                        self.emit(SHR, r_a)
                         val /= 2
                     return
                 
-        self.calculate_expression(expr1, dividend_reg)
-        self.calculate_expression(expr2, divisor_reg)
-
-        first_line = self.get_current_line() - 1
-        self.code.append(f"RST {quotient_reg}")          
-        self.code.append(f"RST {remainder_reg}")
-        self.code.append(f"GET {divisor_reg}")
-        self.code.append(f"JZERO {first_line + 37}")     
-        self.code.append(f"GET {dividend_reg}")          
-        self.code.append(f"PUT {remainder_reg}")
-        self.code.append(f"GET {divisor_reg}")
-        self.code.append(f"PUT {dividend_reg}")
-        self.code.append(f"GET {remainder_reg}")
-        self.code.append(f"SUB {dividend_reg}")
-        self.code.append(f"JZERO {first_line + 19}")
-        self.code.append(f"GET {dividend_reg}")          
-        self.code.append(f"SUB {remainder_reg}")
-        self.code.append(f"JZERO {first_line + 17}")
-        self.code.append(f"SHR {dividend_reg}")
-        self.code.append(f"JUMP {first_line + 19}")
-        self.code.append(f"SHL {dividend_reg}")         
-        self.code.append(f"JUMP {first_line + 12}")
-
-        self.code.append(f"GET {dividend_reg}")         
-        self.code.append(f"SUB {remainder_reg}")
-        self.code.append(f"JZERO {first_line + 23}")
-        self.code.append(f"JUMP {first_line + 37}")    
-        self.code.append(f"GET {remainder_reg}")        
-        self.code.append(f"SUB {dividend_reg}")
-        self.code.append(f"PUT {remainder_reg}")
-        self.code.append(f"INC {quotient_reg}")
-
-        self.code.append(f"GET {dividend_reg}")         
-        self.code.append(f"SUB {remainder_reg}")
-        self.code.append(f"JZERO {first_line + 19}")
-        self.code.append(f"SHR {dividend_reg}")
-        self.code.append(f"GET {divisor_reg}")
-        self.code.append(f"SUB {dividend_reg}")
-        self.code.append(f"JZERO {first_line + 35}")
-        self.code.append(f"JUMP {first_line + 37}")
-        self.code.append(f"SHL {quotient_reg}")         
-        self.code.append(f"JUMP {first_line + 27}")
+        self.gen_division(expr1, expr2, quotient=not ismod, ranges=ranges)
         if ismod:
-            self.code.append(f"GET {remainder_reg}")
+            self.emit(GET, remainder_reg)
         else:
-            self.code.append(f"GET {quotient_reg}")
-
-    def mod_case(self, expr1, expr2):
+            self.emit(GET, quotient_reg)
+
+    def gen_division(self, expr1, expr2, quotient=True, ranges=(TOP, TOP)):
+        # leaves the quotient in d and the remainder in e
+        left, right = ranges
+        if type(expr1) is Const:
+            left = (expr1.value, expr1.value)
+        if type(expr2) is Const:
+            right = (expr2.value, expr2.value)
+        bits = None
+        if right[0] > 0 and left[1] is not None and (left[1] // right[0]).bit_length() <= UNROLLED_STEPS:
+            bits = max((left[1] // right[0]).bit_length(), 1)
+        if type(expr2) is Const or bits is not None:
+            self.gen_short_division(expr1, expr2, quotient, bits)
+            return
+        self.calculate_expression(expr1, "b")
+        self.calculate_expression(expr2, "c")
+        if self.use_routine("div"):
+            self.call_routine("div")
+        else:
+            self.gen_division_loop(check_zero=right[0] == 0)
+
+    def gen_short_division(self, expr1, expr2, quotient=True, bits=None):
+        # the divisor is shifted up until it passes the dividend with one
+        # test per bit, then the steps below that bit are run straight
+        # through. Without a bound on the quotient, dividends of
+        # divisor << UNROLLED_STEPS or more run the division loop
+        limit = UNROLLED_STEPS if bits is None else bits
+        steps = [self.new_label() for _ in range(limit)]
+        general, end = self.new_label(), self.new_label()
+        self.calculate_expression(expr1, "e")
+        if quotient:
+            self.emit(RST, "d")
+        self.calculate_expression(expr2, "c")
+        for step in range(limit + 1):
+            if step:
+                self.emit(SHL, "c")
+            if step == limit and bits is not None:
+                # the quotient is known to be below 1 << bits
+                break
+            self.emit(GET, "c")
+            self.emit(SUB, "e")
+            self.emit(JPOS, steps[step - 1] if step else end)
+        if bits is None:
+            self.emit(JUMP, general)
+        for step in reversed(range(limit)):
+            skip = self.new_label()
+            self.label(steps[step])
+            self.emit(SHR, "c")
+            if quotient:
+                self.emit(SHL, "d")
+            self.emit(GET, "c")
+            self.emit(SUB, "e")
+            self.emit(JPOS, skip)
+            self.emit(GET, "e")
+            self.emit(SUB, "c")
+            self.emit(PUT, "e")
+            if quotient:
+                self.emit(INC, "d")
+            self.label(skip)
+        if bits is None:
+            self.emit(JUMP, end)
+            self.label(general)
+            self.emit(GET, "e")
+            self.emit(PUT, "b")
+            self.calculate_expression(expr2, "c")
+            if self.use_routine("div"):
+                self.call_routine("div")
+            else:
+                self.gen_division_loop()
+        self.label(end)
+
+    def gen_division_loop(self, dividend_reg="b", divisor_reg="c", quotient_reg="d", remainder_reg="e", check_zero=True):
+        scale, shift_left, compare, subtract = self.new_label(), self.new_label(), self.new_label(), self.new_label()
+        step, next_bit, end = self.new_label(), self.new_label(), self.new_label()
+        self.emit(RST, quotient_reg)          
+        if check_zero:
+            self.emit(RST, remainder_reg)
+            self.emit(GET, divisor_reg)
+            self.emit(JZERO, end)     
+        self.emit(GET, dividend_reg)          
+        self.emit(PUT, remainder_reg)
+        self.emit(GET, divisor_reg)
+        self.emit(PUT, dividend_reg)
+        self.emit(GET, remainder_reg)
+        self.emit(SUB, dividend_reg)
+        self.emit(JZERO, compare)
+        self.label(scale)
+        self.emit(GET, dividend_reg)          
+        self.emit(SUB, remainder_reg)
+        self.emit(JZERO, shift_left)
+        self.emit(SHR, dividend_reg)
+        self.emit(JUMP, compare)
+        self.label(shift_left)
+        self.emit(SHL, dividend_reg)         
+        self.emit(JUMP, scale)
+
+        self.label(compare)
+        self.emit(GET, dividend_reg)         
+        self.emit(SUB, remainder_reg)
+        self.emit(JZERO, subtract)
+        self.emit(JUMP, end)    
+        self.label(subtract)
+        self.emit(GET, remainder_reg)        
+        self.emit(SUB, dividend_reg)
+        self.emit(PUT, remainder_reg)
+        self.emit(INC, quotient_reg)
+
+        self.label(step)
+        self.emit(GET, dividend_reg)         
+        self.emit(SUB, remainder_reg)
+        self.emit(JZERO, compare)
+        self.emit(SHR, dividend_reg)
+        self.emit(GET, divisor_reg)
+        self.emit(SUB, dividend_reg)
+        self.emit(JZERO, next_bit)
+        self.emit(JUMP, end)
+        self.label(next_bit)
+        self.emit(SHL, quotient_reg)         
+        self.emit(JUMP, step)
+        self.label(end)
+
+    def mod_case(self, expr1, expr2, ranges=(TOP, TOP)):
         if expr1 == expr2:
-            self.code.append("RST a")
+            self.emit(RST, 'a')
+            return
+        elif type(expr1) is Const and type(expr2) is Const:
+            self.gen_const(expr1.value % expr2.value if expr2.value else 0, 'a')
             return
-        elif expr1[0] == expr2[0] == "const":
-            self.calculate_expression(expr1[1] % expr2[1])
-        elif expr1[0] == "const" and expr1[1] == 0:
-            self.code.append("RST a")
+        elif type(expr1) is Const and expr1.value == 0:
+            self.emit(RST, 'a')
             return
-        elif expr2[0] == "const":
-            val = expr2[1]
+        elif type(expr2) is Const:
+            val = expr2.value
             if val < 2:
-               self.code.append("RST a")
-            elif val == 2:
-                self.calculate_expression(expr1) 
-                self.code.append("PUT b")
-                self.code.append("SHR b")
-                self.code.append("SHL b")
-                self.code.append("SUB b")
-        self.division_case(expr1=expr1, expr2=expr2, ismod=True)
+               self.emit(RST, 'a')
+               return
+            elif val & (val - 1) == 0:
+                # x - (x >> k << k)
+                self.calculate_expression(expr1)
+                self.emit(PUT, 'b')
+                for _ in range(val.bit_length() - 1):
+                    self.emit(SHR, 'b')
+                for _ in range(val.bit_length() - 1):
+                    self.emit(SHL, 'b')
+                self.emit(SUB, 'b')
+                return
+        self.division_case(expr1=expr1, expr2=expr2, ismod=True, ranges=ranges)
 
     def simplify_condition(self, condition):
-        if condition[1][0] == "const" and condition[2][0] == "const":
-            if condition[0] == "le":
-                return condition[1][1] <= condition[2][1]
-            elif condition[0] == "ge":
-                return condition[1][1] >= condition[2][1]
-            elif condition[0] == "lt":
-                return condition[1][1] < condition[2][1]
-            elif condition[0] == "gt":
-                return condition[1][1] > condition[2][1]
-            elif condition[0] == "eq":
-                return condition[1][1] == condition[2][1]
-            elif condition[0] == "ne":
-                return condition[1][1] != condition[2][1]
-
-        elif condition[1][0] == "const" and condition[1][1] == 0:
-            if condition[0] == "le":
+        if type(condition.left) is Const and type(condition.right) is Const:
+            if condition.op == "le":
+                return condition.left.value <= condition.right.value
+            elif condition.op == "ge":
+                return condition.left.value >= condition.right.value
+            elif condition.op == "lt":
+                return condition.left.value < condition.right.value
+            elif condition.op == "gt":
+                return condition.left.value > condition.right.value
+            elif condition.op == "eq":
+                return condition.left.value == condition.right.value
+            elif condition.op == "ne":
+                return condition.left.value != condition.right.value
+
+        elif type(condition.left) is Const and condition.left.value == 0:
+            if condition.op == "le":
                 return True
-            elif condition[0] == "gt":
+            elif condition.op == "gt":
                 return False
             else:
                 return condition
 
-        elif condition[2][0] == "const" and condition[2][1] == 0:
-            if condition[0] == "ge":
+        elif type(condition.right) is Const and condition.right.value == 0:
+            if condition.op == "ge":
                 return True
-            elif condition[0] == "lt":
+            elif condition.op == "lt":
                 return False
             else:
                 return condition
 
-        elif condition[1] == condition[2]:
-            if condition[0] in ["ge", "le", "eq"]:
+        elif condition.left == condition.right:
+            if condition.op in ["ge", "le", "eq"]:
                 return True
             else:
                 return False
@@ -668,68 +1071,69 @@ class CodeGenerator:
         else:
             return condition
 
-    def check_condition(self, condition, first_reg='a', second_reg='b', third_reg='c'):
-        if condition[1][0] == "const" and condition[1][1] == 0:
-            if condition[0] == "ge" or condition[0] == "eq":
-                self.calculate_expression(condition[2])
-                self.code.append(f"JZERO {self.get_current_line() + 2}") 
-                self.code.append("JUMP finish")
-
-            elif condition[0] == "lt" or condition[0] == "ne":
-                self.calculate_expression(condition[2])
-                self.code.append(f"JZERO finish")
-
-        elif condition[2][0] == "const" and condition[2][1] == 0:
-            if condition[0] == "le" or condition[0] == "eq":
-                self.calculate_expression(condition[1])
-                self.code.append(f"JZERO {self.get_current_line() + 2}")  
-                self.code.append("JUMP finish")
-
-            elif condition[0] == "gt" or condition[0] == "ne":
-                self.calculate_expression(condition[1])
-                self.code.append(f"JZERO finish")
+    def check_condition(self, condition, false_label, first_reg='a', second_reg='b', third_reg='c'):
+        if type(condition.left) is Const and condition.left.value == 0:
+            if condition.op == "ge" or condition.op == "eq":
+                self.calculate_expression(condition.right)
+                self.jump_unless_zero(false_label)
+
+            elif condition.op == "lt" or condition.op == "ne":
+                self.calculate_expression(condition.right)
+                self.emit(JZERO, false_label)
+
+        elif type(condition.right) is Const and condition.right.value == 0:
+            if condition.op == "le" or condition.op == "eq":
+                self.calculate_expression(condition.left)
+                self.jump_unless_zero(false_label)
+
+            elif condition.op == "gt" or condition.op == "ne":
+                self.calculate_expression(condition.left)
+                self.emit(JZERO, false_label)
         else:
-            self.calculate_expression(condition[1], second_reg)
-            self.calculate_expression(condition[2], third_reg)
-
-            if condition[0] == "le":
-                self.code.append(f"GET {second_reg}")
-                self.code.append(f"SUB {third_reg}")
-                self.code.append(f"JZERO {self.get_current_line() + 2}") 
-                self.code.append(f"JUMP finish")
-
-            elif condition[0] == "ge":
-                self.code.append(f"GET {third_reg}")
-                self.code.append(f"SUB {second_reg}")
-                self.code.append(f"JZERO {self.get_current_line() + 2}")  
-                self.code.append(f"JUMP finish")
-
-            elif condition[0] == "lt":
-                self.code.append(f"GET {third_reg}")
-                self.code.append(f"SUB {second_reg}")
-                self.code.append(f"JZERO finish")
-
-            elif condition[0] == "gt":
-                self.code.append(f"GET {second_reg}")
-                self.code.append(f"SUB {third_reg}")
-                self.code.append(f"JZERO finish")
-
-            elif condition[0] == "eq":
-                self.code.append(f"GET {second_reg}")
-                self.code.append(f"SUB {third_reg}")
-                self.code.append(f"JZERO {self.get_current_line() + 2}") 
-                self.code.append(f"JUMP finish")
-
-                self.code.append(f"GET {third_reg}")
-                self.code.append(f"SUB {second_reg}")
-                self.code.append(f"JZERO {self.get_current_line() + 2}") 
-                self.code.append(f"JUMP finish")
-
-            elif condition[0] == "ne":
-                self.code.append(f"GET {second_reg}")
-                self.code.append(f"SUB {third_reg}")
-                self.code.append(f"JZERO {self.get_current_line() + 2}")
-                self.code.append(f"JUMP {self.get_current_line() + 3}")
-                self.code.append(f"GET {third_reg}")
-                self.code.append(f"SUB {second_reg}")
-                self.code.append(f"JZERO finish")
+            self.calculate_expression(condition.left, second_reg)
+            self.calculate_expression(condition.right, third_reg)
+
+            if condition.op == "le":
+                self.emit(GET, second_reg)
+                self.emit(SUB, third_reg)
+                self.jump_unless_zero(false_label)
+
+            elif condition.op == "ge":
+                self.emit(GET, third_reg)
+                self.emit(SUB, second_reg)
+                self.jump_unless_zero(false_label)
+
+            elif condition.op == "lt":
+                self.emit(GET, third_reg)
+                self.emit(SUB, second_reg)
+                self.emit(JZERO, false_label)
+
+            elif condition.op == "gt":
+                self.emit(GET, second_reg)
+                self.emit(SUB, third_reg)
+                self.emit(JZERO, false_label)
+
+            elif condition.op == "eq":
+                self.emit(GET, second_reg)
+                self.emit(SUB, third_reg)
+                self.jump_unless_zero(false_label)
+
+                self.emit(GET, third_reg)
+                self.emit(SUB, second_reg)
+                self.jump_unless_zero(false_label)
+
+            elif condition.op == "ne":
+                second_test, done = self.new_label(), self.new_label()
+                self.emit(GET, second_reg)
+                self.emit(SUB, third_reg)
+                self.emit(JZERO, second_test)
+                self.emit(JUMP, done)
+                self.label(second_test)
+                self.emit(GET, third_reg)
+                self.emit(SUB, second_reg)
+                self.emit(JZERO, false_label)
+                self.label(done)
+
+    def jump_unless_zero(self, target):
+        # values are never negative, so JPOS is exactly "not zero"
+        self.emit(JPOS, target)
@@ -1,8 +1,13 @@
 from sly import Lexer, Parser
 from structures import Procedure, Array, Variable, Link, Link_T
+from ast_nodes import Const, Name, Element, Load, BinOp, Condition, Assign, If, While, Until, Read, Write, Call
 from procedures_table import ProcedureList
+from parser_cache import build_parser
+from program import Program
 import sys
 
+ARITH_MODES = ("inline", "call", "auto")
+
 
 class ImpLexer(Lexer):
     tokens = {PROGRAM, PROCEDURE, IS, IN, END, PID, NUM, IF, THEN, ELSE, ENDIF, WHILE, DO, ENDWHILE, REPEAT, UNTIL,
@@ -62,10 +67,14 @@ class ImpLexer(Lexer):
 
 class ImpParser(Parser):
     tokens = ImpLexer.tokens
-    procedures_table = ProcedureList()
-    curr_procedure = Procedure(1)
-    code = None
-    consts = set()
+
+    def __init__(self):
+        self.procedures_table = ProcedureList()
+        self.curr_procedure = Procedure(1)
+
+    @classmethod
+    def _build(cls, definitions):
+        build_parser(cls, definitions)
 
     @_('procedures main')
     def program_all(self, p):
@@ -89,7 +98,7 @@ class ImpParser(Parser):
         if p[0] == self.curr_procedure.name:
             raise Exception(f"Impossible to call function {p[0]} inside itself, line {p.lineno}")
         elif p[0] in self.procedures_table:
-            return p[0], p[2]
+            return Call(p[0], self.procedures_table[p[0]], p[2], p.lineno)
         else:
             raise Exception(f"Undeclaired function {p[0]}, line {p.lineno}")
 
@@ -144,18 +153,19 @@ class ImpParser(Parser):
     @_('args "," PID')   
     def args(self, p):
         if p[2] in self.curr_procedure.symbols:
-            return p[0] + [("load", p[2])]
+            p[0].append(Name(p[2], self.curr_procedure.symbols[p[2]]))
         elif p[2] in self.curr_procedure.links:
-            return p[0] + [("load", p[2])]
+            p[0].append(Name(p[2], self.curr_procedure.links[p[2]]))
         else:
             raise Exception(f"Undeclared variable {p[2]}, line {p.lineno}")
+        return p[0]
         
     @_('PID')
     def args(self, p):
         if p[0] in self.curr_procedure.symbols:
-            return [("load", p[0])]
+            return [Name(p[0], self.curr_procedure.symbols[p[0]])]
         elif p[0] in self.curr_procedure.links:
-            return [("load", p[0])]
+            return [Name(p[0], self.curr_procedure.links[p[0]])]
         else:
             raise Exception(f"Undeclared variable {p[0]}, line {p.lineno}")
 
@@ -163,53 +173,44 @@ class ImpParser(Parser):
 
     @_('commands command')
     def commands(self, p):
-        return p[0] + [p[1]]
+        p[0].append(p[1])
+        return p[0]
 
     @_('command')
     def commands(self, p):
-        command = list(p[0])
-        command.append(p.lineno)
-        return [tuple(command)]
+        return [p[0]]
 
     @_('identifier GETS expression ";"')
     def command(self, p):
-        return "assign", p[0], p[2], p.lineno
+        return Assign(p[0], p[2], p.lineno)
 
     @_('IF condition THEN commands ELSE commands ENDIF')
     def command(self, p):
-        resp = "ifelse", p[1], p[3], p[5], self.consts.copy(), p.lineno
-        self.consts.clear()
-        return resp
+        return If(p[1], p[3], p[5], p.lineno)
 
     @_('IF condition THEN commands ENDIF')
     def command(self, p):
-        resp = "if", p[1], p[3], self.consts.copy(), p.lineno
-        self.consts.clear()
-        return resp
+        return If(p[1], p[3], None, p.lineno)
 
     @_('WHILE condition DO commands ENDWHILE')
     def command(self, p):
-        resp = "while", p[1], p[3], self.consts.copy(), p.lineno
-        self.consts.clear()
-        return resp
+        return While(p[1], p[3], p.lineno)
 
     @_('REPEAT commands UNTIL condition ";"')
     def command(self, p):
-        return "until", p[3], p[1], p.lineno
+        return Until(p[3], p[1], p.lineno)
 
     @_('READ identifier ";"')
     def command(self, p):
-        return "read", p[1]
+        return Read(p[1], p.lineno)
 
     @_('WRITE value ";"')
     def command(self, p):
-        if p[1][0] == "const":
-            self.consts.add(int(p[1][1]))
-        return "write", p[1]
+        return Write(p[1], p.lineno)
 
     @_('procedure_call ";"')
     def command(self, p):
-        return 'proc_call', p[0]
+        return p[0]
 
     @_('value')
     def expression(self, p):
@@ -217,114 +218,176 @@ class ImpParser(Parser):
 
     @_('value "+" value')
     def expression(self, p):
-        return "add", p[0], p[2]
+        return BinOp("add", p[0], p[2])
 
     @_('value "-" value')
     def expression(self, p):
-        return "sub", p[0], p[2]
+        return BinOp("sub", p[0], p[2])
 
     @_('value "*" value')
     def expression(self, p):
-        return "mul", p[0], p[2]
+        return BinOp("mul", p[0], p[2])
 
     @_('value "/" value')
     def expression(self, p):
-        return "div", p[0], p[2]
+        return BinOp("div", p[0], p[2])
 
     @_('value "%" value')
     def expression(self, p):
-        return "mod", p[0], p[2]
+        return BinOp("mod", p[0], p[2])
 
     @_('value EQ value')
     def condition(self, p):
-        return "eq", p[0], p[2]
+        return Condition("eq", p[0], p[2])
 
     @_('value NEQ value')
     def condition(self, p):
-        return "ne", p[0], p[2]
+        return Condition("ne", p[0], p[2])
 
     @_('value LT value')
     def condition(self, p):
-        return "lt", p[0], p[2]
+        return Condition("lt", p[0], p[2])
 
     @_('value GT value')
     def condition(self, p):
-        return "gt", p[0], p[2]
+        return Condition("gt", p[0], p[2])
 
     @_('value LEQ value')
     def condition(self, p):
-        return "le", p[0], p[2]
+        return Condition("le", p[0], p[2])
 
     @_('value GEQ value')
     def condition(self, p):
-        return "ge", p[0], p[2]
+        return Condition("ge", p[0], p[2])
 
     @_('NUM')
     def value(self, p):
-        return "const", p[0]
+        return Const(p[0])
 
     @_('identifier')
     def value(self, p):
-        return "load", p[0]
+        return Load(p[0])
 
     @_('PID')
     def identifier(self, p):
         if p[0] in self.curr_procedure.symbols:
             if type(self.curr_procedure.symbols[p[0]]) is Variable:
-                return p[0]
+                return Name(p[0], self.curr_procedure.symbols[p[0]])
         elif p[0] in self.curr_procedure.links:
             if type(self.curr_procedure.links[p[0]]) is Link:
-                return p[0]
+                return Name(p[0], self.curr_procedure.links[p[0]])
         raise Exception(f"Undeclared variable {p[0]} in {p.lineno} line")
             
     @_('PID "[" NUM "]"')
     def identifier(self, p):
         if p[0] in self.curr_procedure.symbols and type(self.curr_procedure.symbols[p[0]]) is Array:
-            return "array", p[0], p[2]
+            return Element(p[0], self.curr_procedure.symbols[p[0]], p[2])
         elif p[0] in self.curr_procedure.links and type(self.curr_procedure.links[p[0]]) is Link_T:
-            return "link_t", p[0], p[2]
+            return Element(p[0], self.curr_procedure.links[p[0]], p[2])
         else:
             raise Exception(f"Undeclared array {p[0]}, in {p.lineno} line")
 
     @_('PID "[" PID "]"')
     def identifier(self, p):
         if p[0] in self.curr_procedure.symbols and type(self.curr_procedure.symbols[p[0]]) is Array:
-            if p[2] in self.curr_procedure.symbols and type(self.curr_procedure.symbols[p[2]]) is Variable:
-                return "array", p[0], ("load", p[2])
-            elif p[2] in self.curr_procedure.links and type(self.curr_procedure.links[p[2]]) is Link:
-                return "array", p[0], ("load", p[2])
-            else:
-                raise Exception(f"Undeclared variable {p[2]}, line {p.lineno}")
+            array = self.curr_procedure.symbols[p[0]]
         elif p[0] in self.curr_procedure.links and type(self.curr_procedure.links[p[0]]) is Link_T:
-            if p[2] in self.curr_procedure.symbols and type(self.curr_procedure.symbols[p[2]]) is Variable:
-                return "link_t", p[0], ("load", p[2])
-            elif p[2] in self.curr_procedure.links and type(self.curr_procedure.links[p[2]]) is Link:
-                return "link_t", p[0], ("load", p[2])
-            else:
-                raise Exception(f"Undeclared variable {p[2]}, line {p.lineno}")
+            array = self.curr_procedure.links[p[0]]
         else:
             raise Exception(f"Undeclared array {p[0]}, line {p.lineno}")
+        if p[2] in self.curr_procedure.symbols and type(self.curr_procedure.symbols[p[2]]) is Variable:
+            return Element(p[0], array, Name(p[2], self.curr_procedure.symbols[p[2]]))
+        elif p[2] in self.curr_procedure.links and type(self.curr_procedure.links[p[2]]) is Link:
+            return Element(p[0], array, Name(p[2], self.curr_procedure.links[p[2]]))
+        else:
+            raise Exception(f"Undeclared variable {p[2]}, line {p.lineno}")
 
     def error(self, token):
         raise Exception(f"Syntax error: '{token.value}' in line {token.lineno}")
 
 
-sys.tracebacklimit = 0
-lex = ImpLexer()
-pars = ImpParser()
-with open(sys.argv[1]) as in_f:
-    text = in_f.read()
-
-pars.parse(lex.tokenize(text))
-code_gen = pars.code
-procedures_table = pars.procedures_table
-
-procedures_table.gen_first_jump()
-procedures_table.gen_code()
-procedures_table.update_first_jump()
-
-with open(sys.argv[2], 'w') as out_f:
-    print(procedures_table.first_line, file=out_f) # GENERATE FIRST JUMP   
-    for procedure_code in procedures_table.code:
-        for line in procedure_code:
-            print(line, file=out_f)
+def compile(source, arith="inline", peephole=True, inline_growth=50, max_clones=4,
+            const_prop=True, unroll_size=150, cse=True, licm=True, induction=True, ranges=True):
+    if arith not in ARITH_MODES:
+        raise Exception(f"Unknown arithmetic mode {arith}, expected one of {', '.join(ARITH_MODES)}")
+    parser = ImpParser()
+    procedures_table = parser.parse(ImpLexer().tokenize(source))
+    if procedures_table is None:
+        raise Exception("Empty program")
+    procedures_table.arith_mode = arith
+    procedures_table.inline_growth = inline_growth
+    procedures_table.max_clones = max_clones
+    procedures_table.const_prop = const_prop
+    procedures_table.unroll_size = unroll_size
+    procedures_table.cse = cse
+    procedures_table.licm = licm
+    procedures_table.induction = induction
+    procedures_table.ranges = ranges
+    procedures_table.gen_first_jump()
+    procedures_table.gen_code()
+    if peephole:
+        procedures_table.optimize()
+    return Program(procedures_table)
+
+
+def option_number(option):
+    value = option.split("=", 1)[1]
+    if not value.isdigit():
+        raise Exception(f"Option {option} needs a whole number")
+    return int(value)
+
+
+def parse_options(options):
+    settings = {}
+    for option in options:
+        if option.startswith("--arith="):
+            settings["arith"] = option.split("=", 1)[1]
+            if settings["arith"] not in ARITH_MODES:
+                raise Exception(f"Unknown arithmetic mode in {option}, expected one of {', '.join(ARITH_MODES)}")
+        elif option == "--no-peephole":
+            settings["peephole"] = False
+        elif option.startswith("--inline-growth="):
+            settings["inline_growth"] = option_number(option)
+        elif option == "--no-inline":
+            settings["inline_growth"] = None
+        elif option.startswith("--max-clones="):
+            settings["max_clones"] = option_number(option)
+        elif option == "--no-const-prop":
+            settings["const_prop"] = False
+        elif option.startswith("--unroll-size="):
+            settings["unroll_size"] = option_number(option)
+        elif option == "--no-unroll":
+            settings["unroll_size"] = 0
+        elif option == "--no-cse":
+            settings["cse"] = False
+        elif option == "--no-licm":
+            settings["licm"] = False
+        elif option == "--no-induction":
+            settings["induction"] = False
+        elif option == "--no-ranges":
+            settings["ranges"] = False
+        else:
+            raise Exception(f"Unknown option {option}")
+    return settings
+
+
+def main(argv):
+    sys.tracebacklimit = 0
+    options = argv[3:]
+    settings = parse_options([option for option in options if option not in ("--stats", "--lines")])
+    with open(argv[1]) as in_f:
+        text = in_f.read()
+
+    program = compile(text, **settings)
+    for warning in program.warnings:
+        print(warning)
+    if "--stats" in options:
+        for name, before, after in program.peephole_report:
+            print(f"peephole {name}: static cost {before} -> {after} (saved {before - after})")
+    program.write(argv[2])
+    if "--lines" in options:
+        program.write_lines(argv[2] + ".lines")
+
+
+if __name__ == "__main__":
+    main(sys.argv)
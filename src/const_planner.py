@@ -0,0 +1,100 @@
+from instructions import GET, PUT, RST, INC, DEC, SHL, SHR, ADD, SUB, JUMP, JUMPR, HALT, LABEL, A, Instruction
+from peephole import apply, instruction_cost, uses_defs
+
+
+def chain(start, value):
+    if start == 0:
+        bits = bin(value)[2:]
+        ops = []
+        for bit in bits[:-1]:
+            if bit == '1':
+                ops.append(INC)
+            ops.append(SHL)
+        if bits[-1] == '1':
+            ops.append(INC)
+        return ops
+    prefix, bits = bin(start)[2:], bin(value)[2:]
+    if not bits.startswith(prefix):
+        return None
+    ops = []
+    for bit in bits[len(prefix):]:
+        ops.append(SHL)
+        if bit == '1':
+            ops.append(INC)
+    return ops
+
+
+class ConstPlanner:
+    def __init__(self):
+        self.values = {}
+
+    def clear(self):
+        self.values = {}
+
+    def observe(self, instruction):
+        op, arg = instruction.op, instruction.arg
+        values = self.values
+        if op in (LABEL, JUMP, JUMPR, HALT):
+            values.clear()
+        elif op == GET:
+            self.set(A, values.get(arg))
+        elif op == PUT:
+            self.set(arg, values.get(A))
+        elif op == RST:
+            self.set(arg, 0)
+        elif op in (INC, DEC, SHL, SHR):
+            self.set(arg, apply(op, values[arg]) if arg in values else None)
+        elif op in (ADD, SUB):
+            if A in values and arg in values:
+                self.set(A, values[A] + values[arg] if op == ADD else max(0, values[A] - values[arg]))
+            else:
+                self.set(A, None)
+        else:
+            for reg in uses_defs(op, arg)[1]:
+                self.set(reg, None)
+
+    def set(self, reg, value):
+        if value is None:
+            self.values.pop(reg, None)
+        else:
+            self.values[reg] = value
+
+    def plan(self, value, reg):
+        if self.values.get(reg) == value:
+            return []
+        candidates = [[RST] + chain(0, value)]
+        if value > 0:
+            candidates.append([RST] + chain(0, value + 1) + [DEC])
+        if reg in self.values:
+            candidates += self.derive(self.values[reg], value)
+        for other, known in self.values.items():
+            if other == reg:
+                continue
+            if reg == A:
+                candidates += [[(GET, other)] + ops for ops in self.derive(known, value)]
+                if A in self.values and self.values[A] + known == value:
+                    candidates.append([(ADD, other)])
+                for second, known2 in self.values.items():
+                    if second not in (A, other) and known + known2 == value:
+                        candidates.append([(GET, other), (ADD, second)])
+            elif other == A:
+                candidates += [[(PUT, reg)] + ops for ops in self.derive(known, value)]
+        best = min(candidates, key=lambda ops: (sum(instruction_cost(op if type(op) is int else op[0]) for op in ops), len(ops)))
+        return [Instruction(op, reg) if type(op) is int else Instruction(*op) for op in best]
+
+    def derive(self, start, value):
+        if start == value:
+            return [[]]
+        plans = []
+        if abs(start - value) <= 2 * value.bit_length() + 2:
+            plans.append(([INC] if value > start else [DEC]) * abs(value - start))
+        shifted, shifts = start, 0
+        while shifted > 0:
+            for target, fix in ((value, []), (value + 1, [DEC]), (value - 1, [INC])):
+                if target > 0:
+                    ops = chain(shifted, target)
+                    if ops is not None:
+                        plans.append([SHR] * shifts + ops + fix)
+            shifted >>= 1
+            shifts += 1
+        return plans
@@ -0,0 +1,222 @@
+from structures import Array, Variable
+from ast_nodes import (Const, Name, Element, Load, BinOp, Condition, Assign, If, While, Until, Read, Write, Call,
+                       Inline)
+from loops import LoopEffects
+
+COMPARE = {
+    "eq": lambda x, y: x == y,
+    "ne": lambda x, y: x != y,
+    "lt": lambda x, y: x < y,
+    "gt": lambda x, y: x > y,
+    "le": lambda x, y: x <= y,
+    "ge": lambda x, y: x >= y,
+}
+
+
+def fold(op, x, y):
+    # the machine saturates subtraction at 0 and divides by 0 to 0
+    match op:
+        case "add":
+            return x + y
+        case "sub":
+            return max(0, x - y)
+        case "mul":
+            return x * y
+        case "div":
+            return x // y if y else 0
+        case "mod":
+            return x % y if y else 0
+
+
+def meet(env, other):
+    return {symbol: value for symbol, value in env.items() if other.get(symbol) == value}
+
+
+def assigned_symbols(target):
+    if type(target) is Name and type(target.symbol) is Variable:
+        return [target.symbol]
+    return []
+
+
+class ConstantPropagation:
+    # forward dataflow over the commands of one procedure, keeping the
+    # variables known to hold a constant. Only plain variables are tracked:
+    # parameters may alias each other and array cells are not followed.
+    # Loops are iterated until the values at their head stop changing, and
+    # the commands are rewritten once with those values
+    def __init__(self, procedure):
+        self.procedure = procedure
+        # a call can write the variables it is given, the caller's variables
+        # bound in a specialized callee and the memory of inlined procedures,
+        # which the callee may share; the procedure's own locals survive it
+        self.locals = {symbol for name, symbol in procedure.symbols.items()
+                       if type(symbol) is Variable and "." not in name and name not in procedure.bindings}
+        # the head last found for each loop, by id, with the loop itself so
+        # that the id is not reused
+        self.heads = {}
+        # set while testing whether a REPEAT body runs once, see runs_once
+        self.shallow = False
+
+    def run(self):
+        self.procedure.commands, _ = self.commands(self.procedure.commands, {}, True)
+
+    def value(self, value, env):
+        if type(value) is Const:
+            return value.value
+        if type(value) is Load and type(value.target) is Name:
+            return env.get(value.target.symbol)
+        return None
+
+    def expression(self, expr, env):
+        if type(expr) is BinOp:
+            left, right = self.value(expr.left, env), self.value(expr.right, env)
+            if left is None or right is None:
+                return None
+            return fold(expr.op, left, right)
+        return self.value(expr, env)
+
+    def condition(self, condition, env):
+        left, right = self.value(condition.left, env), self.value(condition.right, env)
+        if left is None or right is None:
+            return None
+        return COMPARE[condition.op](left, right)
+
+    def rewrite_identifier(self, identifier, env):
+        if type(identifier) is Element and type(identifier.index) is Name:
+            index = env.get(identifier.index.symbol)
+            if index is not None and (type(identifier.symbol) is not Array or index < identifier.symbol.size):
+                return Element(identifier.name, identifier.symbol, index)
+        return identifier
+
+    def rewrite_value(self, value, env):
+        if type(value) is Load:
+            known = self.value(value, env)
+            if known is not None:
+                return Const(known)
+            return Load(self.rewrite_identifier(value.target, env))
+        return value
+
+    def rewrite_expression(self, expr, env):
+        known = self.expression(expr, env)
+        if known is not None:
+            return Const(known)
+        if type(expr) is BinOp:
+            return BinOp(expr.op, self.rewrite_value(expr.left, env), self.rewrite_value(expr.right, env))
+        return self.rewrite_value(expr, env)
+
+    def rewrite_condition(self, condition, env):
+        return Condition(condition.op, self.rewrite_value(condition.left, env),
+                         self.rewrite_value(condition.right, env))
+
+    def commands(self, commands, env, rewrite):
+        # returns the rewritten commands (None when not rewriting) and the
+        # values known after them
+        env = dict(env)
+        result = [] if rewrite else None
+        for command in commands:
+            match command:
+                case Assign():
+                    known = self.expression(command.expr, env)
+                    if rewrite:
+                        result.append(Assign(self.rewrite_identifier(command.target, env),
+                                             self.rewrite_expression(command.expr, env), command.lineno))
+                    for symbol in assigned_symbols(command.target):
+                        if known is None:
+                            env.pop(symbol, None)
+                        else:
+                            env[symbol] = known
+                case Read():
+                    if rewrite:
+                        result.append(Read(self.rewrite_identifier(command.target, env), command.lineno))
+                    for symbol in assigned_symbols(command.target):
+                        env.pop(symbol, None)
+                case Write():
+                    if rewrite:
+                        result.append(Write(self.rewrite_value(command.value, env), command.lineno))
+                case Call():
+                    if rewrite:
+                        result.append(command)
+                    written = {arg.symbol for arg in command.args} | set(command.procedure.bindings.values())
+                    env = {symbol: value for symbol, value in env.items()
+                           if symbol in self.locals and symbol not in written}
+                case Inline():
+                    body, env = self.commands(command.commands, env, rewrite)
+                    if rewrite:
+                        result.append(Inline(command.call, body, command.lineno))
+                case If():
+                    env = self.perform_if(command, env, rewrite, result)
+                case While() | Until() if self.shallow:
+                    effects = LoopEffects(self.locals, command.commands)
+                    env = {symbol: value for symbol, value in env.items() if not effects.writes(symbol)}
+                case While():
+                    env = self.perform_while(command, env, rewrite, result)
+                case Until():
+                    env = self.perform_until(command, env, rewrite, result)
+        return result, env
+
+    def perform_if(self, command, env, rewrite, result):
+        known = self.condition(command.condition, env)
+        if known is not None:
+            # only the branch taken is kept
+            branch = command.commands if known else command.else_commands or []
+            body, env = self.commands(branch, env, rewrite)
+            if rewrite:
+                result += body
+            return env
+        body, then_env = self.commands(command.commands, env, rewrite)
+        else_body, else_env = self.commands(command.else_commands or [], env, rewrite)
+        if rewrite:
+            if command.else_commands is None:
+                else_body = None
+            result.append(If(self.rewrite_condition(command.condition, env), body, else_body, command.lineno))
+        return meet(then_env, else_env)
+
+    def loop_head(self, command, env):
+        # the values holding on every entry to the body, entering from
+        # outside or coming back from its end. A loop entered again, as on
+        # every round of an enclosing loop, starts from the head it had the
+        # last time, so the head of each loop only shrinks over the whole
+        # pass and nested loops are not settled from scratch on every round
+        _, head = self.heads.get(id(command), (command, env))
+        head = meet(head, env)
+        while True:
+            _, out = self.commands(command.commands, head, False)
+            new_head = meet(head, out)
+            if len(new_head) == len(head):
+                # a copy, as the caller goes on to change the head it is given
+                self.heads[id(command)] = command, dict(head)
+                return head, out
+            head = new_head
+
+    def perform_while(self, command, env, rewrite, result):
+        if self.condition(command.condition, env) is False:
+            # the body never runs
+            return env
+        head, _ = self.loop_head(command, env)
+        if rewrite:
+            body, _ = self.commands(command.commands, head, True)
+            result.append(While(self.rewrite_condition(command.condition, head), body, command.lineno))
+        return head
+
+    def runs_once(self, command, env):
+        # whether the condition holds after the first run of the body. The
+        # loops inside it are not followed here but only forget what they may
+        # write, or testing every REPEAT of a nest would analyse the loops
+        # inside it once more and double the work with every level
+        shallow, self.shallow = self.shallow, True
+        _, out = self.commands(command.commands, env, False)
+        self.shallow = shallow
+        return self.condition(command.condition, out) is True
+
+    def perform_until(self, command, env, rewrite, result):
+        if self.runs_once(command, env):
+            # the body runs exactly once
+            body, out = self.commands(command.commands, env, rewrite)
+            if rewrite:
+                result += body
+            return out
+        head, out = self.loop_head(command, env)
+        if rewrite:
+            body, _ = self.commands(command.commands, head, True)
+            result.append(Until(self.rewrite_condition(command.condition, out), body, command.lineno))
+        return out
@@ -0,0 +1,218 @@
+from structures import Variable, Array, Link, Link_T
+from ast_nodes import Name, Element, Load, BinOp, Condition, Assign, If, While, Until, Read, Write, Call, Inline
+from code_generator import routine_for
+
+OTHER = {"div": "mod", "mod": "div"}
+
+
+def value_symbols(value):
+    if type(value) is Load:
+        target = value.target
+        yield target.symbol
+        if type(target) is Element and type(target.index) is Name:
+            yield target.index.symbol
+
+
+def expression_symbols(expr):
+    if type(expr) is BinOp:
+        yield from value_symbols(expr.left)
+        yield from value_symbols(expr.right)
+    else:
+        yield from value_symbols(expr)
+
+
+def meet(available, other):
+    return {expr: holder for expr, holder in available.items() if other.get(expr) is holder}
+
+
+def divides(expr):
+    # the division loop gives the quotient and the remainder together
+    return routine_for(expr) == "div" and routine_for(BinOp(OTHER[expr.op], expr.left, expr.right)) == "div"
+
+
+class Division:
+    # the other result of the division of command, saved into temporary
+    # next to it once something needs it
+    def __init__(self, command):
+        self.command = command
+        self.temporary = None
+
+
+class CommonSubexpressions:
+    # available expressions over the commands of one procedure: after
+    # x := a * b, or x := t[i], or t[i] := x, the variable x holds the value
+    # until x or anything the expression reads is written, so later
+    # occurrences read x instead. Parameters may alias each other, array
+    # stores through a variable index may hit any cell, and a call may
+    # write its arguments, the caller's variables bound in a specialized
+    # callee and anything that is not a local of the procedure.
+    # After x := a / b the remainder a % b is available too: the division
+    # that needs it is preceded by t := a % b, which the code generator
+    # computes with the same division, and the later a % b reads t
+    def __init__(self, procedures_table, procedure):
+        self.procedures_table = procedures_table
+        self.procedure = procedure
+        self.divisions = {}
+        self.paired = {}
+        self.local = {symbol for name, symbol in procedure.symbols.items()
+                      if type(symbol) in (Variable, Array) and "." not in name and name not in procedure.bindings}
+        # the head last found for each loop, as in ConstantPropagation
+        self.heads = {}
+
+    def run(self):
+        commands, _ = self.commands(self.procedure.commands, {}, True)
+        if self.paired:
+            # the divisions found to be paired were rewritten before the
+            # command that uses their other result
+            commands, _ = self.commands(self.procedure.commands, {}, True)
+        self.procedure.commands = commands
+
+    def kill(self, available, written):
+        # written(symbol) tells whether a write may change symbol
+        for expr, holder in list(available.items()):
+            if type(holder) is Name and written(holder.symbol) or any(written(symbol) for symbol in expression_symbols(expr)):
+                del available[expr]
+
+    def kill_scalar(self, available, symbol):
+        if type(symbol) is Link:
+            self.kill(available, lambda other: type(other) is Link)
+        else:
+            self.kill(available, lambda other: other is symbol)
+
+    def kill_element(self, available, target):
+        # only loads of other constant cells of the array survive
+        def hit(expr):
+            element = expr.target if type(expr) is Load else None
+            if type(element) is not Element:
+                return False
+            if type(target.symbol) is Link_T:
+                if type(element.symbol) is not Link_T:
+                    return False
+            elif element.symbol is not target.symbol:
+                return False
+            return type(element.index) is not int or type(target.index) is not int or element.index == target.index
+        for expr in list(available):
+            if hit(expr) or type(expr) is BinOp and (hit(expr.left) or hit(expr.right)):
+                del available[expr]
+
+    def kill_call(self, available, call):
+        written = {arg.symbol for arg in call.args} | set(call.procedure.bindings.values())
+        self.kill(available, lambda symbol: symbol not in self.local or symbol in written)
+
+    def value(self, value, available):
+        if type(value) is Load and type(value.target) is Element and value in available:
+            return Load(available[value])
+        return value
+
+    def expression(self, expr, available, shared=None):
+        # shared is the command the code generator computes this one with
+        holder = available.get(expr)
+        if type(holder) is Division:
+            if holder.command is not shared:
+                if holder.temporary is None:
+                    name = self.procedures_table.add_temporary(self.procedure)
+                    holder.temporary = Name(name, self.procedure.symbols[name])
+                    self.paired[id(holder.command)] = holder
+                return Load(holder.temporary)
+        elif holder is not None:
+            return Load(holder)
+        if type(expr) is BinOp:
+            return BinOp(expr.op, self.value(expr.left, available), self.value(expr.right, available))
+        return self.value(expr, available)
+
+    def condition(self, condition, available):
+        return Condition(condition.op, self.value(condition.left, available), self.value(condition.right, available))
+
+    def assign(self, command, available):
+        target, expr = command.target, command.expr
+        computed = expr not in available
+        if type(target) is Name:
+            self.kill_scalar(available, target.symbol)
+            if type(target.symbol) is Variable and target.symbol not in expression_symbols(expr):
+                if type(expr) is BinOp or type(expr) is Load and type(expr.target) is Element:
+                    available[expr] = target
+                if computed and type(expr) is BinOp and expr.op in OTHER and divides(expr):
+                    if id(command) not in self.divisions:
+                        self.divisions[id(command)] = Division(command)
+                    available[BinOp(OTHER[expr.op], expr.left, expr.right)] = self.divisions[id(command)]
+        else:
+            self.kill_element(available, target)
+            if type(expr) is Load and type(expr.target) is Name and type(expr.target.symbol) is Variable and \
+                    not (type(target.index) is Name and target.index.symbol is expr.target.symbol):
+                available[Load(target)] = expr.target
+
+    def commands(self, commands, available, rewrite):
+        # returns the rewritten commands (None when not rewriting) and the
+        # expressions available after them
+        available = dict(available)
+        result = [] if rewrite else None
+        previous = None
+        for command in commands:
+            match command:
+                case Assign():
+                    if rewrite:
+                        # a division right after its pair shares it without a temporary
+                        shared = previous if type(previous) is Assign and not (
+                            type(command.target) is Name and command.target.symbol is previous.target.symbol) else None
+                        expr = self.expression(command.expr, available, shared)
+                        if id(command) in self.paired:
+                            result.append(Assign(self.paired[id(command)].temporary,
+                                                 BinOp(OTHER[expr.op], expr.left, expr.right), command.lineno))
+                        result.append(Assign(command.target, expr, command.lineno))
+                    self.assign(command, available)
+                case Read():
+                    if rewrite:
+                        result.append(command)
+                    if type(command.target) is Name:
+                        self.kill_scalar(available, command.target.symbol)
+                    else:
+                        self.kill_element(available, command.target)
+                case Write():
+                    if rewrite:
+                        result.append(Write(self.value(command.value, available), command.lineno))
+                case Call():
+                    if rewrite:
+                        result.append(command)
+                    self.kill_call(available, command)
+                case Inline():
+                    body, available = self.commands(command.commands, available, rewrite)
+                    if rewrite:
+                        result.append(Inline(command.call, body, command.lineno))
+                case If():
+                    condition = self.condition(command.condition, available)
+                    body, then_available = self.commands(command.commands, available, rewrite)
+                    else_body, else_available = self.commands(command.else_commands or [], available, rewrite)
+                    if rewrite:
+                        if command.else_commands is None:
+                            else_body = None
+                        result.append(If(condition, body, else_body, command.lineno))
+                    available = meet(then_available, else_available)
+                case While():
+                    head, _ = self.loop_head(command, available)
+                    if rewrite:
+                        body, _ = self.commands(command.commands, head, True)
+                        result.append(While(self.condition(command.condition, head), body, command.lineno))
+                    available = head
+                case Until():
+                    head, out = self.loop_head(command, available)
+                    if rewrite:
+                        body, _ = self.commands(command.commands, head, True)
+                        result.append(Until(self.condition(command.condition, out), body, command.lineno))
+                    available = out
+            previous = command
+        return result, available
+
+    def loop_head(self, command, available):
+        # the expressions available on every entry to the body, entering
+        # from outside or coming back from its end. A loop entered again
+        # starts from the head it had the last time, so nested loops are not
+        # settled from scratch on every round of the loops around them
+        _, head = self.heads.get(id(command), (command, available))
+        head = meet(head, available)
+        while True:
+            _, out = self.commands(command.commands, head, False)
+            new_head = meet(head, out)
+            if len(new_head) == len(head):
+                self.heads[id(command)] = command, dict(head)
+                return head, out
+            head = new_head
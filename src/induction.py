@@ -0,0 +1,284 @@
+from itertools import islice
+
+from structures import Variable, Array, Link_T
+from ast_nodes import Const, Name, Element, Load, BinOp, Condition, Assign, If, While, Until, Read, Write, Call, Inline
+from loops import LoopEffects, LoopPass
+from loop_invariants import Invariance
+
+MEMORY_SIZE = 2 ** 62
+
+
+def memory_view(procedure, offset):
+    # the memory seen as an array starting at address offset
+    name = f"mem{offset}"
+    if name not in procedure.symbols:
+        procedure.symbols[name] = Array(name, offset, MEMORY_SIZE)
+    return name, procedure.symbols[name]
+
+
+def is_memory_view(name):
+    return name.startswith("mem") and name[3:].isdigit()
+
+
+def increment(command):
+    # the step of i := i + c or i := c + i
+    expr = command.expr
+    if type(command.target) is not Name or type(expr) is not BinOp or expr.op != "add":
+        return None
+    for value, step in ((expr.left, expr.right), (expr.right, expr.left)):
+        if type(step) is Const and step.value > 0 and value == Load(command.target):
+            return step.value
+    return None
+
+
+def value_names(value):
+    if type(value) is Load:
+        yield from identifier_names(value.target)
+
+
+def identifier_names(identifier):
+    if type(identifier) is Name:
+        yield identifier
+    elif type(identifier.index) is Name:
+        yield identifier.index
+
+
+def reads(commands, symbol):
+    # whether the commands may read symbol; a call reads its arguments
+    for command in commands:
+        match command:
+            case Assign():
+                values = [command.expr.left, command.expr.right] if type(command.expr) is BinOp else [command.expr]
+                names = [name for value in values for name in value_names(value)]
+                if type(command.target) is Element:
+                    names += identifier_names(command.target)
+            case Read():
+                names = list(identifier_names(command.target)) if type(command.target) is Element else []
+            case Write():
+                names = list(value_names(command.value))
+            case Call():
+                names = command.args
+            case If():
+                names = list(value_names(command.condition.left)) + list(value_names(command.condition.right))
+                if reads(command.commands, symbol) or reads(command.else_commands or [], symbol):
+                    return True
+            case While() | Until():
+                names = list(value_names(command.condition.left)) + list(value_names(command.condition.right))
+                if reads(command.commands, symbol):
+                    return True
+            case Inline():
+                names = []
+                if reads(command.commands, symbol):
+                    return True
+        if any(name.symbol is symbol for name in names):
+            return True
+    return False
+
+
+class InductionScan:
+    # how a loop uses its variables: increments by a constant, array
+    # indexes, comparisons in conditions, and everything else
+    def __init__(self, commands, condition):
+        self.increments = {}
+        self.indexed = {}
+        self.compared = {}
+        self.other = set()
+        self.scan_condition(condition)
+        self.scan(commands)
+
+    def scan(self, commands):
+        for command in commands:
+            match command:
+                case Assign():
+                    if increment(command) is not None:
+                        self.increments[command.target.symbol] = command.target
+                    else:
+                        self.scan_target(command.target)
+                        if type(command.expr) is BinOp:
+                            self.scan_value(command.expr.left)
+                            self.scan_value(command.expr.right)
+                        else:
+                            self.scan_value(command.expr)
+                case Read():
+                    self.scan_target(command.target)
+                case Write():
+                    self.scan_value(command.value)
+                case Call():
+                    self.other.update(arg.symbol for arg in command.args)
+                case If():
+                    self.scan_condition(command.condition)
+                    self.scan(command.commands)
+                    self.scan(command.else_commands or [])
+                case While() | Until():
+                    self.scan_condition(command.condition)
+                    self.scan(command.commands)
+                case Inline():
+                    self.scan(command.commands)
+
+    def scan_condition(self, condition):
+        sides = [condition.left, condition.right]
+        for value, other in (sides, sides[::-1]):
+            if type(value) is Load and type(value.target) is Name:
+                self.compared.setdefault(value.target.symbol, []).append(other)
+            else:
+                self.scan_value(value)
+
+    def scan_target(self, target):
+        if type(target) is Name:
+            self.other.add(target.symbol)
+        else:
+            self.scan_identifier(target)
+
+    def scan_value(self, value):
+        if type(value) is Load:
+            if type(value.target) is Name:
+                self.other.add(value.target.symbol)
+            else:
+                self.scan_identifier(value.target)
+
+    def scan_identifier(self, element):
+        index = element.index
+        if type(index) is not Name:
+            return
+        if is_memory_view(element.name):
+            self.other.add(index.symbol)
+        else:
+            self.indexed.setdefault(index.symbol, {})[element.symbol] = element.name
+
+
+class InductionVariables(LoopPass):
+    # strength reduction of array indexing. A variable that a loop only
+    # increments by constants, uses as an array index and compares with
+    # values the loop does not change is replaced in the loop by a pointer
+    # holding the address of its element, so t[i] reads or writes at that
+    # address instead of adding the array base to i every time. The
+    # comparisons are shifted by the base, and the variable is set back
+    # from the pointer after the loop unless it is overwritten next.
+    # Decrements are left alone, since subtraction stops at 0 and the
+    # pointer would not
+    def loop(self, command, assigned, following):
+        effects = LoopEffects(self.local, command.commands)
+        invariant = Invariance(effects, assigned)
+        scan = InductionScan(command.commands, command.condition)
+        before, after = [], []
+        pointers, views, bounds = {}, {}, {}
+        for symbol in scan.increments:
+            arrays = scan.indexed.get(symbol)
+            if not arrays or symbol in scan.other or symbol not in assigned or type(symbol) is not Variable or \
+                    effects.called(symbol):
+                continue
+            if not all(invariant.value(other) for other in scan.compared.get(symbol, [])):
+                continue
+            if all(type(array) is Array for array in arrays):
+                start = min(array.memory_offset for array in arrays)
+                base = Const(start)
+                for array in arrays:
+                    views[(array, symbol)] = memory_view(self.procedure, array.memory_offset - start)
+            elif len(arrays) == 1 and type(next(iter(arrays))) is Link_T:
+                # an array parameter holds the address of the caller's array
+                array = next(iter(arrays))
+                base = Load(Element(*memory_view(self.procedure, 0), array.memory_offset))
+                views[(array, symbol)] = memory_view(self.procedure, 0)
+            else:
+                continue
+            name = scan.increments[symbol]
+            pointer = self.temporary()
+            pointers[symbol] = pointer
+            before.append(Assign(pointer, BinOp("add", Load(name), base), command.lineno))
+            for other in scan.compared.get(symbol, []):
+                if (symbol, other) in bounds:
+                    continue
+                if type(other) is Const and type(base) is Const:
+                    bounds[(symbol, other)] = Const(other.value + base.value)
+                else:
+                    bound = self.temporary()
+                    before.append(Assign(bound, BinOp("add", other, base), command.lineno))
+                    bounds[(symbol, other)] = Load(bound)
+            if not self.dead_after(following, symbol):
+                after.append(Assign(name, BinOp("sub", Load(pointer), base), command.lineno))
+        rewrite = PointerRewrite(pointers, views, bounds)
+        body, body_assigned = self.commands(rewrite.commands(command.commands),
+                                            assigned | {pointer.symbol for pointer in pointers.values()})
+        return before, type(command)(rewrite.condition(command.condition), body, command.lineno), after, body_assigned
+
+    def dead_after(self, following, symbol):
+        # the value a loop leaves in symbol is not needed when the following
+        # commands set it before anything reads it, or never read it before
+        # the program ends; a call may read anything that is not a local
+        while following:
+            commands, start, following = following
+            for command in islice(commands, start, None):
+                if reads([command], symbol) or type(command) is Call and symbol not in self.local:
+                    return False
+                if type(command) in (Assign, Read) and type(command.target) is Name and \
+                        command.target.symbol is symbol:
+                    return True
+        return following == ()
+
+    def temporary(self):
+        name = self.procedures_table.add_temporary(self.procedure)
+        return Name(name, self.procedure.symbols[name])
+
+
+class PointerRewrite:
+    def __init__(self, pointers, views, bounds):
+        self.pointers = pointers
+        self.views = views
+        self.bounds = bounds
+
+    def identifier(self, identifier):
+        if type(identifier) is Element and type(identifier.index) is Name:
+            view = self.views.get((identifier.symbol, identifier.index.symbol))
+            if view is not None:
+                return Element(*view, self.pointers[identifier.index.symbol])
+        return identifier
+
+    def value(self, value):
+        if type(value) is Load:
+            return Load(self.identifier(value.target))
+        return value
+
+    def expression(self, expr):
+        if type(expr) is BinOp:
+            return BinOp(expr.op, self.value(expr.left), self.value(expr.right))
+        return self.value(expr)
+
+    def condition(self, condition):
+        left, right = condition.left, condition.right
+        for value, other in ((left, right), (right, left)):
+            if type(value) is Load and type(value.target) is Name and value.target.symbol in self.pointers:
+                symbol = value.target.symbol
+                if value is left:
+                    return Condition(condition.op, Load(self.pointers[symbol]), self.bounds[(symbol, other)])
+                return Condition(condition.op, self.bounds[(symbol, other)], Load(self.pointers[symbol]))
+        return Condition(condition.op, self.value(left), self.value(right))
+
+    def commands(self, commands):
+        if commands is None:
+            return None
+        rewritten = []
+        for command in commands:
+            match command:
+                case Assign():
+                    step = increment(command)
+                    if step is not None and command.target.symbol in self.pointers:
+                        pointer = self.pointers[command.target.symbol]
+                        rewritten.append(Assign(pointer, BinOp("add", Load(pointer), Const(step)), command.lineno))
+                    else:
+                        rewritten.append(Assign(self.identifier(command.target), self.expression(command.expr),
+                                                command.lineno))
+                case Read():
+                    rewritten.append(Read(self.identifier(command.target), command.lineno))
+                case Write():
+                    rewritten.append(Write(self.value(command.value), command.lineno))
+                case If():
+                    rewritten.append(If(self.condition(command.condition), self.commands(command.commands),
+                                        self.commands(command.else_commands), command.lineno))
+                case While() | Until():
+                    rewritten.append(type(command)(self.condition(command.condition),
+                                                   self.commands(command.commands), command.lineno))
+                case Inline():
+                    rewritten.append(Inline(command.call, self.commands(command.commands), command.lineno))
+                case _:
+                    rewritten.append(command)
+        return rewritten
@@ -0,0 +1,229 @@
+from structures import Array, Link_T
+from ast_nodes import (Const, Name, Element, Load, BinOp, Condition, Assign, If, While, Until, Read, Write, Call,
+                       Inline, is_array)
+
+# rough instruction counts used to compare a call with the inlined body
+CALL_COST = 12
+ARG_COST = 6
+ACCESS_COST = {Const: 2, Name: 3, Element: 6}
+ARITH_COST = {"add": 1, "sub": 1, "mul": 20, "div": 30, "mod": 30}
+SMALL = 2 * CALL_COST
+
+
+class InlineError(Exception):
+    pass
+
+
+def value_size(value):
+    if type(value) is Load:
+        value = value.target
+    return ACCESS_COST[type(value)]
+
+
+def size(commands):
+    total = 0
+    for command in commands:
+        match command:
+            case Assign():
+                expr = command.expr
+                if type(expr) is BinOp:
+                    total += value_size(expr.left) + value_size(expr.right) + ARITH_COST[expr.op]
+                else:
+                    total += value_size(expr)
+                total += value_size(command.target) + 1
+            case Read() | Write():
+                total += 2 + value_size(command.target if type(command) is Read else command.value)
+            case If():
+                total += size(command.commands) + size(command.else_commands or []) + 4
+            case While() | Until():
+                total += size(command.commands) + 4
+            case Call():
+                total += CALL_COST + ARG_COST * len(command.args)
+            case Inline():
+                total += size(command.commands)
+    return total
+
+
+def calls_in(commands):
+    for command in commands:
+        match command:
+            case Call():
+                yield command
+            case If():
+                yield from calls_in(command.commands)
+                if command.else_commands is not None:
+                    yield from calls_in(command.else_commands)
+            case While() | Until() | Inline():
+                yield from calls_in(command.commands)
+
+
+def call_sites(table):
+    sites = {name: 0 for name in table}
+    for procedure in table.values():
+        for call in calls_in(procedure.commands):
+            sites[call.name] += 1
+    return sites
+
+
+def remove_unused(table, original_sites):
+    # a procedure whose every call was replaced is not generated any more;
+    # procedures that were never called keep being generated as before
+    roots = [name for name in table if name == "PROGRAM" or original_sites.get(name, 0) == 0]
+    reached = set()
+    while roots:
+        name = roots.pop()
+        if name in reached:
+            continue
+        reached.add(name)
+        roots += [call.name for call in calls_in(table[name].commands)]
+    for name in list(table):
+        if name not in reached:
+            del table[name]
+
+
+class Substitution:
+    # copies commands, renaming every identifier through names, which maps a
+    # name to the (name, symbol) pair to use instead
+    def __init__(self, names):
+        self.names = names
+
+    def identifier(self, identifier):
+        name, symbol = self.names[identifier.name]
+        if type(identifier) is Name:
+            return Name(name, symbol)
+        index = identifier.index
+        if type(index) is int:
+            if type(symbol) is Array and not 0 <= index < symbol.size:
+                raise InlineError()
+        else:
+            index = self.identifier(index)
+        return Element(name, symbol, index)
+
+    def value(self, value):
+        if type(value) is Load:
+            return Load(self.identifier(value.target))
+        return value
+
+    def expression(self, expr):
+        if type(expr) is BinOp:
+            return BinOp(expr.op, self.value(expr.left), self.value(expr.right))
+        return self.value(expr)
+
+    def condition(self, condition):
+        return Condition(condition.op, self.value(condition.left), self.value(condition.right))
+
+    def call(self, call):
+        return Call(call.name, call.procedure, [self.identifier(arg) for arg in call.args], call.lineno)
+
+    def commands(self, commands):
+        if commands is None:
+            return None
+        copied = []
+        for command in commands:
+            match command:
+                case Assign():
+                    copied.append(Assign(self.identifier(command.target), self.expression(command.expr),
+                                         command.lineno))
+                case If():
+                    copied.append(If(self.condition(command.condition), self.commands(command.commands),
+                                     self.commands(command.else_commands), command.lineno))
+                case While():
+                    copied.append(While(self.condition(command.condition), self.commands(command.commands),
+                                        command.lineno))
+                case Until():
+                    copied.append(Until(self.condition(command.condition), self.commands(command.commands),
+                                        command.lineno))
+                case Read():
+                    copied.append(Read(self.identifier(command.target), command.lineno))
+                case Write():
+                    copied.append(Write(self.value(command.value), command.lineno))
+                case Call():
+                    copied.append(self.call(command))
+                case Inline():
+                    copied.append(Inline(self.call(command.call), self.commands(command.commands),
+                                         command.lineno))
+        return copied
+
+
+def inline_names(call):
+    # parameters become the arguments of the call, locals keep their memory
+    # (procedures are never active twice at the same time) and are entered
+    # into the caller's symbol table under a name qualified with the procedure
+    names = {}
+    callee = call.procedure
+    for param, arg in zip(callee.links, call.args):
+        if isinstance(callee.links[param], Link_T) != is_array(arg.symbol):
+            raise InlineError()
+        names[param] = (arg.name, arg.symbol)
+    for local, symbol in callee.symbols.items():
+        name = local if "." in local else f"{callee.name}.{local}"
+        names[local] = (name, symbol)
+    return names
+
+
+class Inliner:
+    # procedures are visited in declaration order, so a callee has already
+    # had its own calls inlined when it is copied into its callers
+    def __init__(self, procedures_table, max_growth):
+        self.procedures_table = procedures_table
+        self.max_growth = max_growth
+        self.inlined = 0
+        # changes to the call counts from the calls inlined into the current
+        # procedure, applied once it is done
+        self.changes = []
+
+    def run(self):
+        table = self.procedures_table
+        original_sites = call_sites(table)
+        total = sum(size(procedure.commands) for procedure in table.values())
+        budget = total * self.max_growth / 100
+        sites = dict(original_sites)
+        for name, procedure in table.items():
+            procedure.commands, growth = self.inline_commands(procedure, procedure.commands, sites, budget)
+            budget -= growth
+            for callee, change in self.changes:
+                sites[callee] += change
+            self.changes = []
+        remove_unused(table, original_sites)
+
+    def inline_commands(self, procedure, commands, sites, budget):
+        growth = 0
+        result = []
+        for command in commands:
+            match command:
+                case Call():
+                    callee = command.procedure
+                    callee_size = size(callee.commands)
+                    call_size = CALL_COST + ARG_COST * len(command.args)
+                    cost = callee_size - call_size
+                    if len(command.args) == len(callee.links) and \
+                            (sites[command.name] == 1 or callee_size <= SMALL or cost <= budget - growth):
+                        try:
+                            names = inline_names(command)
+                            body = Substitution(names).commands(callee.commands)
+                        except InlineError:
+                            pass
+                        else:
+                            for name, symbol in names.values():
+                                if "." in name:
+                                    procedure.symbols[name] = symbol
+                            command = Inline(command, body, command.lineno)
+                            growth += cost if sites[command.call.name] > 1 else -call_size
+                            self.inlined += 1
+                            # the call is gone and the calls of the body are new
+                            self.changes.append((command.call.name, -1))
+                            self.changes += [(call.name, 1) for call in calls_in(body)]
+                case If():
+                    command.commands, body_growth = self.inline_commands(procedure, command.commands, sites,
+                                                                         budget - growth)
+                    growth += body_growth
+                    if command.else_commands is not None:
+                        command.else_commands, body_growth = self.inline_commands(
+                            procedure, command.else_commands, sites, budget - growth)
+                        growth += body_growth
+                case While() | Until():
+                    command.commands, body_growth = self.inline_commands(procedure, command.commands, sites,
+                                                                         budget - growth)
+                    growth += body_growth
+            result.append(command)
+        return result, growth
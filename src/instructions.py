@@ -0,0 +1,55 @@
+# opcodes in the order of virtual_machine/instructions.hh
+READ, WRITE, LOAD, STORE, ADD, SUB, GET, PUT, RST, INC, DEC, SHL, SHR, JUMP, JPOS, JZERO, STRK, JUMPR, HALT = range(19)
+# pseudo-instruction marking a jump target, removed by the linker
+LABEL = 19
+
+NAMES = ("READ", "WRITE", "LOAD", "STORE", "ADD", "SUB", "GET", "PUT", "RST", "INC", "DEC", "SHL", "SHR",
+         "JUMP", "JPOS", "JZERO", "STRK", "JUMPR", "HALT")
+OPCODES = {name: op for op, name in enumerate(NAMES)}
+
+REGISTERS = "abcdefgh"
+REGISTER_INDEX = {reg: index for index, reg in enumerate(REGISTERS)}
+A = 0
+
+JUMPS = (JUMP, JPOS, JZERO)
+REGISTER_OPS = frozenset((LOAD, STORE, ADD, SUB, GET, PUT, RST, INC, DEC, SHL, SHR, STRK, JUMPR))
+
+
+class Instruction:
+    # line is the source line the instruction was generated for, it is
+    # carried along for the line table and is not part of the comparison;
+    # origin is set for code of an inlined procedure, see CodeGenerator.inlined
+    __slots__ = ("op", "arg", "line", "origin")
+
+    def __init__(self, op, arg=None, line=None, origin=None):
+        self.op = op
+        self.arg = arg
+        self.line = line
+        self.origin = origin
+
+    def __eq__(self, other):
+        return type(other) is Instruction and self.op == other.op and self.arg == other.arg
+
+    def copy(self):
+        return Instruction(self.op, self.arg, self.line, self.origin)
+
+    def __str__(self):
+        if self.op == LABEL:
+            return f"{self.arg}:"
+        if self.arg is None:
+            return NAMES[self.op]
+        if self.op in REGISTER_OPS:
+            return f"{NAMES[self.op]} {REGISTERS[self.arg]}"
+        return f"{NAMES[self.op]} {self.arg}"
+
+    __repr__ = __str__
+
+
+def parse(line):
+    parts = line.split()
+    op = OPCODES[parts[0]]
+    if len(parts) == 1:
+        return Instruction(op)
+    if op in REGISTER_OPS:
+        return Instruction(op, REGISTER_INDEX[parts[1]])
+    return Instruction(op, int(parts[1]))
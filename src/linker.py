@@ -0,0 +1,31 @@
+from instructions import JUMPS, LABEL, Instruction
+
+
+def is_label(instruction):
+    return instruction.op == LABEL
+
+
+def link(chunks):
+    addresses = {}
+    address = 0
+    for chunk in chunks:
+        for instruction in chunk:
+            if instruction.op == LABEL:
+                addresses[instruction.arg] = address
+            else:
+                address += 1
+
+    linked = []
+    for chunk in chunks:
+        code = []
+        for instruction in chunk:
+            if instruction.op == LABEL:
+                continue
+            if instruction.op in JUMPS:
+                if instruction.arg not in addresses:
+                    raise Exception(f"Undefined label {instruction.arg}")
+                instruction = Instruction(instruction.op, addresses[instruction.arg], instruction.line,
+                                          instruction.origin)
+            code.append(instruction)
+        linked.append(code)
+    return linked, addresses
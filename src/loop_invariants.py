@@ -0,0 +1,136 @@
+from structures import Variable
+from ast_nodes import Const, Name, Element, Load, BinOp, Condition, Assign, If, While, Until, Write, Inline, INVERSE
+from loops import LoopEffects, LoopPass
+
+
+class LoopInvariantMotion(LoopPass):
+    # moves the expressions and array reads of a loop whose operands the
+    # loop never writes into temporaries assigned just before it. Outer
+    # loops are handled first, so an expression goes to the outermost loop
+    # it is invariant in. A WHILE whose body may not run at all becomes
+    # IF cond THEN <temporaries> REPEAT ... UNTIL not cond, the same code
+    # as the rotated loop, so that nothing is computed when it does not run
+    def loop(self, command, assigned, following):
+        effects = LoopEffects(self.local, command.commands)
+        invariant = Invariance(effects, assigned)
+        found = {}
+        invariant.collect_condition(command.condition, found)
+        invariant.collect(command.commands, found)
+        preheader = []
+        names = {}
+        for expr in found:
+            name = self.procedures_table.add_temporary(self.procedure)
+            names[expr] = Name(name, self.procedure.symbols[name])
+            preheader.append(Assign(names[expr], expr, command.lineno))
+        replace = Replacement(names)
+        condition = replace.condition(command.condition)
+        body, body_assigned = self.commands(replace.commands(command.commands),
+                                            assigned | {name.symbol for name in names.values()})
+        if type(command) is Until or not preheader:
+            return preheader, type(command)(condition, body, command.lineno), [], body_assigned
+        inverse = Condition(INVERSE[condition.op], condition.left, condition.right)
+        loop = Until(inverse, body, command.lineno)
+        return [], If(command.condition, preheader + [loop], None, command.lineno), [], body_assigned
+
+
+class Invariance:
+    def __init__(self, effects, assigned):
+        self.effects = effects
+        self.assigned = assigned
+
+    def scalar(self, symbol):
+        if type(symbol) is Variable and symbol not in self.assigned:
+            return False
+        return not self.effects.writes(symbol)
+
+    def value(self, value):
+        if type(value) is Const:
+            return True
+        target = value.target
+        if type(target) is Name:
+            return self.scalar(target.symbol)
+        if self.effects.writes_array(target.symbol):
+            return False
+        return type(target.index) is int or self.scalar(target.index.symbol)
+
+    def expression(self, expr):
+        # worth a temporary: arithmetic on invariant values and array reads
+        # through an invariant index
+        if type(expr) is BinOp:
+            return not (type(expr.left) is Const and type(expr.right) is Const) and \
+                self.value(expr.left) and self.value(expr.right)
+        return type(expr) is Load and type(expr.target) is Element and type(expr.target.index) is Name and \
+            self.value(expr)
+
+    def collect_value(self, value, found):
+        if self.expression(value):
+            found[value] = None
+
+    def collect_condition(self, condition, found):
+        self.collect_value(condition.left, found)
+        self.collect_value(condition.right, found)
+
+    def collect(self, commands, found):
+        for command in commands:
+            match command:
+                case Assign():
+                    expr = command.expr
+                    if self.expression(expr):
+                        found[expr] = None
+                    elif type(expr) is BinOp:
+                        self.collect_value(expr.left, found)
+                        self.collect_value(expr.right, found)
+                case Write():
+                    self.collect_value(command.value, found)
+                case If():
+                    self.collect_condition(command.condition, found)
+                    self.collect(command.commands, found)
+                    self.collect(command.else_commands or [], found)
+                case While() | Until():
+                    self.collect_condition(command.condition, found)
+                    self.collect(command.commands, found)
+                case Inline():
+                    self.collect(command.commands, found)
+
+
+class Replacement:
+    # replaces the hoisted expressions with their temporaries
+    def __init__(self, names):
+        self.names = names
+
+    def value(self, value):
+        if value in self.names:
+            return Load(self.names[value])
+        return value
+
+    def expression(self, expr):
+        if expr in self.names:
+            return Load(self.names[expr])
+        if type(expr) is BinOp:
+            return BinOp(expr.op, self.value(expr.left), self.value(expr.right))
+        return self.value(expr)
+
+    def condition(self, condition):
+        return Condition(condition.op, self.value(condition.left), self.value(condition.right))
+
+    def commands(self, commands):
+        if commands is None:
+            return None
+        replaced = []
+        for command in commands:
+            match command:
+                case Assign():
+                    replaced.append(Assign(command.target, self.expression(command.expr), command.lineno))
+                case Write():
+                    replaced.append(Write(self.value(command.value), command.lineno))
+                case If():
+                    replaced.append(If(self.condition(command.condition), self.commands(command.commands),
+                                       self.commands(command.else_commands), command.lineno))
+                case While() | Until():
+                    replaced.append(type(command)(self.condition(command.condition), self.commands(command.commands),
+                                                  command.lineno))
+                case Inline():
+                    replaced.append(Inline(command.call, self.commands(command.commands), command.lineno))
+                case _:
+                    replaced.append(command)
+        return replaced
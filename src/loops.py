@@ -0,0 +1,121 @@
+from abc import ABC, abstractmethod
+
+from structures import Variable, Link, Array, Link_T
+from ast_nodes import Name, Assign, If, While, Until, Read, Call, Inline
+
+
+class LoopEffects:
+    # what the commands of a loop may write. Parameters may alias each
+    # other, and a call may write its arguments, the caller's variables
+    # bound in a specialized callee and the memory of any procedure it
+    # shares with an inlined body
+    def __init__(self, local, commands):
+        self.local = local
+        self.scalars = set()
+        self.arrays = set()
+        self.links = False
+        self.link_arrays = False
+        self.calls = False
+        self.passed = set()
+        self.scan(commands)
+
+    def scan(self, commands):
+        for command in commands:
+            match command:
+                case Assign() | Read():
+                    self.scan_target(command.target)
+                case If():
+                    self.scan(command.commands)
+                    self.scan(command.else_commands or [])
+                case While() | Until() | Inline():
+                    self.scan(command.commands)
+                case Call():
+                    self.calls = True
+                    self.passed.update(arg.symbol for arg in command.args)
+                    self.passed.update(command.procedure.bindings.values())
+
+    def scan_target(self, target):
+        if type(target) is Name:
+            self.scalars.add(target.symbol)
+            self.links |= type(target.symbol) is Link
+        else:
+            self.arrays.add(target.symbol)
+            self.link_arrays |= type(target.symbol) is Link_T
+
+    def called(self, symbol):
+        return self.calls and (symbol not in self.local or symbol in self.passed)
+
+    def writes(self, symbol):
+        if type(symbol) is Link:
+            return self.links or self.called(symbol)
+        return symbol in self.scalars or self.called(symbol)
+
+    def writes_array(self, symbol):
+        if type(symbol) is Link_T:
+            return self.link_arrays or self.called(symbol)
+        return symbol in self.arrays or self.called(symbol)
+
+
+class LoopPass(ABC):
+    # walks the commands of a procedure and lets loop() rewrite every loop,
+    # outer loops first, into the commands to run before it, the new loop
+    # and the commands to run after it. Variables a rewritten loop reads
+    # before it must be set on every path to it, as the generator refuses
+    # to read unset variables outside of loops.
+    # What runs after a command is passed along as following: None when it
+    # is not known (inside a loop body or at the end of a procedure, whose
+    # locals keep their values), () at the end of the program, or a tuple
+    # (commands, start, following) for commands[start:] and what follows
+    def __init__(self, procedures_table, procedure):
+        self.procedures_table = procedures_table
+        self.procedure = procedure
+        self.local = {symbol for name, symbol in procedure.symbols.items()
+                      if type(symbol) in (Variable, Array) and "." not in name and name not in procedure.bindings}
+
+    def run(self):
+        bound = {symbol for symbol in self.procedure.bindings.values() if type(symbol) is Variable}
+        end = () if self.procedure.name == "PROGRAM" else None
+        self.procedure.commands, _ = self.commands(self.procedure.commands, bound, end)
+
+    def commands(self, commands, assigned, following=None):
+        # returns the new commands and the variables set on every path
+        # through them
+        assigned = set(assigned)
+        result = []
+        for k, command in enumerate(commands):
+            rest = (commands, k + 1, following)
+            match command:
+                case Assign() | Read():
+                    result.append(command)
+                    if type(command.target) is Name:
+                        assigned.add(command.target.symbol)
+                case If():
+                    body, then_assigned = self.commands(command.commands, assigned, rest)
+                    else_body, else_assigned = self.commands(command.else_commands or [], assigned, rest)
+                    if command.else_commands is None:
+                        else_body = None
+                    result.append(If(command.condition, body, else_body, command.lineno))
+                    assigned = then_assigned & else_assigned
+                case While() | Until():
+                    before, loop, after, body_assigned = self.loop(command, assigned, rest)
+                    result += before
+                    result.append(loop)
+                    result += after
+                    assigned |= {assign.target.symbol for assign in before + after}
+                    if type(command) is Until:
+                        assigned |= body_assigned
+                case Inline():
+                    # the arguments of an inlined call are exempt from the check
+                    arguments = {arg.symbol for arg in command.call.args} - assigned
+                    body, assigned = self.commands(command.commands, assigned | arguments, rest)
+                    assigned -= arguments
+                    result.append(Inline(command.call, body, command.lineno))
+                case _:
+                    result.append(command)
+        return result, assigned
+
+    @abstractmethod
+    def loop(self, command, assigned, following):
+        # returns (commands before, new loop, commands after, variables set
+        # on every path through the body)
+        pass
@@ -0,0 +1,193 @@
+import random
+import sys
+
+from instructions import (READ, WRITE, LOAD, STORE, ADD, SUB, GET, PUT, RST, INC, DEC, SHL, SHR,
+                          JUMP, JPOS, JZERO, STRK, JUMPR, HALT, JUMPS, Instruction, parse)
+
+# marks the position after the last instruction, running into it is an error
+END = HALT + 1
+
+
+class Result:
+    def __init__(self, output, t, io, steps):
+        self.output = output
+        self.t = t
+        self.io = io
+        self.steps = steps
+
+    @property
+    def cost(self):
+        return self.t + self.io
+
+
+def decode(lines):
+    ops, args = [], []
+    for line in lines:
+        if type(line) is Instruction:
+            instruction = line
+        else:
+            line = line.split("#", 1)[0].strip()
+            if not line:
+                continue
+            instruction = parse(line)
+        ops.append(instruction.op)
+        args.append(instruction.arg if instruction.arg is not None else 0)
+    for i, op in enumerate(ops):
+        if op in JUMPS and not 0 <= args[i] < len(ops):
+            raise Exception(f"Jump to nonexistent instruction {args[i]} in instruction {i}")
+    ops.append(END)
+    args.append(0)
+    return ops, args
+
+
+def load(path):
+    with open(path) as in_f:
+        return Machine(in_f)
+
+
+def check_limit(max_steps):
+    if max_steps is not None and max_steps <= 0:
+        raise Exception(f"Step limit must be positive, got {max_steps}")
+
+
+class Machine:
+    def __init__(self, code):
+        self.ops, self.args = decode(code)
+
+    def __len__(self):
+        return len(self.ops) - 1
+
+    def random_registers(self):
+        return [random.randrange(2 ** 31) for _ in range(8)]
+
+    def run(self, inputs=(), registers=None, max_steps=None, trace=None):
+        # same semantics and t/io accounting as run_machine in virtual_machine/mw.cc,
+        # memory is a dict so unset cells read as 0 like the std::map there;
+        # trace, if given, is called with the address of every executed instruction;
+        # max_steps limits the number of instructions executed before HALT
+        check_limit(max_steps)
+        ops, args = self.ops, self.args
+        size = len(ops) - 1
+        inputs = iter(inputs)
+        output = []
+        memory = {}
+        r = list(registers) if registers is not None else self.random_registers()
+        limit = max_steps if max_steps is not None else float("inf")
+        lr = t = io = steps = 0
+        while True:
+            op = ops[lr]
+            x = args[lr]
+            steps += 1
+            if trace is not None:
+                trace(lr)
+            if steps > limit and op != HALT:
+                raise Exception(f"Step limit {max_steps} reached at instruction {lr}")
+            if op == INC:
+                r[x] += 1
+                t += 1
+                lr += 1
+            elif op == GET:
+                r[0] = r[x]
+                t += 1
+                lr += 1
+            elif op == PUT:
+                r[x] = r[0]
+                t += 1
+                lr += 1
+            elif op == JZERO:
+                lr = x if r[0] == 0 else lr + 1
+                t += 1
+            elif op == JPOS:
+                lr = x if r[0] > 0 else lr + 1
+                t += 1
+            elif op == JUMP:
+                lr = x
+                t += 1
+            elif op == ADD:
+                r[0] += r[x]
+                t += 5
+                lr += 1
+            elif op == SUB:
+                r[0] = r[0] - r[x] if r[0] >= r[x] else 0
+                t += 5
+                lr += 1
+            elif op == DEC:
+                if r[x] > 0:
+                    r[x] -= 1
+                t += 1
+                lr += 1
+            elif op == SHR:
+                r[x] >>= 1
+                t += 1
+                lr += 1
+            elif op == SHL:
+                r[x] <<= 1
+                t += 1
+                lr += 1
+            elif op == LOAD:
+                r[0] = memory.get(r[x], 0)
+                t += 50
+                lr += 1
+            elif op == STORE:
+                memory[r[x]] = r[0]
+                t += 50
+                lr += 1
+            elif op == RST:
+                r[x] = 0
+                t += 1
+                lr += 1
+            elif op == STRK:
+                r[x] = lr
+                t += 1
+                lr += 1
+            elif op == JUMPR:
+                lr = r[x]
+                t += 1
+                if not 0 <= lr < size:
+                    raise Exception(f"Jump to nonexistent instruction {lr}")
+            elif op == READ:
+                try:
+                    r[0] = next(inputs)
+                except StopIteration:
+                    raise Exception(f"No input left for READ at instruction {lr}") from None
+                io += 100
+                lr += 1
+            elif op == WRITE:
+                output.append(r[0])
+                io += 100
+                lr += 1
+            elif op == HALT:
+                return Result(output, t, io, steps - 1)
+            else:
+                raise Exception(f"Jump to nonexistent instruction {lr}")
+
+
+def run(code, inputs=(), registers=None, max_steps=None):
+    return Machine(code).run(inputs, registers, max_steps)
+
+
+def read_stdin():
+    while True:
+        print("? ", end="", flush=True)
+        line = sys.stdin.readline()
+        if not line:
+            return
+        yield int(line)
+
+
+if __name__ == "__main__":
+    arguments = [argument for argument in sys.argv[1:] if not argument.startswith("--")]
+    if not arguments:
+        print("usage: machine.py <program.mr> [--blocks] [inputs...]")
+        sys.exit(2)
+    if "--blocks" in sys.argv:
+        from block_machine import BlockMachine
+        with open(arguments[0]) as in_f:
+            machine = BlockMachine(in_f)
+    else:
+        machine = load(arguments[0])
+    inputs = [int(value) for value in arguments[1:]] if len(arguments) > 1 else read_stdin()
+    result = machine.run(inputs)
+    for value in result.output:
+        print(f"> {value}")
+    print(f"cost: {result.cost} (io: {result.io}), {result.steps} instructions executed")
@@ -0,0 +1,62 @@
+import hashlib
+import os
+import pickle
+from types import SimpleNamespace
+
+import sly
+from sly.yacc import YaccError
+
+CACHE_FILE = os.environ.get(
+    "IMP_PARSER_TABLES",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "__pycache__", "imp_parser.tables"))
+
+
+def grammar_key(parser, rules):
+    parts = [sly.__version__, repr(sorted(parser.tokens)), repr(getattr(parser, "precedence", ())),
+             repr(getattr(parser, "start", None))]
+    for name, func in rules:
+        while func is not None:
+            parts.append(f"{name}: {func.rules}")
+            func = getattr(func, "next_func", None)
+    return hashlib.sha256("\n".join(parts).encode()).hexdigest()
+
+
+def load_tables(key):
+    try:
+        with open(CACHE_FILE, "rb") as f:
+            data = pickle.load(f)
+        if data["key"] != key:
+            return None
+        return SimpleNamespace(lr_action=data["action"], lr_goto=data["goto"], defaulted_states=data["defaulted"])
+    except Exception:
+        return None
+
+
+def save_tables(key, table):
+    data = {"key": key, "action": table.lr_action, "goto": table.lr_goto, "defaulted": table.defaulted_states}
+    try:
+        os.makedirs(os.path.dirname(CACHE_FILE), exist_ok=True)
+        temporary = f"{CACHE_FILE}.{os.getpid()}"
+        with open(temporary, "wb") as f:
+            pickle.dump(data, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(temporary, CACHE_FILE)
+    except OSError:
+        pass
+
+
+def build_parser(parser, definitions):
+    # same steps as sly's Parser._build, except that the LALR tables are
+    # read from the cache when the grammar has not changed since they were
+    # written; the production list is cheap and always rebuilt because its
+    # entries hold the rule functions
+    rules = [(name, value) for name, value in definitions if callable(value) and hasattr(value, "rules")]
+    if not parser._Parser__validate_specification():
+        raise YaccError("Invalid parser specification")
+    parser._Parser__build_grammar(rules)
+    key = grammar_key(parser, rules)
+    tables = load_tables(key)
+    if tables is None:
+        parser._Parser__build_lrtables()
+        save_tables(key, parser._lrtable)
+    else:
+        parser._lrtable = tables
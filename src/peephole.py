@@ -0,0 +1,396 @@
+import bisect
+import heapq
+
+from instructions import (READ, WRITE, LOAD, STORE, ADD, SUB, GET, PUT, RST, INC, DEC, SHL, SHR, JUMP, JPOS,
+                          JZERO, STRK, JUMPR, HALT, LABEL, NAMES, JUMPS, A, Instruction)
+
+COSTS = [1] * len(NAMES)
+COSTS[READ] = COSTS[WRITE] = 100
+COSTS[LOAD] = COSTS[STORE] = 50
+COSTS[ADD] = COSTS[SUB] = 5
+PURE = frozenset((GET, PUT, RST, INC, DEC, SHL, SHR, LOAD, ADD, SUB))
+CHAIN = (INC, SHL)
+
+
+def instruction_cost(op):
+    return COSTS[op]
+
+
+def static_cost(code):
+    return sum(COSTS[instruction.op] for instruction in code if instruction.op != LABEL)
+
+
+def uses_defs(op, arg):
+    if op == READ:
+        return (), (A,)
+    if op in (WRITE, JPOS, JZERO):
+        return (A,), ()
+    if op in (LOAD, GET):
+        return (arg,), (A,)
+    if op == STORE:
+        return (A, arg), ()
+    if op in (ADD, SUB):
+        return (A, arg), (A,)
+    if op == PUT:
+        return (A,), (arg,)
+    if op in (RST, STRK):
+        return (), (arg,)
+    if op in (INC, DEC, SHL, SHR):
+        return (arg,), (arg,)
+    if op == JUMPR:
+        return (arg,), ()
+    return (), ()
+
+
+def copy_state(state):
+    known, copies, cells = state
+    return dict(known), set(copies), {address: set(holders) for address, holders in cells.items()}
+
+
+def meet_state(state, other):
+    known = {reg: value for reg, value in state[0].items() if other[0].get(reg) == value}
+    cells = {}
+    for address, holders in state[2].items():
+        common = holders & other[2].get(address, set())
+        if common:
+            cells[address] = common
+    return known, state[1] & other[1], cells
+
+
+def apply(op, value):
+    if op == RST:
+        return 0
+    if op == INC:
+        return value + 1
+    if op == DEC:
+        return max(0, value - 1)
+    if op == SHL:
+        return value << 1
+    if op == SHR:
+        return value >> 1
+
+
+class Peephole:
+    def __init__(self, code, forward_loads=False):
+        self.code = [instruction.copy() for instruction in code]
+        self.mapping = list(range(len(self.code) + 1))
+        self.forward_loads = forward_loads
+
+    def optimize(self, max_passes=20):
+        for _ in range(max_passes):
+            changed = self.remove_unreachable()
+            changed |= self.thread_jumps()
+            changed |= self.local_rewrites()
+            changed |= self.remove_dead_definitions()
+            if not changed:
+                break
+        return self.code
+
+    # control flow
+
+    def analyze(self):
+        n = len(self.code)
+        self.targets = {0}
+        self.pinned = set()
+        calls = []
+        exits = []
+        for i, instruction in enumerate(self.code):
+            if instruction.op in JUMPS:
+                self.targets.add(instruction.arg)
+            if instruction.op == JUMPR:
+                exits.append(i)
+            elif instruction.op == STRK:
+                # return address is computed from the STRK position, so the
+                # whole call sequence up to its JUMP must keep its length
+                j = i + 1
+                while j < n and self.code[j].op != JUMP:
+                    j += 1
+                self.pinned.update(range(i, j + 1))
+                self.targets.add(j + 1)
+                if j < n:
+                    calls.append((self.code[j].arg, j + 1))
+        # every procedure and routine ends with its only JUMPR, so a call
+        # returns through the first JUMPR at or after the address it jumps to
+        self.return_points = {}
+        for target, return_point in calls:
+            k = bisect.bisect_left(exits, target)
+            if k < len(exits):
+                self.return_points.setdefault(exits[k], []).append(return_point)
+
+    def successors(self, i):
+        op, arg = self.code[i].op, self.code[i].arg
+        if op == JUMP:
+            return [arg]
+        if op in (JPOS, JZERO):
+            return [arg, i + 1]
+        if op == JUMPR:
+            return self.return_points.get(i, [])
+        if op == HALT:
+            return []
+        return [i + 1]
+
+    def commit(self, removed, replaced=None):
+        if not removed and not replaced:
+            return False
+        if replaced:
+            for i, instruction in replaced.items():
+                if instruction.line is None:
+                    instruction.line = self.code[i].line
+                    instruction.origin = self.code[i].origin
+                self.code[i] = instruction
+        n = len(self.code)
+        new_index = [0] * (n + 1)
+        kept = []
+        for i in range(n):
+            new_index[i] = len(kept)
+            if i not in removed:
+                kept.append(self.code[i])
+        new_index[n] = len(kept)
+        for instruction in kept:
+            if instruction.op in JUMPS:
+                instruction.arg = new_index[instruction.arg]
+        self.code = kept
+        self.mapping = [new_index[i] for i in self.mapping]
+        return True
+
+    # passes
+
+    def remove_unreachable(self):
+        self.analyze()
+        n = len(self.code)
+        reached = set()
+        stack = [0]
+        while stack:
+            i = stack.pop()
+            if i in reached or i >= n:
+                continue
+            reached.add(i)
+            stack.extend(self.successors(i))
+        return self.commit(set(range(n)) - reached)
+
+    def thread_jumps(self):
+        # a jump that lands on another jump goes straight to where that one
+        # goes: always for JUMP, for the same conditional jump (a has not
+        # changed), and past the opposite one, which cannot be taken
+        n = len(self.code)
+        replaced = {}
+        for i, instruction in enumerate(self.code):
+            op = instruction.op
+            if op not in (JUMP, JPOS, JZERO):
+                continue
+            target, seen = instruction.arg, {i}
+            while target < n and target not in seen:
+                seen.add(target)
+                landed = self.code[target]
+                if landed.op == JUMP or landed.op == op and op != JUMP:
+                    target = landed.arg
+                elif op != JUMP and landed.op in (JPOS, JZERO):
+                    target += 1
+                else:
+                    break
+            if target != instruction.arg:
+                replaced[i] = Instruction(op, target)
+        return self.commit(set(), replaced)
+
+    def local_rewrites(self):
+        self.analyze()
+        entry = self.entry_states()
+        removed = set()
+        replaced = {}
+        known = {}
+        copies = set()
+        # memory cells whose value some registers still hold, by address
+        cells = {}
+        i = 0
+        n = len(self.code)
+        while i < n:
+            op, arg = self.code[i].op, self.code[i].arg
+            if i in self.targets:
+                known, copies, cells = copy_state(entry.get(i, ({}, set(), {})))
+            if i in self.pinned:
+                self.track(op, arg, known, copies, cells)
+                i += 1
+                continue
+            nxt = self.code[i + 1] if i + 1 < n else Instruction(None)
+            free_next = i + 1 < n and i + 1 not in self.targets and i + 1 not in self.pinned
+
+            if op in JUMPS and arg == i + 1:
+                removed.add(i)
+            elif op == LOAD and self.forward_loads and arg in known and known[arg] in cells:
+                # the cell was stored or loaded before and is still in a register
+                holders = cells[known[arg]]
+                if A in holders:
+                    removed.add(i)
+                else:
+                    replaced[i] = Instruction(GET, min(holders))
+                    self.track(GET, min(holders), known, copies, cells)
+                i += 1
+                continue
+            elif op in (JZERO, JPOS) and arg == i + 2 and nxt.op == JUMP and free_next:
+                # values are never negative, so JPOS is exactly "not zero"
+                replaced[i] = Instruction(JPOS if op == JZERO else JZERO, nxt.arg)
+                removed.add(i + 1)
+                i += 2
+                continue
+            elif op == RST:
+                j, value = i + 1, 0
+                while j < n and j not in self.targets and j not in self.pinned \
+                        and self.code[j].op in CHAIN and self.code[j].arg == arg:
+                    value = apply(self.code[j].op, value)
+                    j += 1
+                if known.get(arg) == value:
+                    removed.update(range(i, j))
+                    i = j
+                    continue
+            elif op == GET and (arg in copies or (arg in known and known.get(A) == known[arg])):
+                removed.add(i)
+                i += 1
+                continue
+            elif op == PUT and (arg in copies or (arg in known and known.get(A) == known[arg])):
+                removed.add(i)
+                i += 1
+                continue
+            elif op == INC and nxt.op == DEC and nxt.arg == arg and free_next:
+                removed.update((i, i + 1))
+                i += 2
+                continue
+            self.track(op, arg, known, copies, cells)
+            i += 1
+        return self.commit(removed, replaced)
+
+    def entry_states(self):
+        # what local_rewrites knows at each jump target: the facts that hold
+        # on every path reaching it, iterated around loops until they stop
+        # shrinking. The rewrites keep every register value, so the facts
+        # stay true in the rewritten code
+        n = len(self.code)
+        states = {0: ({}, set(), {})}
+        pending = [0]
+
+        def flow(target, state):
+            if target >= n:
+                return
+            met = meet_state(states[target], state) if target in states else copy_state(state)
+            if states.get(target) != met:
+                states[target] = met
+                heapq.heappush(pending, target)
+
+        while pending:
+            start = heapq.heappop(pending)
+            while pending and pending[0] == start:
+                heapq.heappop(pending)
+            known, copies, cells = copy_state(states[start])
+            i = start
+            while i < n:
+                op, arg = self.code[i].op, self.code[i].arg
+                if op == JUMP:
+                    flow(arg, (known, copies, cells))
+                    break
+                if op == JUMPR:
+                    for target in self.return_points.get(i, []):
+                        flow(target, ({}, set(), {}))
+                    break
+                if op == HALT:
+                    break
+                self.track(op, arg, known, copies, cells)
+                if op in (JPOS, JZERO):
+                    flow(arg, (known, copies, cells))
+                i += 1
+                if i in self.targets:
+                    flow(i, (known, copies, cells))
+                    break
+        return states
+
+    def track(self, op, arg, known, copies, cells):
+        self.track_cells(op, arg, known, copies, cells)
+        if op in (JUMP, JUMPR, HALT):
+            known.clear()
+            copies.clear()
+            return
+        if op == GET:
+            copies.clear()
+            copies.add(arg)
+            if arg in known:
+                known[A] = known[arg]
+            else:
+                known.pop(A, None)
+            return
+        if op == PUT:
+            copies.add(arg)
+            if A in known:
+                known[arg] = known[A]
+            else:
+                known.pop(arg, None)
+            return
+        _, defs = uses_defs(op, arg)
+        for reg in defs:
+            if reg == A:
+                copies.clear()
+            else:
+                copies.discard(reg)
+        if op in (RST, INC, DEC, SHL, SHR) and (op == RST or arg in known):
+            known[arg] = apply(op, known.get(arg, 0))
+        elif op in (ADD, SUB) and A in known and arg in known:
+            known[A] = known[A] + known[arg] if op == ADD else max(0, known[A] - known[arg])
+        else:
+            for reg in defs:
+                known.pop(reg, None)
+
+    def track_cells(self, op, arg, known, copies, cells):
+        # runs before known and copies are updated for the instruction
+        if op in (JUMP, JUMPR, HALT):
+            cells.clear()
+            return
+        if op == STORE:
+            if arg in known:
+                cells[known[arg]] = {A} | copies
+            else:
+                # any cell may have been written
+                cells.clear()
+            return
+        _, defs = uses_defs(op, arg)
+        if not defs:
+            return
+        address = known.get(arg) if op == LOAD else None
+        for address_held, holders in list(cells.items()):
+            if op == GET and arg in holders:
+                holders.add(A)
+            elif op == PUT and A in holders:
+                holders.add(arg)
+            else:
+                holders.difference_update(defs)
+            if not holders:
+                del cells[address_held]
+        if address is not None:
+            cells.setdefault(address, set()).add(A)
+
+    def remove_dead_definitions(self):
+        self.analyze()
+        n = len(self.code)
+        masks = [uses_defs(instruction.op, instruction.arg) for instruction in self.code]
+        uses = [sum(1 << r for r in set(u)) for u, _ in masks]
+        defs = [sum(1 << r for r in set(d)) for _, d in masks]
+        succ = [[s for s in self.successors(i) if s < n] for i in range(n)]
+        # a removable instruction whose result is dead does not keep its
+        # operands live, so a whole dead chain like RST, INC, SHL goes at once
+        removable = [instruction.op in PURE and i not in self.pinned for i, instruction in enumerate(self.code)]
+        live_in = [0] * n
+        live_out = [0] * n
+        changed = True
+        while changed:
+            changed = False
+            for i in range(n - 1, -1, -1):
+                out = 0
+                for s in succ[i]:
+                    out |= live_in[s]
+                used = uses[i] if defs[i] & out or not removable[i] else 0
+                new_in = used | (out & ~defs[i])
+                if out != live_out[i] or new_in != live_in[i]:
+                    live_out[i] = out
+                    live_in[i] = new_in
+                    changed = True
+        removed = set()
+        for i, instruction in enumerate(self.code):
+            if removable[i] and not defs[i] & live_out[i]:
+                removed.add(i)
+        return self.commit(removed)
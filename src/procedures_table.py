@@ -1,12 +1,36 @@
 from code_generator import CodeGenerator
+from structures import Variable
+from peephole import Peephole, static_cost
+from linker import link
+from inliner import Inliner
+from specializer import Specializer
+from const_propagation import ConstantPropagation
+from unroll import LoopUnrolling
+from cse import CommonSubexpressions
+from loop_invariants import LoopInvariantMotion
+from induction import InductionVariables
+from value_ranges import ValueRanges
+from instructions import JUMP, Instruction
 
 class ProcedureList(dict):
     def __init__(self):
         super().__init__()
         self.memory_offset = 0
-        self.current_line = 0
-        self.first_line = ''
+        self.first_line = None
         self.code = []
+        self.peephole_report = []
+        self.arith_mode = "inline"
+        self.routines = {}
+        self.inline_growth = None
+        self.max_clones = 0
+        self.const_prop = False
+        self.unroll_size = 0
+        self.licm = False
+        self.induction = False
+        self.ranges = False
+        self.cse = False
+        self.warnings = []
+        self.temporaries = 0
 
     def add_procedure(self, procedure):
         if procedure.name in self:
@@ -14,19 +38,86 @@ class ProcedureList(dict):
         self.setdefault(procedure.name, procedure)
         self.memory_offset = procedure.last_index
 
-    def gen_first_jump(self):
-        self.first_line = f"JUMP start"
-        self.current_line += 1
+    def add_temporary(self, procedure):
+        name = f"tmp{self.temporaries}"
+        procedure.symbols[name] = Variable(self.memory_offset)
+        self.temporaries += 1
+        self.memory_offset += 1
+        return name
 
-    def update_first_jump(self):
-        first_line = self["PROGRAM"].first_line
-        self.first_line = self.first_line.replace('start', str(first_line))
+    def gen_first_jump(self):
+        self.first_line = Instruction(JUMP, "PROGRAM")
 
     def gen_code(self):
+        if self.inline_growth is not None:
+            Inliner(self, self.inline_growth).run()
+        if self.max_clones:
+            Specializer(self, self.max_clones).run()
+        if self.const_prop:
+            for name in self:
+                if self.unroll_size:
+                    LoopUnrolling(self, self[name], self.unroll_size).run()
+                else:
+                    ConstantPropagation(self[name]).run()
+        if self.licm:
+            for name in self:
+                LoopInvariantMotion(self, self[name]).run()
+        if self.cse:
+            for name in self:
+                CommonSubexpressions(self, self[name]).run()
+        if self.induction:
+            for name in self:
+                InductionVariables(self, self[name]).run()
+        if self.ranges:
+            # last, so the expressions it records are the ones generated
+            for name in self:
+                ValueRanges(self[name]).run()
         codeGenerator = CodeGenerator()
+        codeGenerator.arith_mode = self.arith_mode
+        for name in self:
+            codeGenerator.count_routine_sites(self[name].commands)
         for name in self:
-            self[name].first_line = self.current_line
             codeGenerator.gen_procedure_code(name, self)
             self.code.append(codeGenerator.code)
-            self.current_line += len(codeGenerator.code)
-            
\ No newline at end of file
+        for kind in sorted(codeGenerator.used_routines):
+            codeGenerator.gen_routine_code(kind)
+            self.code.append(codeGenerator.code)
+            self.routines[kind] = None
+        self.warnings = codeGenerator.warnings
+        self.link()
+
+    def link(self):
+        linked, addresses = link([[self.first_line]] + self.code)
+        self.first_line = linked[0][0]
+        self.code = linked[1:]
+        for name in self:
+            self[name].first_line = addresses[name]
+        for kind in self.routines:
+            self.routines[kind] = addresses[kind.upper()]
+
+    def optimize(self):
+        names = list(self) + sorted(self.routines)
+        program = [self.first_line]
+        starts = [0]
+        for procedure_code in self.code:
+            starts.append(len(program))
+            program += procedure_code
+        starts.append(len(program))
+
+        peephole = Peephole(program, forward_loads=self.cse)
+        optimized = peephole.optimize()
+        mapping = peephole.mapping
+
+        self.first_line = optimized[0] if mapping[1] == 1 else None
+        self.code = []
+        self.peephole_report = []
+        for k, name in enumerate(names):
+            old_start, old_end = starts[k + 1], starts[k + 2]
+            new_start, new_end = mapping[old_start], mapping[old_end]
+            if name in self:
+                self[name].first_line = new_start
+            else:
+                self.routines[name] = new_start
+            self.code.append(optimized[new_start:new_end])
+            self.peephole_report.append(
+                (name, static_cost(program[old_start:old_end]), static_cost(self.code[-1])))
@@ -0,0 +1,142 @@
+import sys
+
+from instructions import READ, WRITE, LOAD, STORE, JUMP, JPOS, JZERO, STRK, JUMPR, HALT
+from peephole import COSTS
+from machine import Machine
+from compiler import compile, parse_options
+
+CATEGORIES = ("memory", "arithmetic", "jumps", "io")
+
+
+def category(op):
+    if op in (LOAD, STORE):
+        return 0
+    if op in (JUMP, JPOS, JZERO, STRK, JUMPR):
+        return 2
+    if op in (READ, WRITE):
+        return 3
+    return 1
+
+
+class Profile:
+    def __init__(self, program, result, counts):
+        self.program = program
+        self.result = result
+        # (call stack, address) -> number of executions; the call stack has
+        # for every call that is still active its frames, a (procedure, line)
+        # for each inlined call the call was made from and one for the call
+        self.counts = counts
+
+    def cost(self, address, count):
+        op = self.program.code[address].op
+        if op == HALT:
+            return 0
+        return count * COSTS[op]
+
+    def totals(self):
+        totals = [0] * len(CATEGORIES)
+        for (_, address), count in self.counts.items():
+            totals[category(self.program.code[address].op)] += self.cost(address, count)
+        return totals
+
+    def lines(self):
+        lines = {}
+        for (_, address), count in self.counts.items():
+            entry = lines.setdefault(self.program.lines[address], [0] * (len(CATEGORIES) + 1))
+            entry[category(self.program.code[address].op)] += self.cost(address, count)
+            entry[-1] += count
+        return lines
+
+    def collapsed(self):
+        stacks = {}
+        for (stack, address), count in self.counts.items():
+            cost = self.cost(address, count)
+            if cost:
+                callers = [caller for call in stack for caller in call]
+                callers += self.program.inlined[address] + (self.program.lines[address],)
+                frames = ";".join(frame(*caller) for caller in callers)
+                stacks[frames] = stacks.get(frames, 0) + cost
+        return stacks
+
+    def report(self, source_lines=None, top=20):
+        result = self.result
+        totals = self.totals()
+        parts = ", ".join(f"{name} {cost}" for name, cost in zip(CATEGORIES, totals))
+        print(f"cost {result.cost} ({parts}), {result.steps} instructions executed")
+        print(f"{'line':>6} {'cost':>10} {'%':>6} {'memory':>10} {'arith':>10} {'jumps':>10} {'io':>8} "
+              f"{'instrs':>9}  procedure")
+        rows = sorted(self.lines().items(), key=lambda item: -sum(item[1][:-1]))
+        for (name, line), entry in rows[:top]:
+            cost = sum(entry[:-1])
+            share = 100 * cost / result.cost if result.cost else 0
+            text = ""
+            if source_lines and line is not None and line <= len(source_lines):
+                text = "  " + source_lines[line - 1].strip()
+            print(f"{'-' if line is None else line:>6} {cost:>10} {share:>6.1f} {entry[0]:>10} {entry[1]:>10} "
+                  f"{entry[2]:>10} {entry[3]:>8} {entry[4]:>9}  {name}{text}")
+
+    def write_collapsed(self, path):
+        with open(path, 'w') as out_f:
+            for frames, cost in sorted(self.collapsed().items()):
+                print(f"{frames} {cost}", file=out_f)
+
+
+def frame(name, line):
+    return name if line is None else f"{name}:{line}"
+
+
+def profile(program, inputs=(), registers=None, max_steps=None):
+    machine = Machine(program.code)
+    ops, args = machine.ops, machine.args
+    entries = program.entries()
+    # the procedure every instruction was generated in
+    owners = [frames[0][0] if frames else name for (name, _), frames in zip(program.lines, program.inlined)]
+    counts = {}
+    stack = ()
+
+    def trace(lr):
+        nonlocal stack
+        key = (stack, lr)
+        counts[key] = counts.get(key, 0) + 1
+        op = ops[lr]
+        if op == JUMP:
+            callee = entries.get(args[lr])
+            if callee is not None and callee != owners[lr]:
+                stack = stack + (program.inlined[lr] + (program.lines[lr],),)
+        elif op == JUMPR:
+            stack = stack[:-1]
+
+    result = machine.run(inputs, registers, max_steps, trace)
+    return Profile(program, result, counts)
+
+
+def main(argv):
+    arguments = [argument for argument in argv[1:] if not argument.startswith("--")]
+    options = [argument for argument in argv[1:] if argument.startswith("--")]
+    if not arguments:
+        print("usage: profiler.py <program.imp> [inputs...] [--top=N] [--collapsed=file] [compiler options]")
+        return 2
+    top = 20
+    collapsed = None
+    compiler_options = []
+    for option in options:
+        if option.startswith("--top="):
+            top = int(option.split("=", 1)[1])
+        elif option.startswith("--collapsed="):
+            collapsed = option.split("=", 1)[1]
+        else:
+            compiler_options.append(option)
+
+    with open(arguments[0]) as in_f:
+        source = in_f.read()
+    program = compile(source, **parse_options(compiler_options))
+    result = profile(program, [int(value) for value in arguments[1:]])
+    print("output:", " ".join(str(value) for value in result.result.output))
+    result.report(source.splitlines(), top)
+    if collapsed:
+        result.write_collapsed(collapsed)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
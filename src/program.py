@@ -0,0 +1,43 @@
+class Program:
+    def __init__(self, procedures_table):
+        self.procedures_table = procedures_table
+        self.code = []
+        # (procedure, source line) for every instruction, line is None for code
+        # that belongs to no statement (procedure return, shared routines);
+        # the procedure is the one the line is in, which for inlined code is
+        # not the one generated
+        self.lines = []
+        # the inlined calls every instruction comes from, as (procedure, line
+        # of the call) from the outermost one
+        self.inlined = []
+        if procedures_table.first_line:
+            self.code.append(procedures_table.first_line)
+            self.lines.append(("PROGRAM", None))
+            self.inlined.append(())
+        names = list(procedures_table) + [kind.upper() for kind in sorted(procedures_table.routines)]
+        for name, procedure_code in zip(names, procedures_table.code):
+            self.code += procedure_code
+            for instruction in procedure_code:
+                frames, source = instruction.origin or ((), name)
+                self.lines.append((source, instruction.line))
+                self.inlined.append(frames)
+        self.peephole_report = procedures_table.peephole_report
+        self.warnings = procedures_table.warnings
+
+    def entries(self):
+        entries = {procedure.first_line: name for name, procedure in self.procedures_table.items()}
+        for kind, address in self.procedures_table.routines.items():
+            entries[address] = kind.upper()
+        return entries
+
+    def text(self):
+        return "".join(f"{instruction}\n" for instruction in self.code)
+
+    def write(self, path):
+        with open(path, 'w') as out_f:
+            out_f.write(self.text())
+
+    def write_lines(self, path):
+        with open(path, 'w') as out_f:
+            for address, (name, line) in enumerate(self.lines):
+                print(f"{address}\t{name}\t{'' if line is None else line}", file=out_f)
@@ -0,0 +1,79 @@
+from structures import Variable
+from ast_nodes import Name, Element, Load, BinOp, Assign, If, While, Until, Read, Write, Call, Inline
+
+LOOP_WEIGHT = 10
+REGISTER_ORDER = "hgfedcb"
+
+
+class LoopRegisterAllocator:
+    def __init__(self, procedure, excluded):
+        self.procedure = procedure
+        self.excluded = excluded
+        self.weights = {}
+        self.written = set()
+        self.calls = 0
+
+    def scan_loop(self, condition, commands):
+        self.scan_condition(condition, 1)
+        self.scan_commands(commands, 1)
+
+    def scan_commands(self, commands, weight):
+        for command in commands:
+            match command:
+                case Assign():
+                    self.scan_target(command.target, weight)
+                    self.scan_expression(command.expr, weight)
+                case Read():
+                    self.scan_target(command.target, weight)
+                case Write():
+                    self.scan_value(command.value, weight)
+                case If():
+                    self.scan_condition(command.condition, weight)
+                    self.scan_commands(command.commands, weight)
+                    if command.else_commands is not None:
+                        self.scan_commands(command.else_commands, weight)
+                case While() | Until():
+                    self.scan_condition(command.condition, weight * LOOP_WEIGHT)
+                    self.scan_commands(command.commands, weight * LOOP_WEIGHT)
+                case Call():
+                    self.calls += weight
+                case Inline():
+                    self.scan_commands(command.commands, weight)
+
+    def scan_condition(self, condition, weight):
+        self.scan_value(condition.left, weight)
+        self.scan_value(condition.right, weight)
+
+    def scan_expression(self, expr, weight):
+        if type(expr) is BinOp:
+            self.scan_value(expr.left, weight)
+            self.scan_value(expr.right, weight)
+        else:
+            self.scan_value(expr, weight)
+
+    def scan_value(self, value, weight):
+        if type(value) is Load:
+            self.scan_identifier(value.target, weight)
+
+    def scan_target(self, target, weight):
+        if type(target) is Name:
+            self.written.add(target.name)
+        self.scan_identifier(target, weight)
+
+    def scan_identifier(self, identifier, weight):
+        if type(identifier) is Element:
+            if type(identifier.index) is Name:
+                self.scan_identifier(identifier.index, weight)
+        elif type(identifier.symbol) is Variable and identifier.name not in self.excluded:
+            self.weights[identifier.name] = self.weights.get(identifier.name, 0) + weight
+
+    def choose(self, used_registers):
+        free = [reg for reg in REGISTER_ORDER if reg not in used_registers]
+        promoted = {}
+        for name in sorted(self.weights, key=lambda name: (-self.weights[name], name)):
+            if not free:
+                break
+            spills = 1 + (name in self.written)
+            if self.weights[name] > self.calls * spills:
+                promoted[name] = free.pop(0)
+        return promoted
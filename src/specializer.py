@@ -0,0 +1,119 @@
+from structures import Procedure, Link, Link_T
+from ast_nodes import Call, If, While, Until, Inline, is_array
+from inliner import InlineError, Substitution, call_sites, remove_unused
+
+LOOP_WEIGHT = 10
+
+
+def weighted_calls(commands, weight=1):
+    for command in commands:
+        match command:
+            case Call():
+                yield command, weight
+            case If():
+                yield from weighted_calls(command.commands, weight)
+                if command.else_commands is not None:
+                    yield from weighted_calls(command.else_commands, weight)
+            case While() | Until():
+                yield from weighted_calls(command.commands, weight * LOOP_WEIGHT)
+            case Inline():
+                yield from weighted_calls(command.commands, weight)
+
+
+def binding(call):
+    # the arguments are known addresses unless one of them is itself a
+    # parameter of the caller
+    if len(call.args) != len(call.procedure.links):
+        return None
+    if any(type(arg.symbol) in (Link, Link_T) for arg in call.args):
+        return None
+    return tuple(arg.symbol for arg in call.args)
+
+
+class Specializer:
+    # makes copies of a procedure for the argument bindings it is called with
+    # most, with parameters replaced by the caller's variables so that they
+    # are read and written at their own address instead of through the link.
+    # Callers come after their callees, so walking the procedures backwards
+    # sees every call of a procedure, including calls from copies made
+    # earlier, before deciding on its copies
+    def __init__(self, procedures_table, max_clones):
+        self.procedures_table = procedures_table
+        self.max_clones = max_clones
+        self.clones = {}
+        self.original_sites = {}
+
+    def run(self):
+        table = self.procedures_table
+        self.original_sites = call_sites(table)
+        # the calls made by live procedures, by the name they were made to
+        self.calls = {}
+        for name in reversed(list(table)):
+            procedure = table[name]
+            if name != "PROGRAM" and procedure.links:
+                self.specialize(procedure)
+            # every caller has been seen, so whether the procedure is still
+            # called is known; copies are kept as they are all called
+            if self.live(name):
+                self.add_calls(procedure)
+            for clone in self.clones.get(name, ()):
+                self.add_calls(clone)
+        order = []
+        for name in table:
+            order.append((name, table[name]))
+            order += [(clone.name, clone) for clone in self.clones.get(name, ())]
+        table.clear()
+        table.update(order)
+        remove_unused(table, self.original_sites)
+
+    def live(self, name):
+        if name == "PROGRAM" or self.original_sites.get(name, 0) == 0:
+            return True
+        return any(call.name == name for call, _ in self.calls.get(name, ()))
+
+    def add_calls(self, procedure):
+        for call, weight in weighted_calls(procedure.commands):
+            self.calls.setdefault(call.name, []).append((call, weight))
+
+    def specialize(self, procedure):
+        sites = {}
+        weights = {}
+        for call, weight in self.calls.get(procedure.name, ()):
+            key = binding(call)
+            if key is not None:
+                sites.setdefault(key, []).append(call)
+                weights[key] = weights.get(key, 0) + weight
+        chosen = sorted(sites, key=lambda key: -weights[key])[:self.max_clones]
+        for key in chosen:
+            clone = self.clone(procedure, key, len(self.clones.get(procedure.name, ())) + 1)
+            if clone is None:
+                continue
+            self.clones.setdefault(procedure.name, []).append(clone)
+            for call in sites[key]:
+                call.name, call.procedure, call.args = clone.name, clone, []
+
+    def clone(self, procedure, key, number):
+        names = {name: (name, symbol) for name, symbol in procedure.symbols.items()}
+        bindings = {}
+        for (param, link), symbol in zip(procedure.links.items(), key):
+            if (type(link) is Link_T) != is_array(symbol):
+                return None
+            # parameters bound to the same variable must share one name, or
+            # loop promotion would keep them in two registers
+            name = next((other for other in bindings if bindings[other] is symbol), param)
+            bindings[name] = symbol
+            names[param] = (name, symbol)
+        try:
+            commands = Substitution(names).commands(procedure.commands)
+        except InlineError:
+            return None
+        # the copy is never active at the same time as the procedure, so it
+        # shares its memory, including the slot of the return address
+        clone = Procedure(procedure.memory_offset)
+        clone.name = f"{procedure.name}.{number}"
+        clone.last_index = procedure.last_index
+        clone.symbols = dict(procedure.symbols)
+        clone.bindings = bindings
+        clone.symbols.update(clone.bindings)
+        clone.commands = commands
+        return clone
@@ -42,6 +42,12 @@ class Procedure():
         self.symbols = {}
         self.links = {}
         self.consts = {}
+        # set on specialized copies: parameter name -> caller's symbol, and
+        # the bound variables the copy assigns
+        self.bindings = {}
+        self.assigned = []
+        # operand ranges of the expressions, filled by ValueRanges
+        self.ranges = {}
 
     def set_commands(self, commands):
         self.commands = commands
@@ -0,0 +1,215 @@
+from structures import Variable
+from ast_nodes import Const, Name, Load, BinOp, Assign, If, While, Until, Read, Write, Call, Inline
+from const_propagation import ConstantPropagation, fold
+from induction import increment, reads, value_names, identifier_names
+from inliner import size
+from loops import LoopEffects, LoopPass
+
+# loops running more times than this are not counted
+MAX_TRIPS = 10000
+
+
+def counter_step(command):
+    # the operation and constant of i := i + c, i := c + i or i := i - c
+    if type(command) is not Assign or type(command.target) is not Name:
+        return None
+    if increment(command) is not None:
+        return "add", increment(command)
+    expr = command.expr
+    if type(expr) is BinOp and expr.op == "sub" and expr.left == Load(command.target) and \
+            type(expr.right) is Const and expr.right.value > 0:
+        return "sub", expr.right.value
+    return None
+
+
+def has_loops(commands):
+    for command in commands:
+        match command:
+            case While() | Until():
+                return True
+            case If():
+                if has_loops(command.commands) or has_loops(command.else_commands or []):
+                    return True
+            case Inline():
+                if has_loops(command.commands):
+                    return True
+    return False
+
+
+def first_reads(commands, written):
+    # the variables the commands may read before a write to them that
+    # happens on every path, and the variables written on every path
+    found = set()
+    written = set(written)
+
+    def read(names):
+        found.update(name.symbol for name in names if type(name.symbol) is Variable and name.symbol not in written)
+
+    for command in commands:
+        match command:
+            case Assign():
+                expr = command.expr
+                for value in [expr.left, expr.right] if type(expr) is BinOp else [expr]:
+                    read(value_names(value))
+                if type(command.target) is Name:
+                    written.add(command.target.symbol)
+                else:
+                    read(identifier_names(command.target))
+            case Read():
+                if type(command.target) is Name:
+                    written.add(command.target.symbol)
+                else:
+                    read(identifier_names(command.target))
+            case Write():
+                read(value_names(command.value))
+            case If():
+                read(value_names(command.condition.left))
+                read(value_names(command.condition.right))
+                then_found, then_written = first_reads(command.commands, written)
+                else_found, else_written = first_reads(command.else_commands or [], written)
+                found |= then_found | else_found
+                written = then_written & else_written
+            case While():
+                read(value_names(command.condition.left))
+                read(value_names(command.condition.right))
+                found |= first_reads(command.commands, written)[0]
+            case Until():
+                body_found, written = first_reads(command.commands, written)
+                found |= body_found
+                read(value_names(command.condition.left))
+                read(value_names(command.condition.right))
+            case Inline():
+                body_found, written = first_reads(command.commands, written)
+                found |= body_found
+    return found, written
+
+
+class AssignedBefore(LoopPass):
+    # the variables set on every path to each loop, by id of the loop
+    def __init__(self, procedures_table, procedure):
+        super().__init__(procedures_table, procedure)
+        self.before = {}
+        bound = {symbol for symbol in procedure.bindings.values() if type(symbol) is Variable}
+        self.commands(procedure.commands, bound)
+
+    def loop(self, command, assigned, following):
+        self.before[id(command)] = assigned
+        _, body_assigned = self.commands(command.commands, assigned)
+        return [], command, [], body_assigned
+
+
+class LoopUnrolling(ConstantPropagation):
+    # constant propagation that also unrolls counted loops. A loop is
+    # counted when one side of its condition is a variable known on
+    # entry that the body changes only by one i := i + c or i := i - c at
+    # its top level, and the other side does not change in the loop; the
+    # number of times the body runs is then found by stepping the variable
+    # here. A loop without loops inside whose copies fit in budget is
+    # replaced by them, so the propagation turns the variable into a
+    # constant in each copy and t[i] into a fixed cell; the steps are
+    # dropped for a single assignment of the last value when nothing reads
+    # the variable any more. Otherwise the body is repeated as many times
+    # as fit and divide the count, so the condition is tested less often.
+    # Reads of unset variables are an error outside of loops, so a loop
+    # whose body may read a variable before setting it is only unrolled
+    # when that variable is set on every path to the loop
+    def __init__(self, procedures_table, procedure, budget):
+        super().__init__(procedure)
+        self.budget = budget
+        self.depth = 0
+        self.before = AssignedBefore(procedures_table, procedure).before
+
+    def counted(self, command, env):
+        # the counter and the number of times the body runs
+        head = None
+        for side in (command.condition.left, command.condition.right):
+            if type(side) is not Load or type(side.target) is not Name:
+                continue
+            symbol = side.target.symbol
+            if type(symbol) is not Variable or symbol not in env or self.writes(command.commands, symbol) != 1:
+                continue
+            steps = [counter_step(body_command) for body_command in command.commands
+                     if type(body_command) is Assign and body_command.target == side.target]
+            if len(steps) != 1 or steps[0] is None:
+                continue
+            if head is None:
+                head, _ = self.loop_head(command, env)
+            if self.condition(command.condition, head | {symbol: env[symbol]}) is None:
+                # the other side changes in the loop
+                continue
+            op, step = steps[0]
+            value, trips = env[symbol], 0
+            while True:
+                if type(command) is While and not self.condition(command.condition, head | {symbol: value}):
+                    break
+                trips += 1
+                value = fold(op, value, step)
+                if type(command) is Until and self.condition(command.condition, head | {symbol: value}):
+                    break
+                if trips > MAX_TRIPS:
+                    return None
+            return side.target, trips
+        return None
+
+    def writes(self, commands, symbol):
+        # how many commands may write symbol
+        count = 0
+        for command in commands:
+            match command:
+                case Assign() | Read():
+                    count += type(command.target) is Name and command.target.symbol is symbol
+                case Call():
+                    count += any(arg.symbol is symbol for arg in command.args) or symbol not in self.locals
+                case If():
+                    count += self.writes(command.commands, symbol) + self.writes(command.else_commands or [], symbol)
+                case While() | Until() | Inline():
+                    count += self.writes(command.commands, symbol)
+        return count
+
+    def unroll(self, command, env, rewrite, result):
+        # the environment after the loop, which is unrolled when counted
+        found = None if has_loops(command.commands) else self.counted(command, env)
+        if found is None or found[1] == 0:
+            return self.keep(command, env, rewrite, result)
+        counter, trips = found
+        body_size = max(size(command.commands), 1)
+        if trips * body_size <= self.budget and self.copyable(command, counter):
+            body, env = self.commands(command.commands * trips, env, rewrite)
+            if rewrite:
+                if not reads(body, counter.symbol):
+                    body = [copy for copy in body
+                            if not (type(copy) is Assign and type(copy.target) is Name and
+                                    copy.target.symbol is counter.symbol)]
+                    body.append(Assign(counter, Const(env[counter.symbol]), command.lineno))
+                result += body
+            return env
+        # a body repeated as many times as the loop runs would run once
+        factor = min(trips - 1, self.budget // body_size)
+        while factor > 1 and trips % factor:
+            factor -= 1
+        if factor > 1:
+            command = type(command)(command.condition, command.commands * factor, command.lineno)
+        return self.keep(command, env, rewrite, result)
+
+    def copyable(self, command, counter):
+        # whether the copies of the body can replace the loop: they read no
+        # variable that may be unset, and outside of loops, where nothing
+        # holds variables in registers, they write no variable but the counter
+        if not first_reads(command.commands, set())[0] <= self.before.get(id(command), set()):
+            return False
+        return self.depth > 0 or LoopEffects(self.locals, command.commands).scalars <= {counter.symbol}
+
+    def keep(self, command, env, rewrite, result):
+        self.depth += 1
+        if type(command) is While:
+            env = super().perform_while(command, env, rewrite, result)
+        else:
+            env = super().perform_until(command, env, rewrite, result)
+        self.depth -= 1
+        return env
+
+    def perform_while(self, command, env, rewrite, result):
+        return self.unroll(command, env, rewrite, result)
+
+    def perform_until(self, command, env, rewrite, result):
+        return self.unroll(command, env, rewrite, result)
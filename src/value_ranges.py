@@ -0,0 +1,255 @@
+from structures import Variable
+from ast_nodes import Const, Name, Load, BinOp, Assign, If, While, Until, Read, Write, Call, Inline
+
+# a range is (low, high), with high None when there is no upper bound
+TOP = (0, None)
+
+NEGATED = {"eq": "ne", "ne": "eq", "lt": "ge", "ge": "lt", "gt": "le", "le": "gt"}
+SWAPPED = {"eq": "eq", "ne": "ne", "lt": "gt", "gt": "lt", "le": "ge", "ge": "le"}
+
+
+def join(x, y):
+    high = None if x[1] is None or y[1] is None else max(x[1], y[1])
+    return min(x[0], y[0]), high
+
+
+def widen(old, new):
+    # a bound that is still moving is dropped, so loops reach a fixpoint
+    low = old[0] if new[0] >= old[0] else 0
+    high = old[1] if old[1] is not None and new[1] is not None and new[1] <= old[1] else None
+    return low, high
+
+
+def meet(env, other, combine=join):
+    result = {}
+    for symbol, value in env.items():
+        if symbol in other:
+            combined = combine(value, other[symbol])
+            if combined != TOP:
+                result[symbol] = combined
+    return result
+
+
+def arithmetic(op, x, y):
+    # the machine saturates subtraction at 0 and divides by 0 to 0
+    (xl, xh), (yl, yh) = x, y
+    match op:
+        case "add":
+            return xl + yl, None if xh is None or yh is None else xh + yh
+        case "sub":
+            return (0 if yh is None else max(0, xl - yh)), None if xh is None else max(0, xh - yl)
+        case "mul":
+            return xl * yl, None if xh is None or yh is None else xh * yh
+        case "div":
+            low = xl // yh if yl > 0 and yh is not None else 0
+            return low, None if xh is None else xh // max(yl, 1)
+        case "mod":
+            if xh is not None and xh < yl:
+                return x
+            if yh is None:
+                return 0, xh
+            return 0, max(0, yh - 1) if xh is None else min(xh, max(0, yh - 1))
+
+
+def decide(op, x, y):
+    # whether x op y holds for all values in the ranges, or for none
+    (xl, xh), (yl, yh) = x, y
+    match op:
+        case "lt":
+            if xh is not None and xh < yl:
+                return True
+            if yh is not None and xl >= yh:
+                return False
+        case "le":
+            if xh is not None and xh <= yl:
+                return True
+            if yh is not None and xl > yh:
+                return False
+        case "gt" | "ge":
+            return decide(SWAPPED[op], y, x)
+        case "eq" | "ne":
+            if xl == xh == yl == yh:
+                return op == "eq"
+            if xh is not None and xh < yl or yh is not None and yh < xl:
+                return op == "ne"
+    return None
+
+
+def constrain(op, x, y):
+    # the ranges of x and y narrowed to the values for which x op y holds
+    (xl, xh), (yl, yh) = x, y
+    match op:
+        case "lt" | "le":
+            gap = 1 if op == "lt" else 0
+            if yh is not None:
+                xh = yh - gap if xh is None else min(xh, yh - gap)
+            yl = max(yl, xl + gap)
+        case "gt" | "ge":
+            y, x = constrain(SWAPPED[op], y, x)
+            return x, y
+        case "eq":
+            xl = yl = max(xl, yl)
+            xh = yh = yh if xh is None else xh if yh is None else min(xh, yh)
+    return (xl, xh), (yl, yh)
+
+
+class ValueRanges:
+    # forward dataflow over the commands of one procedure, keeping a lower
+    # and upper bound for the plain variables, like ConstantPropagation
+    # does for their values. Conditions narrow the ranges in the branches
+    # and loops they guard, and bounds that still grow at a loop head are
+    # dropped. Branches whose condition is decided by the ranges are
+    # removed, a % b and a / b with a below b become a and 0, and the
+    # operand ranges of the other expressions are left in
+    # procedure.ranges for the code generator
+    def __init__(self, procedure):
+        self.procedure = procedure
+        self.locals = {symbol for name, symbol in procedure.symbols.items()
+                       if type(symbol) is Variable and "." not in name and name not in procedure.bindings}
+        # the head last found for each loop, as in ConstantPropagation
+        self.heads = {}
+
+    def run(self):
+        self.procedure.ranges = {}
+        self.procedure.commands, _ = self.commands(self.procedure.commands, {}, True)
+
+    def value(self, value, env):
+        if type(value) is Const:
+            return value.value, value.value
+        if type(value) is Load and type(value.target) is Name:
+            return env.get(value.target.symbol, TOP)
+        return TOP
+
+    def expression(self, expr, env):
+        if type(expr) is BinOp:
+            return arithmetic(expr.op, self.value(expr.left, env), self.value(expr.right, env))
+        return self.value(expr, env)
+
+    def condition(self, condition, env):
+        return decide(condition.op, self.value(condition.left, env), self.value(condition.right, env))
+
+    def narrow(self, condition, env, holds):
+        op = condition.op if holds else NEGATED[condition.op]
+        left, right = constrain(op, self.value(condition.left, env), self.value(condition.right, env))
+        env = dict(env)
+        for value, bounds in ((condition.left, left), (condition.right, right)):
+            if type(value) is Load and type(value.target) is Name and type(value.target.symbol) is Variable:
+                env[value.target.symbol] = bounds
+        return env
+
+    def rewrite_expression(self, expr, env):
+        low, high = self.expression(expr, env)
+        if low == high:
+            return Const(low)
+        if type(expr) is not BinOp:
+            return expr
+        left, right = self.value(expr.left, env), self.value(expr.right, env)
+        if expr.op in ("div", "mod") and left[1] is not None and left[1] < right[0]:
+            return expr.left if expr.op == "mod" else Const(0)
+        ranges = self.procedure.ranges
+        if expr in ranges:
+            left, right = join(left, ranges[expr][0]), join(right, ranges[expr][1])
+        ranges[expr] = left, right
+        return expr
+
+    def commands(self, commands, env, rewrite):
+        # returns the rewritten commands (None when not rewriting) and the
+        # ranges known after them
+        env = dict(env)
+        result = [] if rewrite else None
+        for command in commands:
+            match command:
+                case Assign():
+                    bounds = self.expression(command.expr, env)
+                    if rewrite:
+                        result.append(Assign(command.target, self.rewrite_expression(command.expr, env),
+                                             command.lineno))
+                    if type(command.target) is Name and type(command.target.symbol) is Variable:
+                        if bounds == TOP:
+                            env.pop(command.target.symbol, None)
+                        else:
+                            env[command.target.symbol] = bounds
+                case Read():
+                    if rewrite:
+                        result.append(command)
+                    if type(command.target) is Name:
+                        env.pop(command.target.symbol, None)
+                case Write():
+                    if rewrite:
+                        result.append(command)
+                case Call():
+                    if rewrite:
+                        result.append(command)
+                    written = {arg.symbol for arg in command.args} | set(command.procedure.bindings.values())
+                    env = {symbol: bounds for symbol, bounds in env.items()
+                           if symbol in self.locals and symbol not in written}
+                case Inline():
+                    body, env = self.commands(command.commands, env, rewrite)
+                    if rewrite:
+                        result.append(Inline(command.call, body, command.lineno))
+                case If():
+                    env = self.perform_if(command, env, rewrite, result)
+                case While():
+                    env = self.perform_while(command, env, rewrite, result)
+                case Until():
+                    env = self.perform_until(command, env, rewrite, result)
+        return result, env
+
+    def perform_if(self, command, env, rewrite, result):
+        known = self.condition(command.condition, env)
+        if known is not None:
+            # only the branch taken is kept
+            branch = command.commands if known else command.else_commands or []
+            body, env = self.commands(branch, env, rewrite)
+            if rewrite:
+                result += body
+            return env
+        body, then_env = self.commands(command.commands, self.narrow(command.condition, env, True), rewrite)
+        else_body, else_env = self.commands(command.else_commands or [], self.narrow(command.condition, env, False),
+                                            rewrite)
+        if rewrite:
+            if command.else_commands is None:
+                else_body = None
+            result.append(If(command.condition, body, else_body, command.lineno))
+        return meet(then_env, else_env)
+
+    def start(self, command, env, rewrite):
+        # while the loops around it are still settling, a loop entered again
+        # starts from the head it had the last time joined with the new entry,
+        # so it is not settled from scratch on every round of each of them.
+        # Bounds widened away on an early round would stay lost that way, so
+        # the head the loop is rewritten with is found from its entry alone
+        if rewrite or id(command) not in self.heads:
+            return env
+        return meet(self.heads[id(command)][1], env)
+
+    def perform_while(self, command, env, rewrite, result):
+        if self.condition(command.condition, env) is False:
+            # the body never runs
+            return env
+        head = self.start(command, env, rewrite)
+        while True:
+            _, out = self.commands(command.commands, self.narrow(command.condition, head, True), False)
+            new_head = meet(head, meet(env, out), widen)
+            if new_head == head:
+                break
+            head = new_head
+        self.heads[id(command)] = command, head
+        if rewrite:
+            body, _ = self.commands(command.commands, self.narrow(command.condition, head, True), True)
+            result.append(While(command.condition, body, command.lineno))
+        return self.narrow(command.condition, head, False)
+
+    def perform_until(self, command, env, rewrite, result):
+        head = self.start(command, env, rewrite)
+        while True:
+            _, out = self.commands(command.commands, head, False)
+            new_head = meet(head, meet(env, self.narrow(command.condition, out, False)), widen)
+            if new_head == head:
+                break
+            head = new_head
+        self.heads[id(command)] = command, head
+        if rewrite:
+            body, _ = self.commands(command.commands, head, True)
+            result.append(Until(command.condition, body, command.lineno))
+        return self.narrow(command.condition, out, True)